@@ -0,0 +1,23 @@
+import importlib.util
+import os
+import sys
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "services")
+
+# load a service's main.py under a unique module name, since every service
+# deploys its own main.py and they can't all be imported as "main"
+def load_service(name: str):
+    module_name = f"{name}_main"
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    service_dir = os.path.abspath(os.path.join(SERVICES_DIR, name))
+    # let the service import its own sibling modules
+    if service_dir not in sys.path:
+        sys.path.insert(0, service_dir)
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(service_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
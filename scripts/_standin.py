@@ -0,0 +1,273 @@
+import bisect
+import operator
+import time
+import uuid
+from datetime import datetime, timezone
+
+# in-memory stand-in for the parts of google.cloud.firestore the services use,
+# so benchmarks can run locally without credentials or an emulator
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        # the stand-in keeps no update times, so preconditions on them always hold
+        self.update_time = None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field)
+
+# apply field values to a stored document, resolving array transforms
+# (ArrayUnion, ArrayRemove), Increment and SERVER_TIMESTAMP the way the server would
+def apply_fields(stored, data):
+    for field, value in data.items():
+        transform = type(value).__name__
+        if transform == "ArrayUnion":
+            current = list(stored.get(field) or [])
+            stored[field] = current + [item for item in value.values if item not in current]
+        elif transform == "ArrayRemove":
+            stored[field] = [item for item in stored.get(field) or [] if item not in value.values]
+        elif transform == "Increment":
+            stored[field] = (stored.get(field) or 0) + value.value
+        elif transform == "Sentinel":
+            from google.cloud.firestore import SERVER_TIMESTAMP
+            if value is not SERVER_TIMESTAMP:
+                raise NotImplementedError(value.description)
+            stored[field] = datetime.now(timezone.utc)
+        else:
+            stored[field] = value
+    return stored
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self, field_paths=None, **kwargs):
+        data = self._collection._docs.get(self.id)
+        if data is not None and field_paths is not None:
+            data = {field: data[field] for field in field_paths if field in data}
+        return FakeSnapshot(self, data)
+
+    def set(self, data, merge=False):
+        if merge and self.id in self._collection._docs:
+            apply_fields(self._collection._docs[self.id], data)
+        else:
+            self._collection._insert(self.id, apply_fields({}, data))
+
+    def create(self, data):
+        if self.id in self._collection._docs:
+            from google.api_core.exceptions import AlreadyExists
+            raise AlreadyExists(f"Document already exists: {self.id}")
+        self._collection._insert(self.id, apply_fields({}, data))
+
+    def update(self, data):
+        if self.id not in self._collection._docs:
+            from google.api_core.exceptions import NotFound
+            raise NotFound(f"No document to update: {self.id}")
+        apply_fields(self._collection._docs[self.id], data)
+
+    def delete(self, option=None):
+        if option is not None and option.get("exists") and self.id not in self._collection._docs:
+            from google.api_core.exceptions import NotFound
+            raise NotFound(f"No document to delete: {self.id}")
+        self._collection._docs.pop(self.id, None)
+
+# query operators the stand-in supports
+OPERATORS = {
+    "==": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda field, values: field in values
+}
+
+class FakeQuery:
+    def __init__(self, collection, filters=None, limit=None, ordered=None, after=None, fields=None):
+        self._collection = collection
+        self._filters = filters or []
+        self._limit = limit
+        # fields to order by, cursors are only supported by document ID
+        self._ordered = ordered
+        self._after = after
+        # fields to return, or None for whole documents
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {"filters": self._filters, "limit": self._limit, "ordered": self._ordered, "after": self._after, "fields": self._fields}
+        state.update(changes)
+        return FakeQuery(self._collection, **state)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def where(self, field, op, value):
+        if op not in OPERATORS:
+            raise NotImplementedError(op)
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field):
+        return self._copy(ordered=self._ordered + [field] if self._ordered else [field])
+
+    def start_after(self, values):
+        return self._copy(after=values["__name__"])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def count(self, alias=None):
+        return FakeAggregationQuery(self, alias)
+
+    def sum(self, field_ref, alias=None):
+        return FakeAggregationQuery(self, alias, field_ref)
+
+    def stream(self):
+        returned = 0
+        docs = self._collection._docs
+        if self._ordered == ["__name__"]:
+            # walk the sorted document IDs from the cursor, like firestore's index would,
+            # so paging through a large collection doesn't sort it for every page
+            ids = self._collection._sorted_ids()
+            start = bisect.bisect_right(ids, self._after) if self._after is not None else 0
+            items = ((ids[i], docs.get(ids[i])) for i in range(start, len(ids)))
+            items = ((doc_id, data) for doc_id, data in items if data is not None)
+        else:
+            items = list(docs.items())
+        if self._ordered and self._ordered != ["__name__"]:
+            # documents missing an ordering field are left out, like firestore does
+            items = [(doc_id, data) for doc_id, data in items if all(field == "__name__" or field in data for field in self._ordered)]
+            items.sort(key=lambda item: [item[0] if field == "__name__" else item[1][field] for field in self._ordered] + [item[0]])
+        for doc_id, data in items:
+            if self._after is not None and doc_id <= self._after:
+                continue
+            if all(field in data and OPERATORS[op](data[field], value) for field, op, value in self._filters):
+                if self._limit is not None and returned >= self._limit:
+                    return
+                returned += 1
+                if self._fields is not None:
+                    data = {field: data[field] for field in self._fields if field in data}
+                yield FakeSnapshot(FakeDocumentReference(self._collection, doc_id), data)
+
+# a count or sum aggregation, answered like firestore does with one result list per query
+class FakeAggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+class FakeAggregationQuery:
+    def __init__(self, query, alias, field=None):
+        self._query = query
+        self._alias = alias
+        self._field = field
+
+    def get(self):
+        if self._field is None:
+            return [[FakeAggregationResult(self._alias, sum(1 for _ in self._query.stream()))]]
+        # documents without a numeric value in the field are left out of a sum
+        values = (doc.to_dict().get(self._field) for doc in self._query.stream())
+        return [[FakeAggregationResult(self._alias, sum(value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)))]]
+
+class FakeCollection(FakeQuery):
+    def __init__(self, name):
+        super().__init__(self)
+        self.id = name
+        self._docs = {}
+        # document IDs in order, rebuilt after documents are added
+        self._ids = None
+
+    def _insert(self, doc_id, data):
+        if doc_id not in self._docs:
+            self._ids = None
+        self._docs[doc_id] = data
+
+    def _sorted_ids(self):
+        ids = self._ids
+        if ids is None:
+            ids = self._ids = sorted(self._docs)
+        return ids
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self, doc_id or uuid.uuid4().hex[:20])
+
+class FakeBatch:
+    def __init__(self):
+        self._ops = []
+        # documents that must not exist, or must exist, for the batch to commit
+        self._absent = []
+        self._present = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(lambda: reference.set(data, merge=merge))
+
+    def create(self, reference, data):
+        self._absent.append(reference)
+        self._ops.append(lambda: reference.create(data))
+
+    def update(self, reference, data, option=None):
+        self._present.append(reference)
+        self._ops.append(lambda: reference.update(data))
+
+    def delete(self, reference, option=None):
+        self._ops.append(lambda: reference.delete(option=option))
+
+    def commit(self):
+        time.sleep(FakeClient.commit_latency)
+        # check preconditions first, so a failed batch writes nothing
+        for reference in self._absent:
+            if reference.get().exists:
+                from google.api_core.exceptions import AlreadyExists
+                raise AlreadyExists(f"Document already exists: {reference.id}")
+        for reference in self._present:
+            if not reference.get().exists:
+                from google.api_core.exceptions import NotFound
+                raise NotFound(f"No document to update: {reference.id}")
+        for op in self._ops:
+            op()
+        self._ops = []
+        self._absent = []
+        self._present = []
+
+class FakeClient:
+    # simulated cost of building a client: channel, credential lookup and TLS
+    connect_latency = 0.02
+    # simulated round trip of a batch commit
+    commit_latency = 0
+    # collections are shared between clients, like a real database would be
+    _collections = {}
+
+    def __init__(self, *args, **kwargs):
+        time.sleep(self.connect_latency)
+
+    def collection(self, name):
+        return FakeClient._collections.setdefault(name, FakeCollection(name))
+
+    def batch(self):
+        return FakeBatch()
+
+    def get_all(self, references, field_paths=None):
+        for reference in references:
+            yield reference.get(field_paths=field_paths)
+
+    def write_option(self, **kwargs):
+        return kwargs
+
+    @classmethod
+    def reset(cls):
+        cls._collections = {}
+
+class FakeRequest:
+    def __init__(self, method, path, json=None, args=None, headers=None):
+        self.method = method
+        self.path = path
+        self.args = args or {}
+        self.headers = headers or {}
+        self._json = json
+
+    def get_json(self, silent=False):
+        return self._json
@@ -0,0 +1,69 @@
+import argparse
+import itertools
+import logging
+from datetime import datetime, timedelta, timezone
+
+from _service import load_service
+
+# move reports older than the retention window out of firestore into the report
+# archive, one gzip NDJSON file per day, so the reports collection stops growing
+# GET /reports keeps serving archived dates from the archive, and the rollups
+# behind GET /reports/stats keep counting archived reports
+# each day is written in full before any of its reports are deleted, and a day
+# that was already archived is merged with its archive, so the job can be re-run
+# after a failure, or run daily from a scheduler
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old reports")
+    parser.add_argument("--location", help="local directory or gs://bucket/prefix (defaults to REPORT_ARCHIVE_LOCATION)")
+    parser.add_argument("--retention-days", type=int, help="keep reports this many days in firestore (defaults to REPORT_RETENTION_DAYS)")
+    parser.add_argument("--dry-run", action="store_true", help="count reports to archive without writing or deleting")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    service = load_service("report")
+    from archive import partition_exists, read_partition, write_partition
+
+    location = args.location or service.ARCHIVE_LOCATION
+    retention_days = service.RETENTION_DAYS if args.retention_days is None else args.retention_days
+    if not location:
+        parser.error("no archive location, pass --location or set REPORT_ARCHIVE_LOCATION")
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime("%Y-%m-%d")
+    logging.info(f"Archiving reports from before {cutoff} to {location}")
+
+    db = service.get_db()
+    # reports from before the date was stored have no date and can't be partitioned
+    query = service.get_reports_collection().where("date", "<", cutoff).order_by("date")
+
+    archived_days = 0
+    archived_reports = 0
+    for day, docs in itertools.groupby(query.stream(), key=lambda doc: doc.to_dict()["date"]):
+        docs = list(docs)
+        reports = {doc.id: doc.to_dict() for doc in docs}
+        if args.dry_run:
+            logging.info(f"{day}: {len(reports)} reports")
+            archived_days += 1
+            archived_reports += len(reports)
+            continue
+
+        # merge with an earlier archive of the day, keeping the reports from firestore
+        if partition_exists(location, day):
+            for report in read_partition(location, day):
+                reports.setdefault(report["id"], report)
+        count = write_partition(location, day, (reports[report_id] for report_id in sorted(reports)), default=service.encode_value)
+
+        # only delete once the day's archive is written
+        for i in range(0, len(docs), service.BATCH_SIZE):
+            batch = db.batch()
+            for doc in docs[i:i + service.BATCH_SIZE]:
+                batch.delete(doc.reference)
+            batch.commit()
+        logging.info(f"{day}: archived {len(docs)} reports, {count} in the archive")
+        archived_days += 1
+        archived_reports += len(docs)
+
+    logging.info(f"{'Would archive' if args.dry_run else 'Archived'} {archived_reports} reports from {archived_days} days")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import logging
+
+from _service import load_service
+
+# create the email reservation documents (user_emails) for users registered before
+# registering and logging in used them, so those users can log in again
+# safe to run more than once: emails that are already reserved are left alone
+# run it right after deploying the user service, and again to catch users that
+# registered through the previous version while it was being replaced
+
+def main():
+    parser = argparse.ArgumentParser(description="Reserve the emails of existing users")
+    parser.add_argument("--dry-run", action="store_true", help="count missing reservations without writing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    service = load_service("user")
+    # a batch holds at most this many writes
+    from bulk import BATCH_SIZE
+    db = service.get_db()
+    emails = service.get_emails_collection()
+
+    # the first user (in document ID order) with an email gets its reservation
+    claimed = {}
+    user_count = 0
+    for doc in service.get_users_collection().select(["email"]).order_by("__name__").stream():
+        user_count += 1
+        email = (doc.to_dict().get("email") or "").strip().lower()
+        if not email:
+            logging.warning(f"users/{doc.id}: no email")
+        elif email in claimed:
+            # registered twice before reservations made that impossible
+            logging.warning(f"users/{doc.id}: {email} already belongs to users/{claimed[email]}")
+        else:
+            claimed[email] = doc.id
+
+    created = 0
+    conflicts = 0
+    items = list(claimed.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        chunk = items[start:start + BATCH_SIZE]
+        references = [emails.document(service.email_key(email)) for email, _ in chunk]
+        reserved = {snapshot.id: snapshot.to_dict() for snapshot in db.get_all(references) if snapshot.exists}
+
+        batch = db.batch()
+        writes = 0
+        for (email, user_id), reference in zip(chunk, references):
+            reservation = reserved.get(reference.id)
+            if reservation is None:
+                batch.create(reference, {"email": email, "userId": user_id})
+                writes += 1
+            elif reservation.get("userId") != user_id:
+                conflicts += 1
+                logging.warning(f"users/{user_id}: {email} is reserved for users/{reservation.get('userId')}")
+        if writes and not args.dry_run:
+            batch.commit()
+        created += writes
+
+    action = "would be created" if args.dry_run else "created"
+    logging.info(f"{user_count} users, {created} reservations {action}, {conflicts} reserved for another user")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import argparse
+import os
+import timeit
+
+from _service import load_service
+
+# compares authenticating a request by checking the password again (bcrypt, after
+# the firestore lookup it also needs) against verifying a signed access token
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault("FLOW_TOKEN_SECRET", "bench-secret")
+    load_service("user")
+    import bcrypt
+    from tokens import issue_token, verify_token
+
+    hashed = bcrypt.hashpw(b"Password123!", bcrypt.gensalt())
+    token = issue_token("user-1", "user")
+    assert verify_token(token)["sub"] == "user-1"
+
+    password = min(timeit.repeat(lambda: bcrypt.checkpw(b"Password123!", hashed), number=args.repeat, repeat=3)) / args.repeat
+    signed = min(timeit.repeat(lambda: verify_token(token), number=args.repeat * 1000, repeat=3)) / (args.repeat * 1000)
+    print(f"bcrypt check     {password * 1e6:10.1f} us")
+    print(f"token verify     {signed * 1e6:10.1f} us   {password / signed:8.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from _service import load_service
+from _standin import FakeClient
+
+# compares DELETE /users as it used to work (every document listed up front, 500
+# delete batches committed one after another, every deleted ID returned) against
+# bulk_delete (paged reads, batches committed concurrently, a sample of IDs),
+# on collections of up to a million documents with a simulated commit round trip
+
+def sequential_delete(db, query):
+    docs = list(query.stream())
+    batch = db.batch()
+    deleted_ids = []
+    for i, doc in enumerate(docs):
+        batch.delete(doc.reference)
+        deleted_ids.append(doc.id)
+        if (i + 1) % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    if len(docs) % 500 != 0:
+        batch.commit()
+    return len(deleted_ids), deleted_ids
+
+def seed(service, count):
+    FakeClient.reset()
+    service._users_collection = None
+    users = service.get_users_collection()
+    for i in range(count):
+        users.document(f"user{i:07d}").set({"id": f"user{i:07d}", "email": f"user{i}@example.com", "type": "user"})
+    return users
+
+# time a delete, then run it again with allocations traced for its peak memory,
+# since tracing slows it down
+def measure(label, service, delete, count, commit_latency):
+    db = service.get_db()
+    FakeClient.commit_latency = commit_latency
+    users = seed(service, count)
+    start = time.perf_counter()
+    deleted, ids = delete(db, users)
+    total = time.perf_counter() - start
+    assert deleted == count, f"{label} deleted {deleted} of {count} documents"
+
+    FakeClient.commit_latency = 0
+    users = seed(service, count)
+    tracemalloc.start()
+    delete(db, users)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {label:<10} {total:8.2f} s   {count / total:10.0f} docs/s   peak {peak / 1e6:8.1f} MB   {len(ids)} IDs returned")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--commit-latency-ms", type=float, default=20, help="simulated round trip of a batch commit")
+    args = parser.parse_args()
+
+    with patch("google.cloud.firestore.Client", FakeClient):
+        FakeClient.connect_latency = 0
+        service = load_service("user")
+        from bulk import bulk_delete, DEFAULT_DELETED_ID_SAMPLE, DELETE_WORKERS
+
+        print(f"simulated commit round trip {args.commit_latency_ms:.0f} ms, {DELETE_WORKERS} workers")
+        for count in args.docs:
+            print(f"{count} documents:")
+            measure("sequential", service, sequential_delete, count, args.commit_latency_ms / 1000)
+            measure("bulk", service, lambda db, users: bulk_delete(db, [users], DEFAULT_DELETED_ID_SAMPLE), count, args.commit_latency_ms / 1000)
+
+if __name__ == "__main__":
+    main()
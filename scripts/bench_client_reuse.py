@@ -0,0 +1,52 @@
+import statistics
+import time
+from unittest.mock import patch
+
+from _service import load_service
+from _standin import FakeClient, FakeRequest
+
+REQUESTS = 200
+
+# GET /{collection}/{id} through each service's request handler, once with the
+# client rebuilt on every request (previous behaviour) and once reusing the
+# lazily created module-level client
+SERVICES = {
+    "user": "users",
+    "route": "routes",
+    "report": "reports",
+    "map": "maps",
+}
+
+def run(service, collection, reuse_client):
+    timings = []
+    for _ in range(REQUESTS):
+        if not reuse_client:
+            service._db = None
+            setattr(service, f"_{collection}_collection", None)
+        request = FakeRequest("GET", f"/{collection}/1")
+        start = time.perf_counter()
+        service.request_handler(request)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(label, timings):
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p99 = timings[int(len(timings) * 0.99) - 1] * 1000
+    print(f"  {label:<16} p50 {p50:8.3f} ms   p99 {p99:8.3f} ms")
+
+def main():
+    print(f"{REQUESTS} requests per service, simulated client setup {FakeClient.connect_latency * 1000:.0f} ms")
+    for name, collection in SERVICES.items():
+        service = load_service(name)
+        with patch("google.cloud.firestore.Client", FakeClient):
+            FakeClient.reset()
+            FakeClient().collection(collection).document("1").set({"id": "1"})
+            print(f"{name}:")
+            report("client per call", run(service, collection, reuse_client=False))
+            service._db = None
+            setattr(service, f"_{collection}_collection", None)
+            report("reused client", run(service, collection, reuse_client=True))
+
+if __name__ == "__main__":
+    main()
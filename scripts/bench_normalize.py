@@ -0,0 +1,43 @@
+import argparse
+import random
+import re
+import timeit
+
+from _service import load_service
+
+# compares the per-stop normalization pipeline the handlers used to inline
+# against normalize_stops on long stop lists drawn from a pool of popular names
+
+def inline_normalize(stops):
+    normalized_stops = []
+    for stop in stops:
+        if not isinstance(stop, str):
+            return None
+        stop = stop.strip()
+        stop = re.sub(r"\s+", " ", stop)
+        stop = stop.title()
+        if re.match(r"^[A-Za-z0-9\s-]+$", stop) is None:
+            return None
+        normalized_stops.append(stop)
+    return normalized_stops
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stops", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--distinct", type=int, default=500, help="size of the pool of stop names")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    load_service("route")
+    from normalize import normalize_stops
+
+    pool = [f"  {random.choice(['main', 'oak', 'elm', '5th'])}   st  and  avenue {i} " for i in range(args.distinct)]
+    for count in args.stops:
+        stops = random.choices(pool, k=count)
+        assert inline_normalize(stops) == normalize_stops(stops)
+        inline = min(timeit.repeat(lambda: inline_normalize(stops), number=args.repeat, repeat=3)) / args.repeat
+        batched = min(timeit.repeat(lambda: normalize_stops(stops), number=args.repeat, repeat=3)) / args.repeat
+        print(f"{count:>6} stops   inline {inline * 1e6:9.1f} us   normalize_stops {batched * 1e6:9.1f} us   {inline / batched:5.1f}x")
+
+if __name__ == "__main__":
+    main()
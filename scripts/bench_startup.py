@@ -0,0 +1,70 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# measures cold start cost for each service in a fresh interpreter: the time to
+# import main.py, the time to answer a first request that never touches the
+# database (404), and the time to answer a first request that does (GET by ID,
+# served by the in-memory stand-in, so it includes the deferred firestore import)
+SERVICES = {
+    "user": "users",
+    "route": "routes",
+    "report": "reports",
+    "map": "maps",
+}
+
+def child(name):
+    start = time.perf_counter()
+    from _service import load_service
+    service = load_service(name)
+    import_time = time.perf_counter() - start
+
+    from unittest.mock import patch
+    from _standin import FakeClient, FakeRequest
+    FakeClient.connect_latency = 0
+
+    start = time.perf_counter()
+    service.request_handler(FakeRequest("GET", "/unknown"))
+    first_404 = time.perf_counter() - start
+
+    # patching imports google.cloud.firestore, so the timer includes it
+    start = time.perf_counter()
+    with patch("google.cloud.firestore.Client", FakeClient):
+        service.request_handler(FakeRequest("GET", f"/{SERVICES[name]}/1"))
+    first_db = time.perf_counter() - start
+
+    print(json.dumps({"import": import_time, "first_404": first_404, "first_db": first_db}))
+
+def run(name):
+    result = subprocess.run([sys.executable, __file__, "--child", name], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold start import time and time to first response")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per service")
+    parser.add_argument("--budget-ms", type=float, help="fail if any service's median import time exceeds this")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    over_budget = []
+    print(f"median of {args.runs} cold starts")
+    print(f"  {'service':<8} {'import':>10} {'first 404':>12} {'first db':>12}")
+    for name in SERVICES:
+        runs = [run(name) for _ in range(args.runs)]
+        median = {key: sorted(r[key] for r in runs)[len(runs) // 2] * 1000 for key in runs[0]}
+        print(f"  {name:<8} {median['import']:>7.1f} ms {median['first_404']:>9.2f} ms {median['first_db']:>9.1f} ms")
+        if args.budget_ms is not None and median["import"] > args.budget_ms:
+            over_budget.append(name)
+
+    if over_budget:
+        print(f"import time over {args.budget_ms} ms budget: {', '.join(over_budget)}")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import time
+import tracemalloc
+
+from _service import load_service
+
+# compares peak memory and time to first byte of a list response built with
+# http_response (every document materialized, then encoded as one string)
+# against http_stream_response (documents encoded one at a time)
+
+class Doc:
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": f"Route {self.id}",
+            "stops": [f"Stop {i}" for i in range(20)],
+            "createdBy": "test_user_id",
+            "active": True
+        }
+
+def stream_docs(count):
+    for i in range(count):
+        yield Doc(str(i))
+
+def buffered(service, count):
+    docs = list(stream_docs(count))
+    response = service.http_response(200, {"routes": [doc.to_dict() for doc in docs], "nextPageToken": ""})
+    yield response[0]
+
+def streamed(service, count):
+    response = service.http_stream_response(200, "routes", stream_docs(count))
+    yield from response[0]
+
+def measure(label, body):
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    for chunk in body:
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        size += len(chunk)
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {label:<9} body {size / 1e6:7.1f} MB   peak {peak / 1e6:7.1f} MB   first byte {first_byte * 1000:8.2f} ms   total {total * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    service = load_service("route")
+    for count in args.docs:
+        print(f"{count} documents:")
+        measure("buffered", buffered(service, count))
+        measure("streamed", streamed(service, count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import random
+import statistics
+import time
+import tracemalloc
+
+from _service import load_service
+
+# builds a grid-shaped transit network (a route along every row and column, plus
+# random crosstown routes) and reports the cost of building the planner's network,
+# planning trips on the cached network compared to rebuilding it per request, and
+# applying one route change in place compared to a full rebuild
+
+def grid_routes(side, crosstown, seed):
+    rng = random.Random(seed)
+    routes = {}
+    for i in range(side):
+        routes[f"row-{i}"] = [f"Stop {i}-{j}" for j in range(side)]
+        routes[f"column-{i}"] = [f"Stop {j}-{i}" for j in range(side)]
+    for i in range(crosstown):
+        routes[f"crosstown-{i}"] = [f"Stop {rng.randrange(side)}-{rng.randrange(side)}" for _ in range(side // 2)]
+    return routes
+
+def build(TransitNetwork, routes):
+    network = TransitNetwork()
+    for route_id, stops in routes.items():
+        network.add_route(route_id, stops)
+    return network
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--side", type=int, nargs="+", default=[100, 200], help="grid side, the network has side^2 stops")
+    parser.add_argument("--crosstown", type=int, default=50, help="number of random crosstown routes")
+    parser.add_argument("--trips", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    load_service("route")
+    from planner import TransitNetwork
+
+    for side in args.side:
+        routes = grid_routes(side, args.crosstown, args.seed)
+        stops = sorted({stop for route in routes.values() for stop in route})
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        network = build(TransitNetwork, routes)
+        build_time = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{len(stops)} stops, {len(routes)} routes:")
+        print(f"  build          {build_time * 1000:9.1f} ms   peak {peak / 1e6:6.1f} MB")
+
+        rng = random.Random(args.seed)
+        trips = [tuple(rng.sample(stops, 2)) for _ in range(args.trips)]
+        latencies = []
+        transfers = []
+        for origin, destination in trips:
+            start = time.perf_counter()
+            legs = network.plan(origin, destination)
+            latencies.append(time.perf_counter() - start)
+            transfers.append(len(legs) - 1)
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"  plan (cached)  {statistics.median(latencies) * 1000:9.2f} ms p50   {p99 * 1000:7.2f} ms p99   {statistics.mean(transfers):.2f} transfers on average")
+
+        # a stateless handler would rebuild the network on every request
+        start = time.perf_counter()
+        for origin, destination in trips[:10]:
+            build(TransitNetwork, routes).plan(origin, destination)
+        print(f"  plan (rebuild) {(time.perf_counter() - start) / 10 * 1000:9.2f} ms per trip")
+
+        # change one route in place compared to rebuilding after the change
+        route_id = "crosstown-0" if args.crosstown else "row-0"
+        changed = rng.sample(stops, side // 2)
+        start = time.perf_counter()
+        network.add_route(route_id, changed)
+        network.remove_route(route_id)
+        network.add_route(route_id, routes[route_id])
+        update_time = (time.perf_counter() - start) / 3
+        routes[route_id] = changed
+        start = time.perf_counter()
+        build(TransitNetwork, routes)
+        print(f"  route change   {update_time * 1e6:9.1f} us in place   {(time.perf_counter() - start) * 1000:.1f} ms rebuild")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import json
+import statistics
+import time
+from unittest.mock import patch
+
+from _service import load_service
+from _standin import FakeClient, FakeRequest
+
+# pages through every user with GET /users, following nextPageToken, and reports
+# the per-page latency at the start, middle and end of the collection
+# page tokens hold the last document ID, so every page is one query that starts
+# right after it, however deep into the collection it is
+
+def seed(service, count, admin_every):
+    FakeClient.reset()
+    service._users_collection = None
+    users = service.get_users_collection()
+    for i in range(count):
+        user_id = f"user{i:07d}"
+        account_type = "admin" if i % admin_every == 0 else "user"
+        users.document(user_id).set({"id": user_id, "email": f"user{i}@example.com", "password": "$2b$12$hash", "type": account_type})
+
+def page_through(service, params):
+    timings = []
+    users = 0
+    token = ""
+    while True:
+        args = dict(params, start_after=token) if token else dict(params)
+        start = time.perf_counter()
+        body, status, _ = service.request_handler(FakeRequest("GET", "/users", args=args))
+        data = json.loads("".join(body))["data"]
+        timings.append(time.perf_counter() - start)
+        assert status == 200
+        users += len(data["users"])
+        token = data["nextPageToken"]
+        if not token:
+            return users, timings
+
+def report(label, users, timings):
+    tenth = max(len(timings) // 10, 1)
+    middle = len(timings) // 2
+    first = statistics.median(timings[:tenth]) * 1000
+    mid = statistics.median(timings[middle:middle + tenth]) * 1000
+    last = statistics.median(timings[-tenth:]) * 1000
+    print(f"  {label:<14} {users:>8} users  {len(timings):>5} pages   p50 per page: first {first:7.2f} ms   middle {mid:7.2f} ms   last {last:7.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--limit", type=int, default=1000, help="page size")
+    parser.add_argument("--admin-every", type=int, default=10, help="one in this many users is an admin")
+    args = parser.parse_args()
+
+    with patch("google.cloud.firestore.Client", FakeClient):
+        FakeClient.connect_latency = 0
+        service = load_service("user")
+        seed(service, args.users, args.admin_every)
+
+        print(f"{args.users} users, {args.limit} per page")
+        report("all", *page_through(service, {"limit": str(args.limit)}))
+        report("type=admin", *page_through(service, {"limit": str(args.limit), "type": "admin"}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import time
+
+# pick the bcrypt cost for USER_BCRYPT_ROUNDS on the hardware the user service runs
+# on: the highest cost whose hashing time stays within the target latency
+# run it where the function runs (or on a machine with the same CPU), since every
+# step of the cost doubles the time to register, log in and change a password
+
+# lowest cost this recommends, whatever the target
+MIN_ROUNDS = 10
+
+def hash_time(bcrypt, rounds, samples):
+    timings = []
+    for _ in range(samples):
+        salt = bcrypt.gensalt(rounds=rounds)
+        start = time.perf_counter()
+        bcrypt.hashpw(b"Calibrate123!", salt)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick the bcrypt cost for USER_BCRYPT_ROUNDS")
+    parser.add_argument("--target-ms", type=float, default=250, help="hashing latency to aim for")
+    parser.add_argument("--samples", type=int, default=3, help="hashes timed per cost")
+    args = parser.parse_args()
+
+    import bcrypt
+
+    chosen = None
+    rounds = 4
+    while rounds <= 31:
+        elapsed = hash_time(bcrypt, rounds, args.samples) * 1000
+        print(f"  cost {rounds:>2}   {elapsed:10.1f} ms")
+        if elapsed > args.target_ms:
+            break
+        chosen = rounds
+        rounds += 1
+
+    if chosen is None or chosen < MIN_ROUNDS:
+        print(f"no cost of at least {MIN_ROUNDS} hashes within {args.target_ms:.0f} ms here, using {MIN_ROUNDS}")
+        chosen = MIN_ROUNDS
+    print(f"recommended cost {chosen}: deploy the user service with --set-env-vars USER_BCRYPT_ROUNDS={chosen}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+
+from _service import SERVICES_DIR, load_service
+
+# writes the composite indexes for every combination of report filters the report
+# service accepts, and for the report stats queries over the rollups, to
+# services/report/firestore.indexes.json
+# single report filters are served by firestore's automatic single-field indexes
+# deploy with: firebase deploy --only firestore:indexes
+
+INDEXES_PATH = os.path.abspath(os.path.join(SERVICES_DIR, "report", "firestore.indexes.json"))
+
+def generate(service):
+    indexes = []
+    for size in range(2, len(service.REPORT_FILTERS) + 1):
+        for fields in itertools.combinations(service.REPORT_FILTERS, size):
+            if service.is_indexed(fields):
+                indexes.append({
+                    "collectionGroup": "reports",
+                    "queryScope": "COLLECTION",
+                    # equality filters, then the document ID that pages are ordered by
+                    "fields": [{"fieldPath": field, "order": "ASCENDING"} for field in fields] + [{"fieldPath": "__name__", "order": "ASCENDING"}]
+                })
+    # stats queries match the bucket and any rollup filters, then a range of bucket starts
+    for size in range(len(service.ROLLUP_FILTERS) + 1):
+        for fields in itertools.combinations(service.ROLLUP_FILTERS, size):
+            indexes.append({
+                "collectionGroup": "report_rollups",
+                "queryScope": "COLLECTION",
+                "fields": [{"fieldPath": field, "order": "ASCENDING"} for field in ("bucket", *fields, "start")]
+            })
+    return json.dumps({"indexes": indexes, "fieldOverrides": []}, indent=2) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="fail if the indexes file is out of date instead of writing it")
+    args = parser.parse_args()
+
+    indexes = generate(load_service("report"))
+    if args.check:
+        with open(INDEXES_PATH) as f:
+            if f.read() != indexes:
+                print(f"{INDEXES_PATH} is out of date, run scripts/generate_report_indexes.py")
+                sys.exit(1)
+        print(f"{INDEXES_PATH} is up to date")
+        return
+
+    with open(INDEXES_PATH, "w") as f:
+        f.write(indexes)
+    print(f"Wrote {INDEXES_PATH}")
+
+if __name__ == "__main__":
+    main()
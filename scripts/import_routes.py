@@ -0,0 +1,73 @@
+import argparse
+import io
+import json
+import os
+import urllib.request
+import zipfile
+
+from _service import load_service
+
+# import routes from a GTFS feed (a directory or .zip) or a JSON array of routes
+# through POST /routes:import, sending the routes in chunks
+# GTFS feeds are parsed here, so large stop_times.txt files never go over the wire
+
+def load_routes(path):
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    load_service("route")
+    from gtfs import parse_gtfs
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as feed:
+            return parse_gtfs(lambda name: io.TextIOWrapper(feed.open(name), encoding="utf-8-sig", newline=""))
+    return parse_gtfs(lambda name: open(os.path.join(path, name), encoding="utf-8-sig", newline=""))
+
+def post(url, routes):
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/routes:import",
+        data=json.dumps({"routes": routes}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())["data"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import routes from GTFS or JSON")
+    parser.add_argument("path", help="GTFS directory, GTFS .zip or .json array of routes")
+    parser.add_argument("--url", help="base URL of the deployed route service")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="routes per request")
+    parser.add_argument("--dry-run", action="store_true", help="validate locally without importing")
+    args = parser.parse_args()
+
+    routes = load_routes(args.path)
+    print(f"{len(routes)} routes read from {args.path}")
+
+    errors = []
+    imported = 0
+    if args.dry_run:
+        service = load_service("route")
+        for row, route in enumerate(routes):
+            _, error = service.validate_route(route)
+            if error:
+                errors.append({"row": row, "error": error})
+        imported = len(routes) - len(errors)
+    else:
+        if not args.url:
+            parser.error("--url is required unless --dry-run is given")
+        for offset in range(0, len(routes), args.chunk_size):
+            result = post(args.url, routes[offset:offset + args.chunk_size])
+            imported += result["importedRouteCount"]
+            # rows are numbered within a request, so shift them back into the whole feed
+            errors.extend({"row": error["row"] + offset, "error": error["error"]} for error in result["errors"])
+            print(f"  rows {offset}-{min(offset + args.chunk_size, len(routes)) - 1}: {result['importedRouteCount']} imported")
+
+    for error in errors:
+        print(f"row {error['row']}: {error['error']}")
+    print(f"{imported} {'valid' if args.dry_run else 'imported'}, {len(errors)} failed")
+    raise SystemExit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import logging
+import os
+import statistics
+import threading
+import time
+from unittest.mock import patch
+
+from _service import load_service
+from _standin import FakeClient, FakeRequest
+
+# measures GET /users/{id} latency while a storm of concurrent logins runs against
+# the same function instance, once with bcrypt effectively inline (a worker per
+# login thread) and once on the bounded password pool, which turns logins away
+# with a 503 when it is saturated
+# turned-away clients wait RETRY_DELAY before trying again, as a real client would
+
+EMAIL = "storm@example.com"
+PASSWORD = "Password123!"
+RETRY_DELAY = 0.05
+
+def storm(service, stop, results, logins):
+    while not stop.is_set():
+        request = FakeRequest("POST", "/users/login", json={"email": EMAIL, "password": PASSWORD})
+        start = time.perf_counter()
+        status = service.request_handler(request)[1]
+        results[status] = results.get(status, 0) + 1
+        if status == 200:
+            logins.append(time.perf_counter() - start)
+        else:
+            time.sleep(RETRY_DELAY)
+
+def percentiles(timings):
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[max(int(len(timings) * 0.99) - 1, 0)] * 1000
+
+def probe(service, stop, timings, interval):
+    while not stop.is_set():
+        start = time.perf_counter()
+        assert service.request_handler(FakeRequest("GET", "/users/1"))[1] == 200
+        timings.append(time.perf_counter() - start)
+        time.sleep(interval)
+
+def run(service, label, workers, queue_limit, logins, seconds):
+    service.PASSWORD_WORKERS = workers
+    service.PASSWORD_QUEUE_LIMIT = queue_limit
+    if service._password_pool is not None:
+        service._password_pool.shutdown()
+    service._password_pool = None
+
+    stop = threading.Event()
+    timings = []
+    results = {}
+    login_timings = []
+    threads = [threading.Thread(target=storm, args=(service, stop, results, login_timings)) for _ in range(logins)]
+    threads.append(threading.Thread(target=probe, args=(service, stop, timings, 0.01)))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    p50, p99 = percentiles(timings)
+    line = f"  {label:<28} GET p50 {p50:7.2f} ms  p99 {p99:7.2f} ms"
+    if login_timings:
+        p50, p99 = percentiles(login_timings)
+        statuses = ", ".join(f"{count} x {status}" for status, count in sorted(results.items()))
+        line += f"   login p50 {p50:7.0f} ms  p99 {p99:7.0f} ms   {statuses}"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=32, help="concurrent login threads")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt cost of the stored password")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    os.environ["USER_BCRYPT_ROUNDS"] = str(args.rounds)
+    os.environ.setdefault("FLOW_TOKEN_SECRET", "load-test-secret")
+    with patch("google.cloud.firestore.Client", FakeClient):
+        FakeClient.connect_latency = 0
+        service = load_service("user")
+        import bcrypt
+
+        hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=args.rounds)).decode()
+        service.get_users_collection().document("1").set({"id": "1", "email": EMAIL, "password": hashed, "type": "user"})
+
+        print(f"{args.logins} login threads for {args.seconds:.0f} s, bcrypt cost {args.rounds}, {os.cpu_count()} CPUs")
+        workers, queue_limit = service.PASSWORD_WORKERS, service.PASSWORD_QUEUE_LIMIT
+        run(service, "idle", workers, queue_limit, 0, args.seconds / 2)
+        run(service, "a worker per login", args.logins, 0, args.logins, args.seconds)
+        run(service, f"{workers} workers, queue {queue_limit}", workers, queue_limit, args.logins, args.seconds)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import logging
+from datetime import datetime
+
+from _service import load_service
+
+# rebuild the report_rollups collection (the counters behind GET /reports/stats)
+# from the reports collection and the report archive, to backfill reports created
+# before rollups existed or repair counts after a partial failure
+# reports stored before coalescing get a count of 1, which GET /reports/count adds up
+# archived days are counted from their archive, so their stats survive the rebuild
+# reports created while the rebuild runs may be counted twice or not at all, so
+# run it when reports are quiet, or run it again afterwards
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the report rollup counters")
+    parser.add_argument("--location", help="report archive, local directory or gs://bucket/prefix (defaults to REPORT_ARCHIVE_LOCATION)")
+    parser.add_argument("--dry-run", action="store_true", help="count rollups without writing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    service = load_service("report")
+    from archive import list_partitions, read_partition
+
+    db = service.get_db()
+    location = args.location or service.ARCHIVE_LOCATION
+    archived = list_partitions(location) if location else []
+
+    counts = {}
+    report_count = 0
+    skipped = 0
+
+    def count(report):
+        nonlocal report_count, skipped
+        report_count += 1
+        # reports from before the date and time posted were stored can't be bucketed
+        if not report.get("date") or not report.get("time"):
+            skipped += 1
+            return
+        posted = datetime.strptime(f"{report['date']}T{report['time']}", "%Y-%m-%dT%H:%M")
+        for bucket, (pattern, _) in service.ROLLUP_BUCKETS.items():
+            key = (bucket, posted.strftime(pattern), report["route"], report["type"])
+            # coalesced reports count every report they stand for
+            counts[key] = counts.get(key, 0) + report.get("count", 1)
+
+    # the archive job writes a day before deleting it from firestore, so reports of
+    # archived days still in firestore are in the archive too and counted only once
+    live_ids = {day: set() for day in archived}
+    uncounted = []
+    for doc in service.get_reports_collection().stream():
+        report = doc.to_dict()
+        if "count" not in report:
+            uncounted.append(doc.reference)
+        if report.get("date") in live_ids:
+            live_ids[report["date"]].add(doc.id)
+        count(report)
+    archived_count = 0
+    for day in archived:
+        for report in read_partition(location, day):
+            if report["id"] not in live_ids[day]:
+                archived_count += 1
+                count(report)
+    logging.info(f"{report_count} reports ({archived_count} from {len(archived)} archived days) make up {len(counts)} rollups, {skipped} reports without a date and time skipped, {len(uncounted)} without a count")
+    if args.dry_run:
+        return
+
+    rollups = service.get_rollups_collection()
+    batch = db.batch()
+    writes = 0
+
+    def write():
+        nonlocal batch, writes
+        writes += 1
+        if writes % service.BATCH_SIZE == 0:
+            batch.commit()
+            batch = db.batch()
+
+    # reports stored before coalescing stand for one report each
+    for reference in uncounted:
+        batch.update(reference, {"count": 1})
+        write()
+
+    # drop every shard, then write each rollup's exact count to its first shard
+    stale = 0
+    for doc in rollups.stream():
+        batch.delete(doc.reference)
+        stale += 1
+        write()
+    for (bucket, start, route, report_type), count in counts.items():
+        rollup = {
+            "bucket": bucket,
+            "start": start,
+            "route": route,
+            "type": report_type,
+            "shard": 0,
+            "count": count
+        }
+        batch.set(rollups.document(service.rollup_id(bucket, start, route, report_type, 0)), rollup)
+        write()
+    if writes % service.BATCH_SIZE != 0:
+        batch.commit()
+    logging.info(f"{len(counts)} rollups written, {stale} old shards removed, {len(uncounted)} reports given a count")
+
+if __name__ == "__main__":
+    main()
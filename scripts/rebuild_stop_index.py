@@ -0,0 +1,53 @@
+import argparse
+import logging
+
+from _service import load_service
+
+# rebuild the stops collection (the stop to routes index) from the routes
+# collection, for routes created before the index existed or after a partial failure
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the stop to routes index")
+    parser.add_argument("--dry-run", action="store_true", help="count index entries without writing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    service = load_service("route")
+    db = service.get_db()
+
+    stop_routes = {}
+    route_count = 0
+    for doc in service.get_routes_collection().stream():
+        route_count += 1
+        for stop in doc.to_dict().get("stops", []):
+            stop_routes.setdefault(stop, set()).add(doc.id)
+    logging.info(f"{route_count} routes serve {len(stop_routes)} stops")
+    if args.dry_run:
+        return
+
+    stops = service.get_stops_collection()
+    # drop entries for stops no route serves any more
+    stale = [doc.reference for doc in stops.stream() if doc.id not in stop_routes]
+
+    batch = db.batch()
+    writes = 0
+    for reference in stale:
+        batch.delete(reference)
+        writes += 1
+        if writes % service.BATCH_SIZE == 0:
+            batch.commit()
+            batch = db.batch()
+    for stop, route_ids in stop_routes.items():
+        # overwrite rather than merge, so the entry matches the routes exactly
+        batch.set(stops.document(stop), {"name": stop, "routes": sorted(route_ids)})
+        writes += 1
+        if writes % service.BATCH_SIZE == 0:
+            batch.commit()
+            batch = db.batch()
+    if writes % service.BATCH_SIZE != 0:
+        batch.commit()
+    logging.info(f"{len(stop_routes)} index entries written, {len(stale)} stale entries removed")
+
+if __name__ == "__main__":
+    main()
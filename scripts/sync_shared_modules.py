@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+
+from _service import SERVICES_DIR
+
+# copies the modules in services/shared into every service that uses them, since
+# each service is deployed from its own folder and can only import what is in it
+# edit services/shared/<module>.py, never a service's copy, then run this before
+# deploying (add --check to only verify, which the shared tests also do)
+
+SHARED_DIR = os.path.abspath(os.path.join(SERVICES_DIR, "shared"))
+
+# the services each shared module is copied into
+SHARED_MODULES = {
+    "bulk.py": ["map", "report", "route", "user"],
+    "conditional.py": ["map", "report", "route", "user"],
+    "export.py": ["report", "route", "user"],
+    "fields.py": ["map", "report", "route", "user"],
+    "normalize.py": ["report", "route"],
+    "pages.py": ["map", "report", "route", "user"],
+    "tokens.py": ["map", "report", "route", "user"]
+}
+
+# the copies of the shared modules that differ from them, or are missing
+def stale_copies():
+    stale = []
+    for module, services in SHARED_MODULES.items():
+        with open(os.path.join(SHARED_DIR, module), "rb") as f:
+            shared = f.read()
+        for service in services:
+            path = os.path.abspath(os.path.join(SERVICES_DIR, service, module))
+            if not os.path.exists(path):
+                stale.append((path, shared))
+                continue
+            with open(path, "rb") as f:
+                if f.read() != shared:
+                    stale.append((path, shared))
+    return stale
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the shared modules into the services")
+    parser.add_argument("--check", action="store_true", help="fail if a copy differs instead of writing it")
+    args = parser.parse_args()
+
+    stale = stale_copies()
+    if args.check:
+        for path, _ in stale:
+            print(f"{path} differs from services/shared, run scripts/sync_shared_modules.py")
+        if stale:
+            sys.exit(1)
+        print("Every copy of the shared modules is up to date")
+        return
+
+    for path, shared in stale:
+        with open(path, "wb") as f:
+            f.write(shared)
+        print(f"Updated {path}")
+    print(f"{len(stale)} copies updated")
+
+if __name__ == "__main__":
+    main()
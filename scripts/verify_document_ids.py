@@ -0,0 +1,73 @@
+import argparse
+import logging
+
+from _service import load_service
+
+# every service stores a document's "id" field as its Firestore document ID
+# and looks documents up by key, so check that the two agree everywhere
+SERVICES = {
+    "user": "users",
+    "route": "routes",
+    "report": "reports",
+    "map": "maps",
+}
+
+# returns (checked, mismatched, fixed) counts for a collection
+def verify_collection(db, collection, fix=False):
+    checked = 0
+    mismatched = 0
+    fixed = 0
+
+    for doc in db.collection(collection).stream():
+        checked += 1
+        data = doc.to_dict()
+        stored_id = data.get("id")
+        if stored_id == doc.id:
+            continue
+
+        mismatched += 1
+        logging.warning(f"{collection}/{doc.id}: stored id is {stored_id!r}")
+        if not fix:
+            continue
+
+        if not stored_id:
+            # no id field, the document ID is the only identifier clients have seen
+            doc.reference.update({"id": doc.id})
+            fixed += 1
+            continue
+
+        # clients have been addressing this document by its id field, so move it
+        # under that key, unless another document already owns the key
+        target = db.collection(collection).document(stored_id)
+        if target.get().exists:
+            logging.error(f"{collection}/{doc.id}: cannot move to {stored_id}, document already exists")
+            continue
+        batch = db.batch()
+        batch.set(target, data)
+        batch.delete(doc.reference)
+        batch.commit()
+        fixed += 1
+
+    return checked, mismatched, fixed
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify that stored id fields match Firestore document IDs")
+    parser.add_argument("--fix", action="store_true", help="move or patch mismatched documents")
+    parser.add_argument("--service", choices=SERVICES.keys(), action="append", help="limit to a service (repeatable)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    mismatched_total = 0
+    for name in args.service or SERVICES.keys():
+        service = load_service(name)
+        collection = SERVICES[name]
+        checked, mismatched, fixed = verify_collection(service.get_db(), collection, args.fix)
+        mismatched_total += mismatched - fixed
+        logging.info(f"{collection}: {checked} checked, {mismatched} mismatched, {fixed} fixed")
+
+    # non-zero exit so the check can gate a deploy
+    raise SystemExit(1 if mismatched_total else 0)
+
+if __name__ == "__main__":
+    main()
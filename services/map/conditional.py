@@ -0,0 +1,73 @@
+# conditional GETs shared by the map, report, route and user services
+# each service deploys on its own, so services/shared/conditional.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+# GET responses carry a strong ETag built from the version of every document in them,
+# and a single document also carries its Last-Modified time. A client that sends either
+# back in If-None-Match or If-Modified-Since gets a 304 with no body while it is current,
+# so unchanged resources are never serialized or sent again
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+# utility function to get a string that changes whenever a document does
+# firestore documents have an update_time, anything else (archived reports) is hashed
+def document_version(doc):
+    update_time = getattr(doc, "update_time", None)
+    if isinstance(update_time, datetime):
+        return f"{doc.id}@{update_time.isoformat()}"
+    content = json.dumps(doc.to_dict(), sort_keys=True, default=str)
+    return f"{doc.id}#{hashlib.sha256(content.encode()).hexdigest()}"
+
+# utility function to get the strong entity tag of a list of documents, which
+# changes when any of them changes or one is added, removed or reordered
+# variant holds whatever else shapes the body, like the fields a GET selects, since
+# the same documents projected onto other fields are another representation
+def entity_tag(docs, variant=()):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(list(variant)).encode())
+    digest.update(b"\n")
+    for doc in docs:
+        digest.update(document_version(doc).encode())
+        digest.update(b"\n")
+    return f'"{digest.hexdigest()[:32]}"'
+
+# utility function to get the Last-Modified header value of a document, or None
+# if it has no update time
+def last_modified(doc):
+    update_time = getattr(doc, "update_time", None)
+    if not isinstance(update_time, datetime):
+        return None
+    return format_datetime(update_time.astimezone(timezone.utc), usegmt=True)
+
+# utility function to get the validator headers of a response
+# only single documents get a Last-Modified, since removing a document from a list
+# leaves the newest update time in it unchanged
+def validator_headers(docs, single=False, variant=()):
+    headers = {"ETag": entity_tag(docs, variant)}
+    if single and docs:
+        modified = last_modified(docs[0])
+        if modified:
+            headers["Last-Modified"] = modified
+    return headers
+
+# utility function to check whether the client already has the current representation
+# If-None-Match wins over If-Modified-Since when a request has both
+def not_modified(request_headers, headers):
+    if not request_headers:
+        return False
+
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or headers["ETag"] in tags
+
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since and headers.get("Last-Modified"):
+        try:
+            # HTTP dates have whole seconds, like Last-Modified
+            return parsedate_to_datetime(headers["Last-Modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
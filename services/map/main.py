@@ -1,11 +1,17 @@
-from google.cloud import firestore
 import json
 import logging
 import re
+import threading
+from bulk import bulk_delete, parse_sample_size
+from conditional import not_modified, validator_headers
+from pages import count_documents, http_stream_response, paginate
+from fields import get_document, parse_fields, select_fields
+from tokens import authenticate
 
 STATUS = {
     200: "OK",
     201: "Created",
+    304: "Not Modified",
     400: "Bad Request",
     401: "Unauthorized",
     404: "Not Found",
@@ -14,12 +20,32 @@ STATUS = {
     500: "Internal Server Error"
 }
 
+# fields GET /maps and /maps/{id} can be narrowed to with fields=
+MAP_FIELDS = ["id", "url"]
+
+# firestore client and collection handle, created lazily on first use and
+# reused across warm invocations of the function instance
+# google.cloud.firestore is only imported here, so requests that never reach the
+# database (404s, 405s, validation errors) don't pay for it on a cold start
+_db = None
+_db_lock = threading.Lock()
+_maps_collection = None
+
 def get_db():
-    return firestore.Client()
+    global _db
+    if _db is None:
+        with _db_lock:
+            # check again in case another request created the client first
+            if _db is None:
+                from google.cloud import firestore
+                _db = firestore.Client()
+    return _db
 
 def get_maps_collection():
-    db = get_db()
-    return db.collection("maps")
+    global _maps_collection
+    if _maps_collection is None:
+        _maps_collection = get_db().collection("maps")
+    return _maps_collection
 
 def request_handler(request):
     try:
@@ -33,6 +59,12 @@ def request_handler(request):
         query_params = request.args
         logging.debug(f"Query parameters: {query_params}")
 
+        # verify the access token, if the request carries one, without a database read
+        user = authenticate(request)
+        if user is None:
+            logging.error("Invalid or expired access token")
+            return http_response(401)
+
         # dynamically parse path parameters
         map_id = ""
         if len(path) == 2 and path[0] == "maps":
@@ -46,7 +78,7 @@ def request_handler(request):
                 match request.method:
                     # get a list of all maps
                     case "GET":
-                        return get_maps(query_params)
+                        return get_maps(query_params, request.headers)
                     # delete all maps
                     case "DELETE":
                         return delete_maps(query_params)
@@ -58,12 +90,24 @@ def request_handler(request):
                         logging.error(f"Invalid request method: {request.method}")
                         return http_response(405)
                     
+            # /maps/count, endpoint for counting maps
+            # matched before /maps/{id} so "count" isn't taken as a map ID
+            case ["maps", "count"]:
+                match request.method:
+                    # count all maps
+                    case "GET":
+                        return count_maps(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+
             # /maps/{id}, endpoint for managing a specific map
             case ["maps", map_id]:
                 match request.method:
                     # get a map
                     case "GET":
-                        return get_map(map_id)
+                        return get_map(map_id, query_params, request.headers)
                     # handle invalid request method
                     case _:
                         logging.error(f"Invalid request method: {request.method}")
@@ -77,7 +121,7 @@ def request_handler(request):
         return http_response(500)
 
 # utility function to form a consistent HTTP response
-def http_response(status: int, data=None):
+def http_response(status: int, data=None, headers=None):
     try:
         if data is None:
             data = ""
@@ -86,11 +130,11 @@ def http_response(status: int, data=None):
             "message": STATUS.get(status, "Unknown status"),
             "data": data
         }
-        # google cloud expects a tuple
+        # google cloud expects a tuple, and a 304 has no body
         response = (
-            json.dumps(response_data),
+            "" if status == 304 else json.dumps(response_data),
             status, 
-            {"Content-Type": "application/json"}
+            {"Content-Type": "application/json", **(headers or {})}
         )
         logging.debug(f"Raw response data: {response}")
         return response
@@ -103,21 +147,47 @@ def http_response(status: int, data=None):
         )
 
 # GET /maps
-def get_maps(query_params=None):
+def get_maps(query_params=None, request_headers=None):
     maps = get_maps_collection()
     query = maps
-    docs = []
 
-    # query params not implemented yet
     if query_params:
-        return NotImplementedError()
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"limit", "start_after", "fields"}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+    fields = parse_fields(query_params, MAP_FIELDS)
+    if fields is None:
+        return http_response(400)
+    query = select_fields(query, fields)
+
+    page = paginate(query, query_params)
+    if page is None:
+        return http_response(400)
+    query, limit = page
     
     try:
-        docs = list(query.stream())
-        query_result = [doc.to_dict() for doc in docs]
+        return http_stream_response(200, "maps", query.stream(), limit, request_headers, [fields, (query_params or {}).get("start_after", "")])
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /maps/count
+def count_maps(query_params=None):
+    try:
+        query = get_maps_collection()
+
+        if query_params:
+            # account for unsupported query parameters
+            unsupported = set(query_params)
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
 
         data = {
-            "maps": query_result
+            "mapCount": count_documents([query])
         }
 
         return http_response(200, data)
@@ -132,29 +202,21 @@ def delete_maps(query_params=None):
         maps = get_maps_collection()
         query = maps
 
-        # query params not implemented yet
         if query_params:
-            return NotImplementedError()
-        
-        docs = list(query.stream())
-
-        batch = db.batch()
-        deleted_ids = []
-
-        for i, doc in enumerate(docs):
-            batch.delete(doc.reference)
-            deleted_ids.append(doc.id)
-
-            # commit every 500 deletes for batch deleting
-            if (i + 1) % 500 == 0:
-                batch.commit()
-                batch = db.batch()
-        # commit remaining deletes
-        if len(docs) % 500 != 0:
-            batch.commit()
+            # account for unsupported query parameters
+            unsupported = set(query_params) - {"sample"}
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
+
+        sample_size = parse_sample_size(query_params)
+        if sample_size is None:
+            return http_response(400)
+
+        deleted_count, deleted_ids = bulk_delete(db, [query], sample_size)
         
         data = {
-            "deletedMapCount": len(deleted_ids),
+            "deletedMapCount": deleted_count,
             "deletedMapIds": deleted_ids
         }
 
@@ -191,30 +253,32 @@ def create_map(data):
         return http_response(500)
 
 # GET /maps/{id}
-def get_map(map_id):
+def get_map(map_id, query_params=None, request_headers=None):
     maps = get_maps_collection()
-    query = maps
-    docs = []
     
     try:
         if not isinstance(map_id, str) or map_id == "":
             logging.error(f"Invalid map ID: {map_id}, must be string")
             return http_response(404)
         else:
-            docs = list(query.where("id", "==", map_id).stream())
-            if not docs:
+            fields = parse_fields(query_params, MAP_FIELDS)
+            if fields is None:
+                return http_response(400)
+            # map IDs are stored as the document ID, so look it up directly
+            doc = get_document(maps.document(map_id), fields)
+            if not doc.exists:
                 logging.error(f"Map with ID {map_id} not found")
                 return http_response(404)
-            # check if more than one report with the same ID exists
-            if len(docs) > 1:
-                logging.error(f"Multiple maps with ID {map_id} found")
-                return http_response(500)
         
+            headers = validator_headers([doc], single=True, variant=fields)
+            if not_modified(request_headers, headers):
+                return http_response(304, headers=headers)
+
             data = {
-                "map": docs[0].to_dict()
+                "map": doc.to_dict()
             }
 
-            return http_response(200, data)
+            return http_response(200, data, headers)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
\ No newline at end of file
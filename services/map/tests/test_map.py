@@ -1,7 +1,15 @@
 import pytest
-from unittest.mock import MagicMock, patch
-from main import get_maps, delete_maps, create_map, get_map
+from unittest.mock import ANY, MagicMock, patch
+from main import get_maps, count_maps, delete_maps, create_map, get_map
 import json
+from datetime import datetime, timezone
+import base64
+import threading
+import os
+import subprocess
+import sys
+import main
+import tokens
 
 # get_maps tests
 @patch("main.get_maps_collection")
@@ -18,24 +26,181 @@ def test_get_maps_success(mock_maps_collection):
         json.dumps({
             "message": "OK",
             "data": {
-                "maps": [data]
+                "maps": [data],
+                "nextPageToken": ""
             }
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_map_doc]
+    mock_query.order_by.return_value.limit.return_value.stream.return_value = [mock_map_doc]
     mock_maps_collection.return_value = mock_query
     
     response = get_maps()
+    # list responses are streamed
+    body = "".join(response[0])
+
+    assert (body, *response[1:]) == expected
+
+@patch("main.get_maps_collection")
+def test_get_maps_not_modified_success(mock_maps_collection):
+    mock_map_doc = MagicMock(id="1", update_time=datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc))
+    mock_map_doc.to_dict.return_value = {"id": "1"}
+
+    # mock query behavior
+    mock_page = mock_maps_collection.return_value.order_by.return_value.limit.return_value
+    mock_page.stream.return_value = [mock_map_doc]
+
+    etag = get_maps()[2]["ETag"]
+    response = get_maps(None, {"If-None-Match": etag})
+
+    # the page hasn't changed, so it is sent as a 304 with no body
+    assert response == ("", 304, {"Content-Type": "application/json", "ETag": etag})
+
+    # a new map on the page changes its tag
+    mock_page.stream.return_value = [mock_map_doc, MagicMock(id="2", update_time=datetime(2024, 5, 2, tzinfo=timezone.utc))]
+    response = get_maps(None, {"If-None-Match": etag})
+
+    assert response[1] == 200
+    assert response[2]["ETag"] != etag
+
+@patch("main.get_maps_collection")
+def test_get_maps_next_page_success(mock_maps_collection):
+    mock_docs = []
+    for doc_id in ["a", "b", "c"]:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_doc.to_dict.return_value = {"id": doc_id}
+        mock_docs.append(mock_doc)
+
+    mock_query = MagicMock()
+    mock_page = mock_query.order_by.return_value.start_after.return_value.limit.return_value
+    mock_page.stream.return_value = mock_docs
+    mock_maps_collection.return_value = mock_query
+
+    start_after = base64.urlsafe_b64encode(b"0").decode()
+    response = get_maps({"limit": "2", "start_after": start_after})
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    assert body["data"]["maps"] == [{"id": "a"}, {"id": "b"}]
+    assert base64.urlsafe_b64decode(body["data"]["nextPageToken"]).decode() == "b"
+    mock_query.order_by.return_value.start_after.assert_called_once_with({"__name__": "0"})
+    # one extra document is fetched to detect the next page
+    mock_query.order_by.return_value.start_after.return_value.limit.assert_called_once_with(3)
+
+@patch("main.get_maps_collection")
+def test_get_maps_fields_success(mock_maps_collection):
+    mock_map_doc = MagicMock()
+    mock_map_doc.to_dict.return_value = {"url": "https://example.com"}
+    mock_query = mock_maps_collection.return_value
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_map_doc]
+
+    response = get_maps({"fields": "url"})
+
+    assert json.loads("".join(response[0]))["data"]["maps"] == [{"url": "https://example.com"}]
+    # only the requested fields are read
+    mock_query.select.assert_called_once_with(["url"])
+
+@pytest.mark.parametrize("invalid_data", [
+    {"limit": "abc"},
+    {"limit": "0"},
+    {"limit": "5.5"},
+    {"limit": "100000"},
+    {"start_after": None},
+    {"start_after": "not_base64"},
+    {"start_after": "MA==!!"},
+    {"start_after": ""},
+    {"start_after": base64.urlsafe_b64encode(b"maps/1").decode()},
+    {"sort": "name"},
+    {"fields": ""},
+    {"fields": "id,owner"}
+])
+@patch("main.get_maps_collection")
+def test_get_maps_invalid_query_params_fail(mock_maps_collection, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = get_maps(invalid_data)
 
     assert response == expected
 
+# count_maps tests
+@patch("main.get_maps_collection")
+def test_count_maps_success(mock_maps_collection):
+    mock_count = mock_maps_collection.return_value.count.return_value
+    mock_count.get.return_value = [[MagicMock(value=3)]]
+
+    response = count_maps()
+
+    assert json.loads(response[0]) == {"message": "OK", "data": {"mapCount": 3}}
+    # one aggregation query, no documents read
+    mock_maps_collection.return_value.count.assert_called_once_with(alias="count")
+    mock_maps_collection.return_value.stream.assert_not_called()
+
+@patch("main.get_maps_collection")
+def test_count_maps_invalid_query_params_fail(mock_maps_collection):
+    response = count_maps({"limit": "10"})
+
+    assert response[1] == 400
+
+@patch("main.count_maps")
+def test_request_handler_count_success(mock_count):
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/maps/count"
+    request.args = {}
+    request.headers = {}
+
+    main.request_handler(request)
+
+    # "count" isn't taken as a map ID
+    mock_count.assert_called_once_with({})
+
+@patch("main.count_maps")
+def test_request_handler_invalid_token_fail(mock_count, monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+    header, payload, signature = tokens.issue_token("1", "user").split(".")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/maps/count"
+    request.args = {}
+    request.headers = {"Authorization": f"Bearer {header}.{payload}.{signature[::-1]}"}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 401
+    mock_count.assert_not_called()
+
+@pytest.mark.parametrize("authorization", ["Bearer not.a.token", "Basic dXNlcjpwYXNz"])
+@patch("main.count_maps")
+def test_request_handler_foreign_token_success(mock_count, monkeypatch, authorization):
+    # tokens someone else issued, like IAM ID tokens, leave the request anonymous
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/maps/count"
+    request.args = {}
+    request.headers = {"Authorization": authorization}
+
+    main.request_handler(request)
+
+    mock_count.assert_called_once_with({})
+
 # delete_maps tests
 @patch("main.get_db")
 @patch("main.get_maps_collection")
@@ -51,7 +216,8 @@ def test_delete_maps_success(mock_maps_collection, mock_get_db):
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_map_doc]
+    # one page, shorter than a full batch
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_map_doc]
     mock_maps_collection.return_value = mock_query
 
     # mock db and batch
@@ -143,11 +309,8 @@ def test_get_map_success(mock_maps_collection):
     mock_map_doc = MagicMock()
     mock_map_doc.to_dict.return_value = data
 
-    mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_map_doc]
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value = mock_map_doc
 
     mock_maps_collection.return_value = mock_collection
 
@@ -160,7 +323,8 @@ def test_get_map_success(mock_maps_collection):
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
     
@@ -169,6 +333,42 @@ def test_get_map_success(mock_maps_collection):
     assert response == expected
 
 @patch("main.get_maps_collection")
+def test_get_map_fields_success(mock_maps_collection):
+    mock_reference = mock_maps_collection.return_value.document.return_value
+    mock_reference.get.return_value.to_dict.return_value = {"url": "https://example.com"}
+
+    response = get_map("1", {"fields": "url"})
+
+    assert json.loads(response[0])["data"] == {"map": {"url": "https://example.com"}}
+    mock_reference.get.assert_called_once_with(field_paths=["url"])
+
+@patch("main.get_maps_collection")
+def test_get_map_not_modified_success(mock_maps_collection):
+    mock_map_doc = mock_maps_collection.return_value.document.return_value.get.return_value
+    mock_map_doc.id = "1"
+    mock_map_doc.to_dict.return_value = {"id": "1"}
+    mock_map_doc.update_time = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+    headers = get_map("1")[2]
+    assert headers["Last-Modified"] == "Wed, 01 May 2024 12:30:00 GMT"
+
+    # the client's copy is current, so it gets a 304 with no body
+    for request_headers in ({"If-None-Match": headers["ETag"]}, {"If-Modified-Since": headers["Last-Modified"]}):
+        assert get_map("1", None, request_headers) == ("", 304, headers)
+
+    # the map changed since, so it is sent again
+    mock_map_doc.update_time = datetime(2024, 5, 1, 12, 31, tzinfo=timezone.utc)
+    response = get_map("1", None, {"If-None-Match": headers["ETag"]})
+
+    assert response[1] == 200
+    assert json.loads(response[0])["data"] == {"map": {"id": "1"}}
+
+@patch("main.get_maps_collection")
+def test_get_map_invalid_fields_fail(mock_maps_collection):
+    response = get_map("1", {"fields": "owner"})
+
+    assert response[1] == 400
+@patch("main.get_maps_collection")
 @pytest.mark.parametrize("invalid_data", ["", 0, None])
 def test_get_map_invalid_id_fail(mock_maps_collection, invalid_data):
     mock_collection = MagicMock()
@@ -187,4 +387,30 @@ def test_get_map_invalid_id_fail(mock_maps_collection, invalid_data):
 
     response = get_map(invalid_data)
 
-    assert response == expected
\ No newline at end of file
+    assert response == expected
+
+# get_db tests
+@patch("google.cloud.firestore.Client")
+def test_get_db_reuses_client(mock_client, monkeypatch):
+    monkeypatch.setattr(main, "_db", None)
+    monkeypatch.setattr(main, "_maps_collection", None)
+
+    # simulate concurrent cold requests
+    threads = [threading.Thread(target=main.get_maps_collection) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert main.get_db() is main.get_db()
+    assert main.get_maps_collection() is main.get_maps_collection()
+    mock_client.assert_called_once()
+
+# cold start tests
+def test_import_defers_heavy_dependencies():
+    # import main in a fresh interpreter, like a cold start would
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main; print([m for m in ('google.cloud.firestore',) if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], cwd=service_dir, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
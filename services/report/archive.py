@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import tempfile
+
+# reports older than the retention window are archived out of firestore into gzip
+# compressed NDJSON files, one per day (date=YYYY-MM-DD/reports.ndjson.gz), sorted
+# by report ID, in a local directory or under a gs://bucket/prefix location
+# google.cloud.storage is only imported for gs:// locations
+
+# an archived report, shaped like a firestore snapshot for http_stream_response
+# its ID includes the date, so page tokens can point inside the archive
+# fields narrows it down like a firestore projection would
+class ArchivedReport:
+    def __init__(self, date, report, fields=()):
+        self.id = f"{date}/{report['id']}"
+        self._report = {field: report[field] for field in fields if field in report} if fields else report
+
+    def to_dict(self):
+        return self._report
+
+def partition_path(date):
+    return f"date={date}/reports.ndjson.gz"
+
+# cloud storage client, created on first use and reused like the firestore client
+_storage_client = None
+
+def _bucket(location):
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+        _storage_client = storage.Client()
+    bucket, _, prefix = location[len("gs://"):].partition("/")
+    return _storage_client.bucket(bucket), f"{prefix.rstrip('/')}/" if prefix else ""
+
+def _blob(location, date):
+    bucket, prefix = _bucket(location)
+    return bucket.blob(prefix + partition_path(date))
+
+def _local_path(location, date):
+    return os.path.join(location, partition_path(date))
+
+def partition_exists(location, date):
+    if location.startswith("gs://"):
+        return _blob(location, date).exists()
+    return os.path.exists(_local_path(location, date))
+
+# list the archived days, in order
+def list_partitions(location):
+    if location.startswith("gs://"):
+        bucket, prefix = _bucket(location)
+        paths = [blob.name[len(prefix):] for blob in bucket.list_blobs(prefix=f"{prefix}date=")]
+    elif os.path.isdir(location):
+        paths = [f"{entry}/reports.ndjson.gz" for entry in os.listdir(location) if os.path.isfile(os.path.join(location, entry, "reports.ndjson.gz"))]
+    else:
+        paths = []
+    dates = [path[len("date="):].split("/", 1)[0] for path in paths]
+    return sorted(date for date, path in zip(dates, paths) if path == partition_path(date))
+
+# read the archived reports for a day, one at a time
+def read_partition(location, date):
+    raw = _blob(location, date).open("rb") if location.startswith("gs://") else open(_local_path(location, date), "rb")
+    with raw, gzip.open(raw, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+# write the archived reports for a day, replacing any earlier archive of it
+# reports must already be sorted by ID, and values json can't encode go through default
+# the file is written in full before it replaces the archive, so a failed write
+# never leaves a partial partition behind
+def write_partition(location, date, reports, default=None):
+    if location.startswith("gs://"):
+        tmp = tempfile.TemporaryFile()
+    else:
+        os.makedirs(os.path.dirname(_local_path(location, date)), exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(_local_path(location, date)), delete=False)
+
+    count = 0
+    try:
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            for report in reports:
+                f.write(json.dumps(report, default=default) + "\n")
+                count += 1
+        if location.startswith("gs://"):
+            _blob(location, date).upload_from_file(tmp, rewind=True)
+        else:
+            tmp.close()
+            os.replace(tmp.name, _local_path(location, date))
+    except BaseException:
+        tmp.close()
+        if not location.startswith("gs://"):
+            os.unlink(tmp.name)
+        raise
+    tmp.close()
+    return count
@@ -0,0 +1,145 @@
+# bulk deletion shared by the map, report, route and user services
+# each service deploys on its own, so services/shared/bulk.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+import logging
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# maximum number of writes in a single firestore batch
+BATCH_SIZE = 500
+
+# number of batches committed at once
+# pages are only read while fewer than twice this many batches are waiting, so a
+# bulk delete holds a bounded number of documents however many it deletes
+DELETE_WORKERS = 8
+
+# retries of a batch that failed with a transient error, waiting DELETE_BACKOFF
+# seconds before the first one and doubling up to MAX_DELETE_BACKOFF, with jitter
+DELETE_RETRIES = 5
+DELETE_BACKOFF = 0.5
+MAX_DELETE_BACKOFF = 30
+
+# default and maximum number of deleted IDs returned by a bulk delete
+DEFAULT_DELETED_ID_SAMPLE = 100
+MAX_DELETED_ID_SAMPLE = 1000
+
+# utility function to validate the number of deleted IDs to return
+# returns the sample size, or None if it is invalid
+def parse_sample_size(query_params=None):
+    query_params = query_params or {}
+    if "sample" not in query_params:
+        return DEFAULT_DELETED_ID_SAMPLE
+
+    # account for invalid sample size
+    sample = str(query_params["sample"])
+    if not sample.isdigit() or int(sample) > MAX_DELETED_ID_SAMPLE:
+        logging.error(f"Invalid sample: {query_params['sample']}. Must be an integer between 0 and {MAX_DELETED_ID_SAMPLE}")
+        return None
+    return int(sample)
+
+# commit a batch, retrying transient errors with exponential backoff
+def commit_with_backoff(batch):
+    from google.api_core.exceptions import Aborted, DeadlineExceeded, InternalServerError, NotFound, ResourceExhausted, ServiceUnavailable
+
+    for attempt in range(DELETE_RETRIES + 1):
+        try:
+            batch.commit()
+            return
+        except NotFound:
+            # a retry failing its exists preconditions means the attempt that
+            # timed out was committed after all
+            if attempt:
+                return
+            raise
+        except (Aborted, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable) as e:
+            if attempt == DELETE_RETRIES:
+                raise
+            delay = min(MAX_DELETE_BACKOFF, DELETE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+            logging.warning(f"Retrying batch in {delay:.2f}s after error: {e}")
+            time.sleep(delay)
+
+# delete a page of documents in one batch, committed with backoff
+# another request can delete some of them first, failing the batch's exists
+# preconditions, so the page is read again and retried without them
+# returns the IDs of the documents the batch deleted
+def delete_page(db, docs, option=None, write=None):
+    from google.api_core.exceptions import NotFound
+
+    for attempt in range(DELETE_RETRIES + 1):
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference, option=option)
+            if write is not None:
+                write(batch, doc)
+        try:
+            commit_with_backoff(batch)
+            return [doc.id for doc in docs]
+        except NotFound:
+            if attempt == DELETE_RETRIES:
+                raise
+            # only check which documents still exist, without reading their fields
+            existing = {snapshot.id for snapshot in db.get_all([doc.reference for doc in docs], field_paths=[]) if snapshot.exists}
+            logging.warning(f"Retrying batch without {len(docs) - len(existing)} documents another request deleted")
+            docs = [doc for doc in docs if doc.id in existing]
+            if not docs:
+                return []
+
+# delete every document the queries match, one page at a time in document ID order
+# each page is committed as one batch, with write(batch, doc) adding up to
+# writes_per_doc - 1 more writes per document, which can read the given fields
+# (otherwise only document IDs are read)
+# documents another request deletes first are left out of the count and the sample
+# returns the number of deleted documents and up to sample_size of their IDs
+def bulk_delete(db, queries, sample_size=0, fields=(), write=None, writes_per_doc=1):
+    page_size = BATCH_SIZE // writes_per_doc
+    # extra writes, like counter changes, must not be applied twice, so their
+    # batches only commit while the documents still exist
+    option = db.write_option(exists=True) if write is not None else None
+
+    deleted = 0
+    sample = []
+    # IDs in the sample whose documents another request deleted first
+    skipped = set()
+    # batches waiting to be committed, with the IDs of the documents they delete
+    pending = {}
+
+    def collect(futures):
+        nonlocal deleted
+        for future in futures:
+            deleted_ids = future.result()
+            deleted += len(deleted_ids)
+            skipped.update(set(pending.pop(future)) - set(deleted_ids))
+
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        try:
+            for query in queries:
+                after = None
+                while True:
+                    page = query.select(list(fields)).order_by("__name__")
+                    if after is not None:
+                        page = page.start_after({"__name__": after})
+                    docs = list(page.limit(page_size).stream())
+                    if not docs:
+                        break
+
+                    sample.extend(doc.id for doc in docs[:sample_size - len(sample)])
+                    pending[executor.submit(delete_page, db, docs, option, write)] = [doc.id for doc in docs]
+
+                    # wait for a batch to commit before reading further ahead
+                    if len(pending) >= 2 * DELETE_WORKERS:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+
+                    # a short page is the last one
+                    if len(docs) < page_size:
+                        break
+                    after = docs[-1].id
+            collect(list(pending))
+        except Exception:
+            # don't start batches that are still waiting
+            for future in pending:
+                future.cancel()
+            raise
+
+    return deleted, [doc_id for doc_id in sample if doc_id not in skipped]
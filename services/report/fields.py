@@ -0,0 +1,37 @@
+# sparse fieldsets shared by the map, report, route and user services
+# each service deploys on its own, so services/shared/fields.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+# GET endpoints take fields=a,b,c to return only those fields of each document,
+# which is pushed down to firestore as a projection, so the rest is never read
+import logging
+
+# utility function to validate the fields query parameter against the fields a
+# resource can return, without it the default fields are returned (none for whole documents)
+# returns the fields to select, or None if the parameter is invalid
+def parse_fields(query_params=None, allowed=(), default=()):
+    query_params = query_params or {}
+    if "fields" not in query_params:
+        return list(default)
+
+    fields = []
+    for field in str(query_params["fields"]).split(","):
+        field = field.strip()
+        if field and field not in fields:
+            fields.append(field)
+    if not fields:
+        logging.error("Invalid fields: must name at least one field")
+        return None
+
+    unsupported = [field for field in fields if field not in allowed]
+    if unsupported:
+        logging.error(f"Unsupported fields: {', '.join(unsupported)}. Must be any of {', '.join(allowed)}")
+        return None
+    return fields
+
+# utility function to project a query onto the given fields, or leave it whole
+def select_fields(query, fields):
+    return query.select(fields) if fields else query
+
+# utility function to read a document, projected onto the given fields
+def get_document(reference, fields):
+    return reference.get(field_paths=fields) if fields else reference.get()
@@ -1,11 +1,24 @@
-from google.cloud import firestore
 import json
 import logging
-import re
+import hashlib
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from normalize import normalize_name
+from archive import ArchivedReport, partition_exists, read_partition
+from bulk import bulk_delete, parse_sample_size
+from export import http_export_response, parse_export_params
+from conditional import not_modified, validator_headers
+from pages import decode_page_token, http_stream_response, paginate
+from fields import get_document, parse_fields, select_fields
+from tokens import authenticate
 
 STATUS = {
     200: "OK",
     201: "Created",
+    304: "Not Modified",
     400: "Bad Request",
     401: "Unauthorized",
     404: "Not Found",
@@ -14,12 +27,139 @@ STATUS = {
     500: "Internal Server Error"
 }
 
+REPORT_TYPES = [
+    "delay",
+    "no-show",
+    "early departure",
+    "route change",
+    "overcrowding",
+    "missed stop",
+    "accessibility issues"
+]
+
+# fields GET /reports and /reports/{id} can be narrowed to with fields=,
+# and the columns of a CSV export of reports
+REPORT_FIELDS = ["id", "type", "route", "stop", "date", "time", "timestamp", "count", "firstSeen", "lastSeen", "createdBy"]
+
+# fields GET and DELETE /reports can filter on, in the order they appear in the
+# composite indexes in firestore.indexes.json
+REPORT_FILTERS = ["type", "route", "date", "time"]
+
+# maximum number of days in a date range on GET /reports, which is also the
+# number of date partitions one query can match, and on DELETE /reports
+MAX_RANGE_DAYS = 30
+MAX_DELETE_RANGE_DAYS = 366
+
+# reports with the same route, stop and type in the same window of minutes are
+# coalesced into one report with a count, or set to 0 to store every report
+# windows are aligned to the hour and must divide it, so a coalesced report never
+# spans two rollup buckets
+COALESCE_WINDOW_MINUTES = int(os.environ.get("REPORT_COALESCE_WINDOW_MINUTES", "10"))
+if COALESCE_WINDOW_MINUTES < 0 or (COALESCE_WINDOW_MINUTES and 60 % COALESCE_WINDOW_MINUTES):
+    raise ValueError(f"REPORT_COALESCE_WINDOW_MINUTES must be 0 or divide 60, not {COALESCE_WINDOW_MINUTES}")
+
+# maximum number of writes in a single firestore batch
+BATCH_SIZE = 500
+# maximum number of reports in one batch request, and batches committed at once
+MAX_BATCH_REPORTS = 500
+BATCH_WORKERS = 4
+
+# report counts are rolled up per route, type and hour or day, with each rollup
+# split over ROLLUP_SHARDS counter documents so busy routes spread their
+# increments instead of contending on one document
+ROLLUP_SHARDS = 10
+# rollup bucket sizes, their start formats and lengths
+ROLLUP_BUCKETS = {
+    "hour": ("%Y-%m-%dT%H", timedelta(hours=1)),
+    "day": ("%Y-%m-%d", timedelta(days=1))
+}
+# fields GET /reports/stats can filter on, in the order they appear in the
+# composite indexes in firestore.indexes.json
+ROLLUP_FILTERS = ["route", "type"]
+# maximum number of buckets in one stats request
+MAX_STATS_BUCKETS = 1000
+# maximum number of rollup counter shards one stats request reads, each a document
+# read, up to ROLLUP_SHARDS per route, type and bucket in range
+MAX_STATS_ROLLUPS = 5000
+
+# reports older than RETENTION_DAYS are moved out of firestore to ARCHIVE_LOCATION
+# (a local directory or gs://bucket/prefix) by scripts/archive_reports.py, and
+# GET /reports reads archived dates from there, archival is off without a location
+ARCHIVE_LOCATION = os.environ.get("REPORT_ARCHIVE_LOCATION", "")
+RETENTION_DAYS = int(os.environ.get("REPORT_RETENTION_DAYS", "90"))
+
+# firestore client and collection handle, created lazily on first use and
+# reused across warm invocations of the function instance
+# google.cloud.firestore is only imported here, so requests that never reach the
+# database (404s, 405s, validation errors) don't pay for it on a cold start
+_db = None
+_db_lock = threading.Lock()
+_reports_collection = None
+_rollups_collection = None
+
 def get_db():
-    return firestore.Client()
+    global _db
+    if _db is None:
+        with _db_lock:
+            # check again in case another request created the client first
+            if _db is None:
+                from google.cloud import firestore
+                _db = firestore.Client()
+    return _db
 
 def get_reports_collection():
-    db = get_db()
-    return db.collection("reports")
+    global _reports_collection
+    if _reports_collection is None:
+        _reports_collection = get_db().collection("reports")
+    return _reports_collection
+
+def get_rollups_collection():
+    global _rollups_collection
+    if _rollups_collection is None:
+        _rollups_collection = get_db().collection("report_rollups")
+    return _rollups_collection
+
+# utility function to get the ID of a rollup counter shard
+# normalized route names can't contain underscores, so the ID is unambiguous
+def rollup_id(bucket, start, route, report_type, shard):
+    return f"{route}__{report_type}__{bucket}__{start}__{shard}"
+
+# utility function to add the rollup counter changes for a report to a batch
+# the report's date and time posted decide its buckets, and the change goes to a
+# random shard unless one is given
+def count_report(batch, report, change=1, shard=None):
+    from google.cloud.firestore import Increment
+    rollups = get_rollups_collection()
+    posted = datetime.strptime(f"{report['date']}T{report['time']}", "%Y-%m-%dT%H:%M")
+    shard = random.randrange(ROLLUP_SHARDS) if shard is None else shard
+
+    for bucket, (pattern, _) in ROLLUP_BUCKETS.items():
+        start = posted.strftime(pattern)
+        rollup = {
+            "bucket": bucket,
+            "start": start,
+            "route": report["route"],
+            "type": report["type"],
+            "shard": shard,
+            "count": Increment(change)
+        }
+        batch.set(rollups.document(rollup_id(bucket, start, report["route"], report["type"], shard)), rollup, merge=True)
+
+# utility function to get the document a new report is stored in: the report for
+# its route, stop, type and window if coalescing is on, otherwise a new document
+def report_document(report):
+    reports = get_reports_collection()
+    if not COALESCE_WINDOW_MINUTES:
+        return reports.document()
+
+    window = int(report["time"][3:]) // COALESCE_WINDOW_MINUTES
+    key = f"{report['route']}|{report.get('stop', '')}|{report['type']}|{report['date']}T{report['time'][:2]}|{window}"
+    return reports.document(hashlib.sha1(key.encode()).hexdigest()[:20])
+
+# utility function to get the changes that count more reports in a coalesced report
+def coalesce_fields(count):
+    from google.cloud.firestore import SERVER_TIMESTAMP, Increment
+    return {"count": Increment(count), "lastSeen": SERVER_TIMESTAMP}
 
 def request_handler(request):
     try:
@@ -33,6 +173,12 @@ def request_handler(request):
         query_params = request.args
         logging.debug(f"Query parameters: {query_params}")
 
+        # verify the access token, if the request carries one, without a database read
+        user = authenticate(request)
+        if user is None:
+            logging.error("Invalid or expired access token")
+            return http_response(401)
+
         # dynamically parse path parameters
         report_id = ""
         if len(path) == 2 and path[0] == "reports":
@@ -46,23 +192,65 @@ def request_handler(request):
                 match request.method:
                     # get a list of all reports
                     case "GET":
-                        return get_reports(query_params)
+                        return get_reports(query_params, request.headers)
                     # delete all reports
                     case "DELETE":
                         return delete_reports(query_params)
                     case "POST":
-                        return create_report(data)
+                        return create_report(data, user)
                     # handle invalid request method
                     case _:
                         logging.error(f"Invalid request method: {request.method}")
                         return http_response(405)
                     
+            # /reports:batch, endpoint for submitting many reports at once
+            case ["reports:batch"]:
+                match request.method:
+                    # create an array of reports
+                    case "POST":
+                        return create_reports(data, user)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /reports/stats, endpoint for report counts over time
+            # matched before /reports/{id} so "stats" isn't taken as a report ID
+            case ["reports", "stats"]:
+                match request.method:
+                    # get report counts per route, type and hour or day
+                    case "GET":
+                        return get_report_stats(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /reports/export, endpoint for downloading reports as a file
+            case ["reports", "export"]:
+                match request.method:
+                    # stream the matching reports as NDJSON or CSV
+                    case "GET":
+                        return export_reports(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /reports/count, endpoint for counting reports
+            # matched before /reports/{id} so "count" isn't taken as a report ID
+            case ["reports", "count"]:
+                match request.method:
+                    # count the reports matching the same filters as GET /reports
+                    case "GET":
+                        return count_reports(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
             # /reports/{id}, endpoint for managing a specific report
             case ["reports", report_id]:
                 match request.method:
                     # get a report
                     case "GET":
-                        return get_report(report_id)
+                        return get_report(report_id, query_params, request.headers)
                     # handle invalid request method
                     case _:
                         logging.error(f"Invalid request method: {request.method}")
@@ -75,8 +263,14 @@ def request_handler(request):
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
+# utility function to encode values json can't, like firestore timestamps
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
 # utility function to form a consistent HTTP response
-def http_response(status: int, data=None):
+def http_response(status: int, data=None, headers=None):
     try:
         if data is None:
             data = ""
@@ -85,11 +279,11 @@ def http_response(status: int, data=None):
             "message": STATUS.get(status, "Unknown status"),
             "data": data
         }
-        # google cloud expects a tuple
+        # google cloud expects a tuple, and a 304 has no body
         response = (
-            json.dumps(response_data),
+            "" if status == 304 else json.dumps(response_data, default=encode_value),
             status, 
-            {"Content-Type": "application/json"}
+            {"Content-Type": "application/json", **(headers or {})}
         )
         logging.debug(f"Raw response data: {response}")
         return response
@@ -101,22 +295,261 @@ def http_response(status: int, data=None):
             {"Content-Type": "application/json"}
         )
 
+# utility function to check that a combination of filters is served by an index
+# a time of day matches reports from every date, so it is only indexed with a date
+def is_indexed(fields):
+    return "time" not in fields or "date" in fields
+
+# utility function to get the dates from the "from" date to the "to" date, inclusive
+# "to" defaults to today, and there must be a "from" so ranges stay bounded
+# returns the dates as YYYY-MM-DD, or None if the range is invalid
+def date_range(query_params, max_days):
+    try:
+        start = datetime.strptime(query_params["from"], "%Y-%m-%d")
+        end = datetime.strptime(query_params["to"], "%Y-%m-%d") if "to" in query_params else datetime.now(timezone.utc).replace(tzinfo=None)
+    except (KeyError, TypeError, ValueError):
+        logging.error(f"Invalid date range: {query_params.get('from')} to {query_params.get('to')}. Needs a 'from' date, and dates must be formatted as %Y-%m-%d")
+        return None
+
+    days = (end - start).days + 1
+    if not 0 < days <= max_days:
+        logging.error(f"Invalid date range: {days} days. Must cover 1 to {max_days} days")
+        return None
+    return [(start + timedelta(days=day)).strftime("%Y-%m-%d") for day in range(days)]
+
+# utility function to validate and normalize report filters
+# a date, or a range of dates, is returned as the list of dates it covers
+# returns the other filters as {field: value} and the dates (or None without a
+# date), or None if the filters are invalid
+def parse_report_filters(query_params=None, max_days=MAX_RANGE_DAYS):
+    query_params = query_params or {}
+    fields = [field for field in REPORT_FILTERS if field in query_params]
+
+    # filter - range of dates posted, matched as a date
+    days = None
+    if "from" in query_params or "to" in query_params:
+        if "date" in query_params:
+            logging.error("Unsupported filter combination: date with from or to. Use one or the other")
+            return None
+        days = date_range(query_params, max_days)
+        if days is None:
+            return None
+        fields = [field for field in REPORT_FILTERS if field in query_params or field == "date"]
+
+    # account for filter combinations that would need a full collection scan
+    if not is_indexed(fields):
+        logging.error(f"Unsupported filter combination: {', '.join(fields)}. Filtering by time requires a date")
+        return None
+
+    filters = {}
+    for field in fields:
+        if field == "date" and days is not None:
+            continue
+        value = query_params[field]
+        # filter - report type
+        if field == "type" and value not in REPORT_TYPES:
+            logging.error(f"Invalid report type: {value}")
+            return None
+        # filter - route, stored by normalized name
+        if field == "route":
+            value = normalize_name(value) if isinstance(value, str) else None
+            if value is None:
+                logging.error(f"Invalid route name: {query_params['route']}. Cannot contain special characters or underscores.")
+                return None
+        # filter - date and time posted, stored as YYYY-MM-DD and HH:MM
+        if field in ("date", "time"):
+            pattern = "%Y-%m-%d" if field == "date" else "%H:%M"
+            try:
+                value = datetime.strptime(value, pattern).strftime(pattern)
+            except (TypeError, ValueError):
+                logging.error(f"Invalid {field}: {value}. Must be formatted as {pattern}")
+                return None
+        filters[field] = value
+
+    if "date" in filters:
+        days = [filters.pop("date")]
+    return filters, days
+
+# utility function to push parsed report filters down into queries
+# reports are partitioned by their date field, so dates only read their own
+# partitions, with one query per MAX_RANGE_DAYS partitions since firestore
+# matches at most that many values in one "in" filter
+def report_queries(query, filters, days=None):
+    chunks = [None] if days is None else [days[i:i + MAX_RANGE_DAYS] for i in range(0, len(days), MAX_RANGE_DAYS)]
+
+    queries = []
+    for chunk in chunks:
+        chunk_query = query
+        for field in REPORT_FILTERS:
+            if field == "date" and chunk is not None:
+                chunk_query = chunk_query.where("date", "==", chunk[0]) if len(chunk) == 1 else chunk_query.where("date", "in", chunk)
+            elif field in filters:
+                chunk_query = chunk_query.where(field, "==", filters[field])
+        queries.append(chunk_query)
+    return queries
+
+# utility function to count the reports queries match with server-side sum
+# aggregations of their count, since a coalesced report stands for count reports
+def sum_report_counts(queries):
+    total = 0
+    for query in queries:
+        results = query.sum("count", alias="count").get()
+        total += results[0][0].value or 0
+    return total
+
+# utility function to push report filters down into queries
+# returns the filtered queries, or None if the filters are invalid
+def filter_reports(query, query_params=None, max_days=MAX_RANGE_DAYS):
+    parsed = parse_report_filters(query_params, max_days)
+    if parsed is None:
+        return None
+    return report_queries(query, *parsed)
+
+# utility function to get the dates, out of the given ones, that have been archived
+# only dates older than the retention window are checked for an archive
+def archived_days(days):
+    if not ARCHIVE_LOCATION or not days:
+        return []
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)).strftime("%Y-%m-%d")
+    return [day for day in days if day < cutoff and partition_exists(ARCHIVE_LOCATION, day)]
+
 # GET /reports
-def get_reports(query_params=None):
+def get_reports(query_params=None, request_headers=None):
     reports = get_reports_collection()
     query = reports
-    docs = []
 
-    # query params not implemented yet
     if query_params:
-        return NotImplementedError()
-    
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"limit", "start_after", "from", "to", "fields", *REPORT_FILTERS}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+    # a page comes from a single query, so ranges are limited to one query's partitions
+    parsed = parse_report_filters(query_params)
+    if parsed is None:
+        return http_response(400)
+    filters, days = parsed
+
+    fields = parse_fields(query_params, REPORT_FIELDS)
+    if fields is None:
+        return http_response(400)
+
     try:
-        docs = list(query.stream())
-        query_result = [doc.to_dict() for doc in docs]
+        # dates moved out of firestore are read from their archive instead
+        archived = archived_days(days)
+        if archived:
+            return get_archived_reports(query_params, filters, days, archived, fields, request_headers)
+
+        query = select_fields(report_queries(query, filters, days)[0], fields)
+        page = paginate(query, query_params)
+        if page is None:
+            return http_response(400)
+        query, limit = page
+
+        return http_stream_response(200, "reports", query.stream(), limit, request_headers, [fields, (query_params or {}).get("start_after", "")], default=encode_value)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# utility function to list reports over dates some of which have been archived
+# reports from archived dates come first, by date then ID, then the rest from
+# firestore by document ID
+# page tokens inside the archive encode "date/id", since document IDs can't contain "/"
+def get_archived_reports(query_params, filters, days, archived, fields=(), request_headers=None):
+    query_params = query_params or {}
+    # the dates still in firestore
+    live_days = [day for day in days if day not in set(archived)]
+
+    after_day, after_id = None, None
+    live_params = {param: value for param, value in query_params.items() if param != "start_after"}
+    if "start_after" in query_params:
+        cursor = decode_page_token(query_params["start_after"])
+        if cursor is None:
+            return http_response(400)
+        if "/" in cursor:
+            after_day, after_id = cursor.split("/", 1)
+        else:
+            # the previous page ended in firestore, so the archive has been read
+            archived = []
+            live_params = query_params
+
+    query = get_reports_collection()
+    page = paginate(select_fields(report_queries(query, filters, live_days)[0] if live_days else query, fields), live_params)
+    if page is None:
+        return http_response(400)
+    live_query, limit = page
+
+    def docs():
+        for day in archived:
+            if after_day is not None and day < after_day:
+                continue
+            for report in read_partition(ARCHIVE_LOCATION, day):
+                if day == after_day and report["id"] <= after_id:
+                    continue
+                if all(report.get(field) == value for field, value in filters.items()):
+                    yield ArchivedReport(day, report, fields)
+        if live_days:
+            yield from live_query.stream()
+
+    return http_stream_response(200, "reports", docs(), limit, request_headers, [fields, query_params.get("start_after", "")], default=encode_value)
+
+# GET /reports/export
+# reads reports from firestore only, archived dates are already files
+def export_reports(query_params=None):
+    if query_params:
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"format", "gzip", "after", "from", "to", *REPORT_FILTERS}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+    export = parse_export_params(query_params)
+    if export is None:
+        return http_response(400)
+    export_format, compress, after = export
+
+    # the export is read in document ID order from one query, so ranges are limited
+    # to one query's partitions
+    queries = filter_reports(get_reports_collection(), query_params)
+    if queries is None:
+        return http_response(400)
+
+    try:
+        return http_export_response("reports", queries[0], export_format, compress, after, fields=REPORT_FIELDS)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /reports/count
+def count_reports(query_params=None):
+    try:
+        query = get_reports_collection()
+
+        if query_params:
+            # account for unsupported query parameters
+            unsupported = set(query_params) - {"from", "to", *REPORT_FILTERS}
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
+
+        parsed = parse_report_filters(query_params)
+        if parsed is None:
+            return http_response(400)
+        filters, days = parsed
+
+        # dates moved out of firestore are counted from their archive instead
+        archived = archived_days(days)
+        # a coalesced report stands for count reports, so counts are added up
+        report_count = 0
+        for day in archived:
+            report_count += sum(report.get("count", 1) for report in read_partition(ARCHIVE_LOCATION, day) if all(report.get(field) == value for field, value in filters.items()))
+        live_days = None if days is None else [day for day in days if day not in archived]
+        if live_days is None or live_days:
+            report_count += sum_report_counts(report_queries(query, filters, live_days))
 
         data = {
-            "reports": query_result
+            "reportCount": report_count
         }
 
         return http_response(200, data)
@@ -131,29 +564,36 @@ def delete_reports(query_params=None):
         reports = get_reports_collection()
         query = reports
 
-        # query params not implemented yet
         if query_params:
-            return NotImplementedError()
-        
-        docs = list(query.stream())
+            # account for unsupported query parameters
+            unsupported = set(query_params) - {"from", "to", "sample", *REPORT_FILTERS}
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
 
-        batch = db.batch()
-        deleted_ids = []
+        queries = filter_reports(query, query_params, max_days=MAX_DELETE_RANGE_DAYS)
+        if queries is None:
+            return http_response(400)
+        sample_size = parse_sample_size(query_params)
+        if sample_size is None:
+            return http_response(400)
 
-        for i, doc in enumerate(docs):
-            batch.delete(doc.reference)
-            deleted_ids.append(doc.id)
+        # take each report out of its rollups in the same batch that deletes it
+        def uncount_report(batch, doc):
+            report = doc.to_dict()
+            # reports from before date and time were stored were never counted
+            if report.get("date") and report.get("time"):
+                count_report(batch, report, change=-report.get("count", 1))
 
-            # commit every 500 deletes for batch deleting
-            if (i + 1) % 500 == 0:
-                batch.commit()
-                batch = db.batch()
-        # commit remaining deletes
-        if len(docs) % 500 != 0:
-            batch.commit()
+        deleted_count, deleted_ids = bulk_delete(
+            db, queries, sample_size,
+            fields=["route", "type", "date", "time", "count"],
+            write=uncount_report,
+            writes_per_doc=1 + len(ROLLUP_BUCKETS)
+        )
         
         data = {
-            "deletedReportCount": len(deleted_ids),
+            "deletedReportCount": deleted_count,
             "deletedReportIds": deleted_ids
         }
 
@@ -162,113 +602,287 @@ def delete_reports(query_params=None):
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
+# utility function to validate and normalize a new report
+# returns the report to store and None, or None and the reason the report is invalid
+def validate_report(data, user=None):
+    if not isinstance(data, dict):
+        return None, f"Report is of type {type(data)}, must be an object"
+
+    # account for missing fields
+    if not data.get("type"):
+        return None, "Missing 'type' in request body"
+    if not data.get("route"):
+        return None, "Missing 'route' in request body"
+    # the signed-in user is the author, so only anonymous reports name one
+    if not user and not data.get("createdBy"):
+        return None, "Missing 'createdBy' in request body"
+
+    # invalid report type
+    if data["type"] not in REPORT_TYPES:
+        return None, f"Invalid report type: {data['type']}"
+
+    # normalize route name
+    route = normalize_name(data["route"]) if isinstance(data["route"], str) else None
+    # invalid route
+    if route is None:
+        return None, f"Invalid route name: {data['route']}. Cannot contain special characters or underscores."
+
+    report = dict(data)
+    report["route"] = route
+
+    # normalize stop name
+    if data.get("stop"):
+        if not isinstance(data["stop"], str):
+            return None, f"Invalid stop type: {type(data['stop'])}, must be string"
+        stop = normalize_name(data["stop"])
+        # invalid stop
+        if stop is None:
+            return None, f"Invalid stop name: {data['stop']}. Cannot contain special characters or underscores."
+        report["stop"] = stop
+
+    from google.cloud.firestore import SERVER_TIMESTAMP
+
+    # the server sets the timestamp when it commits the report
+    report["timestamp"] = SERVER_TIMESTAMP
+    # number of reports coalesced into this one, and when the first and last were seen
+    report["count"] = 1
+    report["firstSeen"] = SERVER_TIMESTAMP
+    report["lastSeen"] = SERVER_TIMESTAMP
+    # date and time posted, stored separately so reports can be filtered on them
+    # and partitioned by date
+    posted = datetime.now(timezone.utc)
+    report["date"] = posted.strftime("%Y-%m-%d")
+    report["time"] = posted.strftime("%H:%M")
+    # reports are created by the signed-in user, if the request has an access token
+    report["createdBy"] = user.get("sub") if user else "test_user_id"
+    return report, None
+
 # POST /reports
-def create_report(data):
+def create_report(data, user=None):
     try:
-        reports = get_reports_collection()
-        query = reports
-        report_types = [
-            "delay",
-            "no-show",
-            "early departure",
-            "route change",
-            "overcrowding",
-            "missed stop",
-            "accessibility issues"
-        ]
-
-        # account for missing fields
-        if not data.get("type"):
-            logging.error(f"Missing 'type' in request body")
+        report, error = validate_report(data, user)
+        if error:
+            logging.error(error)
             return http_response(400)
-        if not data.get("route"):
-            logging.error(f"Missing 'route' in request body")
-            return http_response(400)
-        if not data.get("timestamp"):
-            # TODO: automatically generate timestamp
-            logging.error(f"Missing 'timestamp' in request body")
+
+        # create new report, or find the report it coalesces into
+        doc = report_document(report)
+        report["id"] = doc.id
+
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            # create the report and count it in its rollups in one batch
+            # create() fails if the report's window already has a report
+            batch = get_db().batch()
+            batch.create(doc, report)
+            count_report(batch, report)
+            batch.commit()
+        except AlreadyExists:
+            # count the report in the existing report instead
+            batch = get_db().batch()
+            batch.update(doc, coalesce_fields(1))
+            count_report(batch, report)
+            batch.commit()
+            return http_response(200, {"id": doc.id, "coalesced": True})
+
+        return http_response(201, {"id": doc.id, "coalesced": False})
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# POST /reports:batch
+def create_reports(data, user=None):
+    try:
+        db = get_db()
+
+        # accept {"reports": [...]} or a bare array of reports
+        items = data.get("reports") if isinstance(data, dict) else data
+        if not isinstance(items, list) or len(items) == 0:
+            logging.error(f"Field 'reports' is of type {type(items)}, must be a non-empty array of reports")
             return http_response(400)
-        if not data.get("createdBy"):
-            # TODO: automatically generate createdBy
-            logging.error(f"Missing 'createdBy' in request body")
+        if len(items) > MAX_BATCH_REPORTS:
+            logging.error(f"Too many reports: {len(items)}. Submit at most {MAX_BATCH_REPORTS} reports per request")
             return http_response(400)
 
-        # invalid report type
-        if data["type"] not in report_types:
-            logging.error(f"Invalid report type: {data['type']}")
-            return http_response(400)
-        
-        # normalize report type
-        report_type = data["type"].strip()
-        report_type = re.sub(r"\s+", " ", report_type)
-        report_type = report_type.title()
-
-        # normalize route name
-        route = data["route"].strip()
-        route = re.sub(r"\s+", " ", route)
-        route = route.title()
-
-        # normalize stop name
-        if data.get("stop"):
-            if not isinstance(data["stop"], str) or data["stop"] == "":
-                logging.error(f"Invalid stop type: {type(data['stop'])}, must be string")
-                return http_response(400)
-            stop = data["stop"].strip()
-            stop = re.sub(r"\s+", " ", stop)
-            stop = stop.title()
-            # invalid stop
-            if re.match(r"^[A-Za-z0-9\s-]+$", stop) is None:
-                logging.error(f"Invalid stop name: {stop}. Cannot contain special characters or underscores.")
-                return http_response(400)
+        # validate every report with the same rules as POST /reports, keeping the valid
+        # ones, grouped by the report they're stored in so duplicates are written once
+        results = [None] * len(items)
+        groups = {}
+        for index, item in enumerate(items):
+            report, error = validate_report(item, user)
+            if error:
+                results[index] = {"index": index, "error": error}
+                continue
+            doc = report_document(report)
+            report["id"] = doc.id
+            groups.setdefault(doc.id, (doc, report, []))[2].append(index)
+        writes = list(groups.values())
 
-        # invalid route
-        if re.match(r"^[A-Za-z0-9\s-]+$", route) is None:
-            logging.error(f"Invalid route name: {route}. Cannot contain special characters or underscores.")
-            return http_response(400)
-        
-        # create new report
-        doc = reports.document()
-        report_id = doc.id
-        # id is automatically generated
-        data["id"] = report_id
-        data["route"] = route
-        if data.get("stop"):
-            data["stop"] = stop
-        data["timestamp"] = "test_timestamp"
-        # TODO: generate createdBy with authentication
-        data["createdBy"] = "test_user_id"
-        doc.set(data)
-
-        return http_response(201)
+        # each report is written with its rollup counters, so a batch holds as many
+        # reports as fit in BATCH_SIZE writes, with batches committed in parallel
+        chunk_size = BATCH_SIZE // (1 + len(ROLLUP_BUCKETS))
+        chunks = [writes[i:i + chunk_size] for i in range(0, len(writes), chunk_size)]
+
+        from google.api_core.exceptions import AlreadyExists, NotFound
+
+        def commit(chunk):
+            # retry once if another request creates or deletes one of the reports first
+            for attempt in range(2):
+                existing = set()
+                if COALESCE_WINDOW_MINUTES:
+                    existing = {snapshot.id for snapshot in db.get_all([doc for doc, _, _ in chunk]) if snapshot.exists}
+                batch = db.batch()
+                for doc, report, indexes in chunk:
+                    if doc.id in existing:
+                        batch.update(doc, coalesce_fields(len(indexes)))
+                    else:
+                        batch.create(doc, {**report, "count": len(indexes)})
+                    count_report(batch, report, change=len(indexes))
+                try:
+                    batch.commit()
+                    return existing
+                except (AlreadyExists, NotFound):
+                    if attempt:
+                        raise
+
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(chunks))) as executor:
+                futures = {executor.submit(commit, chunk): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    try:
+                        existing = future.result()
+                        # reports after the first in a group, or all of them if the report
+                        # already existed, were coalesced into it
+                        for _, report, indexes in chunk:
+                            for position, index in enumerate(indexes):
+                                results[index] = {"index": index, "id": report["id"], "coalesced": report["id"] in existing or position > 0}
+                    except Exception as e:
+                        logging.error(f"Failed to commit batch of {len(chunk)} reports: {e}")
+                        for _, _, indexes in chunk:
+                            for index in indexes:
+                                results[index] = {"index": index, "error": f"Write failed: {e}"}
+
+        data = {
+            "createdReportCount": sum("id" in result for result in results),
+            "results": results
+        }
+
+        return http_response(200, data)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
 # GET /reports/{id}
-def get_report(report_id):
+def get_report(report_id, query_params=None, request_headers=None):
     reports = get_reports_collection()
-    query = reports
-    docs = []
     
     try:
         if not isinstance(report_id, str) or report_id == "":
             logging.error(f"Invalid report ID: {report_id}, must be string")
             return http_response(404)
         else:
-            docs = list(query.where("id", "==", report_id).stream())
-            if not docs:
+            fields = parse_fields(query_params, REPORT_FIELDS)
+            if fields is None:
+                return http_response(400)
+            # report IDs are stored as the document ID, so look it up directly
+            doc = get_document(reports.document(report_id), fields)
+            if not doc.exists:
                 logging.error(f"Report with ID {report_id} not found")
                 return http_response(404)
-            # check if more than one report with the same ID exists
-            if len(docs) > 1:
-                logging.error(f"Multiple reports with ID {report_id} found")
-                return http_response(500)
         
+            headers = validator_headers([doc], single=True, variant=fields)
+            if not_modified(request_headers, headers):
+                return http_response(304, headers=headers)
+
             data = {
-                "report": docs[0].to_dict()
+                "report": doc.to_dict()
             }
 
-            return http_response(200, data)
+            return http_response(200, data, headers)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /reports/stats?from={date or datetime}&to={date or datetime}
+def get_report_stats(query_params=None):
+    try:
+        query_params = query_params or {}
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"from", "to", "bucket", *ROLLUP_FILTERS}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+        bucket = query_params.get("bucket", "hour")
+        if bucket not in ROLLUP_BUCKETS:
+            logging.error(f"Invalid bucket: {bucket}. Must be one of {', '.join(ROLLUP_BUCKETS)}")
+            return http_response(400)
+        pattern, length = ROLLUP_BUCKETS[bucket]
+
+        # both ends of the range are inclusive, truncated to the bucket
+        bounds = []
+        for param in ("from", "to"):
+            try:
+                moment = datetime.fromisoformat(query_params[param])
+            except (KeyError, TypeError, ValueError):
+                logging.error(f"Invalid '{param}': {query_params.get(param)}. Must be an ISO 8601 date or date and time")
+                return http_response(400)
+            # times without an offset are UTC, like the rollups
+            if moment.tzinfo is not None:
+                moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+            bounds.append(datetime.strptime(moment.strftime(pattern), pattern))
+        start, end = bounds
+        if start > end:
+            logging.error(f"Invalid range: 'from' is after 'to'")
+            return http_response(400)
+        # account for ranges that would read too many rollups
+        if (end - start) // length + 1 > MAX_STATS_BUCKETS:
+            logging.error(f"Range too long: at most {MAX_STATS_BUCKETS} {bucket} buckets per request")
+            return http_response(400)
+
+        query = get_rollups_collection().where("bucket", "==", bucket)
+        for field in ROLLUP_FILTERS:
+            if field not in query_params:
+                continue
+            value = query_params[field]
+            # filter - route, stored by normalized name
+            if field == "route":
+                value = normalize_name(value) if isinstance(value, str) else None
+                if value is None:
+                    logging.error(f"Invalid route name: {query_params['route']}. Cannot contain special characters or underscores.")
+                    return http_response(400)
+            # filter - report type
+            if field == "type" and value not in REPORT_TYPES:
+                logging.error(f"Invalid report type: {value}")
+                return http_response(400)
+            query = query.where(field, "==", value)
+        query = query.where("start", ">=", start.strftime(pattern)).where("start", "<=", end.strftime(pattern))
+
+        # add up the shards of each rollup, reading one more than allowed to find
+        # out whether the range and filters match too many
+        counts = {}
+        for read, doc in enumerate(query.limit(MAX_STATS_ROLLUPS + 1).stream(), 1):
+            if read > MAX_STATS_ROLLUPS:
+                logging.error(f"Too many rollups: at most {MAX_STATS_ROLLUPS} per request, narrow the range or filter by route and type")
+                return http_response(400)
+            rollup = doc.to_dict()
+            key = (rollup["start"], rollup["route"], rollup["type"])
+            counts[key] = counts.get(key, 0) + rollup.get("count", 0)
+
+        stats = [
+            {"start": start_key, "route": route, "type": report_type, "count": count}
+            for (start_key, route, report_type), count in sorted(counts.items()) if count
+        ]
+        data = {
+            "bucket": bucket,
+            "from": start.strftime(pattern),
+            "to": end.strftime(pattern),
+            "total": sum(stat["count"] for stat in stats),
+            "stats": stats
+        }
+
+        return http_response(200, data)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
-        return http_response(500)
\ No newline at end of file
+        return http_response(500)
@@ -0,0 +1,43 @@
+# name normalization shared by the route and report services
+# each service deploys on its own, so services/shared/normalize.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+from functools import lru_cache
+import logging
+import re
+
+# patterns used to normalize and validate names, compiled once per instance
+WHITESPACE_PATTERN = re.compile(r"\s+")
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9\s-]+$")
+
+# number of distinct names kept normalized in memory per instance
+# popular stop and route names repeat across requests, so they are only normalized once
+NAME_CACHE_SIZE = 4096
+
+# normalize a route or stop name: trim it, collapse whitespace and title-case it
+# returns None if the normalized name contains special characters or underscores
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def normalize_name(name: str):
+    name = WHITESPACE_PATTERN.sub(" ", name.strip()).title()
+    if NAME_PATTERN.match(name) is None:
+        return None
+    return name
+
+# normalize and validate a whole list of stop names in one pass
+# returns the normalized list, or None if the list or any stop in it is invalid
+def normalize_stops(stops):
+    if not isinstance(stops, list) or len(stops) == 0:
+        logging.error(f"Field 'stops' is of type {type(stops)}, must be a non-empty array of strings")
+        return None
+
+    normalized_stops = []
+    for stop in stops:
+        if not isinstance(stop, str):
+            logging.error(f"Stop must be a string")
+            return None
+        normalized_stop = normalize_name(stop)
+        if normalized_stop is None:
+            logging.error(f"Invalid stop name: {stop}. Cannot contain special characters or underscores.")
+            return None
+        normalized_stops.append(normalized_stop)
+
+    return normalized_stops
@@ -0,0 +1,126 @@
+# paginated list responses shared by the map, report, route and user services
+# each service deploys on its own, so services/shared/pages.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+# list endpoints page through documents in document ID order, and the nextPageToken of a
+# page is the base64-encoded ID of its last document, which the next page starts after
+import base64
+import itertools
+import json
+import logging
+from http import HTTPStatus
+from conditional import not_modified, validator_headers
+
+# default and maximum number of items on a page of a list endpoint
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# field path that orders queries by document ID
+DOCUMENT_ID = "__name__"
+
+# utility function to decode a nextPageToken into the ID of the last document on
+# the previous page, or None if the token is invalid
+def decode_page_token(token):
+    try:
+        # decode base64 nextPageToken, rejecting anything that isn't base64
+        last_doc_id = base64.b64decode(token.encode(), altchars=b"-_", validate=True).decode()
+        logging.debug(f"Decoded next page token: {last_doc_id}")
+    except (AttributeError, ValueError):
+        logging.error(f"Invalid start_after: {token}")
+        return None
+    if not last_doc_id:
+        logging.error(f"Invalid start_after: {token}, names no document")
+        return None
+    return last_doc_id
+
+# utility function to apply keyset pagination to a list query, ordered by document ID
+# returns the paginated query and the page size, or None if the parameters are invalid
+def paginate(query, query_params=None):
+    query_params = query_params or {}
+    limit = DEFAULT_PAGE_SIZE
+
+    # filter - pagination limit
+    if "limit" in query_params:
+        # account for invalid limit
+        if not str(query_params["limit"]).isdigit() or not 0 < int(query_params["limit"]) <= MAX_PAGE_SIZE:
+            logging.error(f"Invalid limit: {query_params['limit']}. Must be an integer between 1 and {MAX_PAGE_SIZE}")
+            return None
+        limit = int(query_params["limit"])
+
+    # order by document ID so pages are stable and cursors need no extra read
+    query = query.order_by(DOCUMENT_ID)
+
+    # filter - pagination start_after
+    if "start_after" in query_params:
+        last_doc_id = decode_page_token(query_params["start_after"])
+        if last_doc_id is None:
+            return None
+        # a document ID can't contain "/", which would point the cursor at another path
+        if "/" in last_doc_id:
+            logging.error(f"Invalid start_after: {query_params['start_after']}, not a document ID")
+            return None
+        query = query.start_after({DOCUMENT_ID: last_doc_id})
+
+    # fetch one extra document to find out whether there is another page
+    return query.limit(limit + 1), limit
+
+# utility function to count the documents queries match with server-side count
+# aggregations, one round trip per query instead of a read per document
+def count_documents(queries):
+    total = 0
+    for query in queries:
+        results = query.count(alias="count").get()
+        total += results[0][0].value
+    return total
+
+# utility function to form a consistent HTTP response around a list of documents
+# the body is encoded one document at a time as the query streams, so the full
+# list is never held in memory, and the page is cut off after limit documents
+# a page is tagged with an ETag, so a request whose If-None-Match still matches
+# gets a 304 instead of the documents, and variant is whatever else shapes the page
+# default encodes the values json can't, like json.dumps's default
+def http_stream_response(status: int, key: str, docs, limit=None, request_headers=None, variant=(), default=None):
+    headers = {}
+    if limit is not None:
+        # a page is at most limit + 1 documents, read before the body to tag them
+        # the extra document decides the nextPageToken, so it is part of the tag
+        docs = list(itertools.islice(docs, limit + 1))
+        headers = validator_headers(docs, variant=[limit, *variant])
+        if not_modified(request_headers, headers):
+            # a 304 has no body
+            return ("", 304, {"Content-Type": "application/json", **headers})
+    docs = iter(docs)
+    # fetch the first document up front so query errors still become a 500
+    first_doc = next(docs, None)
+
+    def generate():
+        yield f'{{"message": {json.dumps(HTTPStatus(status).phrase)}, "data": {{{json.dumps(key)}: ['
+        count = 0
+        next_page_token = ""
+        try:
+            doc = first_doc
+            last_doc = None
+            while doc is not None:
+                # an extra document means there is another page
+                if limit is not None and count == limit:
+                    # add base64-encoded pagination token
+                    next_page_token = base64.urlsafe_b64encode(last_doc.id.encode()).decode()
+                    break
+                if count:
+                    yield ", "
+                yield json.dumps(doc.to_dict(), default=default)
+                last_doc = doc
+                count += 1
+                doc = next(docs, None)
+        except Exception as e:
+            # the status has already been sent, so all we can do is end the body early
+            logging.error(f"Internal server error while streaming {key}: {e}")
+            return
+        yield f'], "nextPageToken": {json.dumps(next_page_token)}}}}}'
+
+    logging.debug(f"Streaming response: {status} with {key}")
+    # google cloud streams a generator body
+    return (
+        generate(),
+        status,
+        {"Content-Type": "application/json", **headers}
+    )
@@ -0,0 +1,131 @@
+import gzip
+import json
+import os
+import sys
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch
+from archive import list_partitions, partition_exists, partition_path, read_partition, write_partition
+
+REPORTS = [
+    {"id": "a", "type": "delay", "route": "Main Line", "date": "2024-01-05", "timestamp": datetime(2024, 1, 5, 8, 15, tzinfo=timezone.utc)},
+    {"id": "b", "type": "no-show", "route": "Main Line", "date": "2024-01-05", "timestamp": datetime(2024, 1, 5, 9, 30, tzinfo=timezone.utc)}
+]
+
+def encode(value):
+    return value.isoformat()
+
+# write_partition and read_partition tests
+def test_write_partition_success(tmp_path):
+    count = write_partition(str(tmp_path), "2024-01-05", iter(REPORTS), default=encode)
+
+    assert count == 2
+    assert partition_exists(str(tmp_path), "2024-01-05")
+    assert not partition_exists(str(tmp_path), "2024-01-06")
+    # one gzip NDJSON file per day
+    with gzip.open(tmp_path / partition_path("2024-01-05"), "rt") as f:
+        assert [json.loads(line)["id"] for line in f] == ["a", "b"]
+    assert list(read_partition(str(tmp_path), "2024-01-05"))[0]["timestamp"] == "2024-01-05T08:15:00+00:00"
+
+def test_write_partition_replaces_success(tmp_path):
+    write_partition(str(tmp_path), "2024-01-05", REPORTS, default=encode)
+    write_partition(str(tmp_path), "2024-01-05", REPORTS[:1], default=encode)
+
+    assert [report["id"] for report in read_partition(str(tmp_path), "2024-01-05")] == ["a"]
+
+def test_write_partition_failure_keeps_archive(tmp_path):
+    write_partition(str(tmp_path), "2024-01-05", REPORTS, default=encode)
+
+    def failing_reports():
+        yield REPORTS[0]
+        raise RuntimeError("lost connection")
+
+    with pytest.raises(RuntimeError):
+        write_partition(str(tmp_path), "2024-01-05", failing_reports(), default=encode)
+
+    # the earlier archive is untouched, and no temporary file is left behind
+    assert [report["id"] for report in read_partition(str(tmp_path), "2024-01-05")] == ["a", "b"]
+    assert os.listdir(tmp_path / "date=2024-01-05") == ["reports.ndjson.gz"]
+
+# list_partitions tests
+def test_list_partitions_success(tmp_path):
+    write_partition(str(tmp_path), "2024-01-06", REPORTS, default=encode)
+    write_partition(str(tmp_path), "2024-01-05", REPORTS, default=encode)
+    # directories without a partition file aren't archived days
+    os.makedirs(tmp_path / "date=2024-01-07")
+
+    assert list_partitions(str(tmp_path)) == ["2024-01-05", "2024-01-06"]
+    assert list_partitions(str(tmp_path / "missing")) == []
+
+# archive_reports, rebuild_report_rollups and report counting tests, run against the
+# in-memory firestore stand-in the benchmarks use
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "..", "scripts")
+
+@pytest.fixture
+def report_service():
+    sys.path.insert(0, SCRIPTS_DIR)
+    from _service import load_service
+    from _standin import FakeClient
+
+    with patch("google.cloud.firestore.Client", FakeClient):
+        FakeClient.connect_latency = 0
+        FakeClient.reset()
+        service = load_service("report")
+        service._reports_collection = None
+        service._rollups_collection = None
+        yield service
+    sys.path.remove(SCRIPTS_DIR)
+
+def run_script(name, *args):
+    script = __import__(name)
+    with patch.object(sys, "argv", [name, *args]):
+        script.main()
+
+def day_stats(service):
+    from _standin import FakeRequest
+    response = service.request_handler(FakeRequest("GET", "/reports/stats", args={"from": "2024-01-01", "to": "2024-01-10", "bucket": "day"}))
+    return json.loads(response[0])["data"]["stats"]
+
+def test_rebuild_rollups_keeps_archived_days_success(report_service, tmp_path):
+    reports = report_service.get_reports_collection()
+    for i, (date, time, count) in enumerate([("2024-01-05", "08:15", 1), ("2024-01-05", "09:30", 2), ("2024-01-06", "10:00", 1)]):
+        reports.document(f"r{i}").set({"id": f"r{i}", "type": "delay", "route": "main line", "date": date, "time": time, "count": count})
+    run_script("rebuild_report_rollups", "--location", str(tmp_path))
+    before = day_stats(report_service)
+    assert [stat["count"] for stat in before] == [3, 1]
+
+    # archive both days, then put one report back as if the archive job had failed
+    # before deleting it, so it is in firestore and the archive at once
+    run_script("archive_reports", "--location", str(tmp_path), "--retention-days", "1")
+    assert list(reports.stream()) == []
+    reports.document("r0").set({"id": "r0", "type": "delay", "route": "main line", "date": "2024-01-05", "time": "08:15", "count": 1})
+    run_script("rebuild_report_rollups", "--location", str(tmp_path))
+
+    assert day_stats(report_service) == before
+
+# a clock that stays inside one coalescing window
+class PostedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2024, 1, 5, 8, 15, tzinfo=timezone.utc)
+
+def test_count_reports_coalesced_success(report_service, tmp_path):
+    from _standin import FakeRequest
+    with patch.object(report_service, "datetime", PostedDatetime):
+        for _ in range(4):
+            report_service.request_handler(FakeRequest("POST", "/reports", json={"type": "delay", "route": "main line", "stop": "stop 1", "createdBy": "1"}))
+    [report] = [doc.to_dict() for doc in report_service.get_reports_collection().stream()]
+    assert report["count"] == 4
+
+    count = report_service.request_handler(FakeRequest("GET", "/reports/count"))
+    stats = report_service.request_handler(FakeRequest("GET", "/reports/stats", args={"from": "2024-01-05", "to": "2024-01-05", "bucket": "day"}))
+
+    # the four reports coalesced into one document are counted like the rollups count them
+    assert json.loads(count[0])["data"]["reportCount"] == 4
+    assert json.loads(stats[0])["data"]["total"] == 4
+
+    # a report stored before coalescing has no count until the rollups are rebuilt
+    report_service.get_reports_collection().document("old").set({"id": "old", "type": "delay", "route": "Main Line", "date": "2024-01-05", "time": "07:00"})
+    run_script("rebuild_report_rollups", "--location", str(tmp_path))
+    count = report_service.request_handler(FakeRequest("GET", "/reports/count"))
+    assert json.loads(count[0])["data"]["reportCount"] == 5
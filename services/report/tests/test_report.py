@@ -1,7 +1,20 @@
 import pytest
-from unittest.mock import MagicMock, patch
-from main import get_reports, delete_reports, create_report, get_report
+from unittest.mock import ANY, MagicMock, patch
+from main import get_reports, count_reports, delete_reports, create_report, get_report
 import json
+import base64
+import itertools
+import re
+from datetime import datetime, timezone
+from google.cloud.firestore import SERVER_TIMESTAMP
+from google.api_core.exceptions import AlreadyExists
+import threading
+import os
+import subprocess
+import sys
+import main
+import tokens
+from archive import write_partition
 
 # get_reports tests
 @patch("main.get_reports_collection")
@@ -22,24 +35,389 @@ def test_get_reports_success(mock_reports_collection):
         json.dumps({
             "message": "OK",
             "data": {
-                "reports": [report]
+                "reports": [report],
+                "nextPageToken": ""
             }
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_report_doc]
+    mock_query.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
     mock_reports_collection.return_value = mock_query
     
     response = get_reports()
+    # list responses are streamed
+    body = "".join(response[0])
+
+    assert (body, *response[1:]) == expected
+
+@patch("main.get_reports_collection")
+def test_get_reports_not_modified_success(mock_reports_collection):
+    mock_report_doc = MagicMock(id="1", update_time=datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc))
+    mock_report_doc.to_dict.return_value = {"id": "1"}
+
+    # mock query behavior
+    mock_page = mock_reports_collection.return_value.order_by.return_value.limit.return_value
+    mock_page.stream.return_value = [mock_report_doc]
+
+    etag = get_reports()[2]["ETag"]
+    response = get_reports(None, {"If-None-Match": etag})
+
+    # the page hasn't changed, so it is sent as a 304 with no body
+    assert response == ("", 304, {"Content-Type": "application/json", "ETag": etag})
+
+    # a new report on the page changes its tag
+    mock_page.stream.return_value = [mock_report_doc, MagicMock(id="2", update_time=datetime(2024, 5, 2, tzinfo=timezone.utc))]
+    response = get_reports(None, {"If-None-Match": etag})
+
+    assert response[1] == 200
+    assert response[2]["ETag"] != etag
+
+@patch("main.get_reports_collection")
+def test_get_reports_next_page_success(mock_reports_collection):
+    mock_docs = []
+    for doc_id in ["a", "b", "c"]:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_doc.to_dict.return_value = {"id": doc_id}
+        mock_docs.append(mock_doc)
+
+    mock_query = MagicMock()
+    mock_page = mock_query.order_by.return_value.start_after.return_value.limit.return_value
+    mock_page.stream.return_value = mock_docs
+    mock_reports_collection.return_value = mock_query
+
+    start_after = base64.urlsafe_b64encode(b"0").decode()
+    response = get_reports({"limit": "2", "start_after": start_after})
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    assert body["data"]["reports"] == [{"id": "a"}, {"id": "b"}]
+    assert base64.urlsafe_b64decode(body["data"]["nextPageToken"]).decode() == "b"
+    mock_query.order_by.return_value.start_after.assert_called_once_with({"__name__": "0"})
+    # one extra document is fetched to detect the next page
+    mock_query.order_by.return_value.start_after.return_value.limit.assert_called_once_with(3)
+
+@pytest.mark.parametrize("invalid_data", [
+    {"limit": "abc"},
+    {"limit": "0"},
+    {"limit": "5.5"},
+    {"limit": "100000"},
+    {"start_after": None},
+    {"start_after": "not_base64"},
+    {"start_after": "MA==!!"},
+    {"start_after": ""},
+    {"start_after": base64.urlsafe_b64encode(b"reports/1").decode()},
+    {"sort": "name"},
+    {"type": "some_type"},
+    {"route": "some_route"},
+    {"date": "2024-13-01"},
+    {"date": "2024-01-01", "time": "8am"},
+    # time of day without a date would scan every date
+    {"time": "08:15"},
+    {"type": "delay", "time": "08:15"},
+    {"fields": ""},
+    {"fields": "type,severity"}
+])
+@patch("main.get_reports_collection")
+def test_get_reports_invalid_query_params_fail(mock_reports_collection, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = get_reports(invalid_data)
 
     assert response == expected
 
+@patch("main.get_reports_collection")
+def test_get_reports_filters_success(mock_reports_collection):
+    mock_report_doc = MagicMock()
+    mock_report_doc.id = "1"
+    mock_report_doc.to_dict.return_value = {"id": "1"}
+
+    mock_query = MagicMock()
+    mock_filtered = mock_query.where.return_value.where.return_value.where.return_value.where.return_value
+    mock_filtered.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
+    mock_reports_collection.return_value = mock_query
+
+    response = get_reports({"time": "8:15", "route": "  sample  route", "date": "2024-1-05", "type": "delay"})
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    assert body["data"]["reports"] == [{"id": "1"}]
+    # filters are normalized and applied in index field order
+    mock_query.where.assert_called_once_with("type", "==", "delay")
+    mock_query.where.return_value.where.assert_called_once_with("route", "==", "Sample Route")
+    mock_query.where.return_value.where.return_value.where.assert_called_once_with("date", "==", "2024-01-05")
+    mock_query.where.return_value.where.return_value.where.return_value.where.assert_called_once_with("time", "==", "08:15")
+
+@patch("main.get_reports_collection")
+def test_get_reports_fields_success(mock_reports_collection):
+    mock_report_doc = MagicMock()
+    mock_report_doc.to_dict.return_value = {"type": "delay", "stop": "Stop 2"}
+    mock_query = mock_reports_collection.return_value
+    mock_projected = mock_query.where.return_value.select.return_value
+    mock_projected.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
+
+    response = get_reports({"type": "delay", "fields": "type,stop"})
+
+    assert json.loads("".join(response[0]))["data"]["reports"] == [{"type": "delay", "stop": "Stop 2"}]
+    # the projection is pushed down with the filters
+    mock_query.where.return_value.select.assert_called_once_with(["type", "stop"])
+
+@patch("main.get_reports_collection")
+def test_get_reports_date_range_success(mock_reports_collection):
+    mock_query = MagicMock()
+    mock_range = mock_query.where.return_value.where.return_value
+    mock_range.order_by.return_value.limit.return_value.stream.return_value = []
+    mock_reports_collection.return_value = mock_query
+
+    response = get_reports({"type": "delay", "from": "2024-02-27", "to": "2024-03-01"})
+
+    assert response[1] == 200
+    # only the date partitions in the range are read
+    mock_query.where.assert_called_once_with("type", "==", "delay")
+    mock_query.where.return_value.where.assert_called_once_with("date", "in", ["2024-02-27", "2024-02-28", "2024-02-29", "2024-03-01"])
+
+@pytest.mark.parametrize("invalid_data", [
+    {"to": "2024-01-05"},
+    {"from": "2024-01-06", "to": "2024-01-05"},
+    {"from": "2024-01-01", "to": "2024-02-15"},
+    {"from": "2024-01-05T08:00"},
+    {"date": "2024-01-05", "from": "2024-01-05"}
+])
+@patch("main.get_reports_collection")
+def test_get_reports_invalid_date_range_fail(mock_reports_collection, invalid_data):
+    response = get_reports(invalid_data)
+
+    assert response[1] == 400
+
+@pytest.fixture
+def archived_reports(tmp_path, monkeypatch):
+    # two archived reports on an old date, and the archive switched on
+    write_partition(str(tmp_path), "2020-01-01", [
+        {"id": "a", "type": "delay", "route": "Main Line", "date": "2020-01-01"},
+        {"id": "b", "type": "no-show", "route": "Main Line", "date": "2020-01-01"}
+    ])
+    monkeypatch.setattr(main, "ARCHIVE_LOCATION", str(tmp_path))
+    return tmp_path
+
+@patch("main.get_reports_collection")
+def test_get_reports_archived_success(mock_reports_collection, archived_reports):
+    mock_report_doc = MagicMock()
+    mock_report_doc.id = "c"
+    mock_report_doc.to_dict.return_value = {"id": "c", "type": "delay", "route": "Main Line", "date": "2020-01-02"}
+
+    mock_query = MagicMock()
+    mock_query.where.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
+    mock_reports_collection.return_value = mock_query
+
+    response = get_reports({"type": "delay", "from": "2020-01-01", "to": "2020-01-02"})
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    # archived reports are filtered like firestore would, then the live dates follow
+    assert [report["id"] for report in body["data"]["reports"]] == ["a", "c"]
+    # only the date without an archive is queried
+    mock_query.where.return_value.where.assert_called_once_with("date", "==", "2020-01-02")
+
+@patch("main.get_reports_collection")
+def test_get_reports_archived_fields_success(mock_reports_collection, archived_reports):
+    mock_query = mock_reports_collection.return_value
+    mock_live = mock_query.where.return_value.where.return_value.select.return_value
+    mock_live.order_by.return_value.limit.return_value.stream.return_value = []
+
+    response = get_reports({"type": "delay", "from": "2020-01-01", "to": "2020-01-02", "fields": "id,route"})
+    body = json.loads("".join(response[0]))
+
+    # archived reports are narrowed down like the live ones
+    assert body["data"]["reports"] == [{"id": "a", "route": "Main Line"}]
+    mock_query.where.return_value.where.return_value.select.assert_called_once_with(["id", "route"])
+
+@patch("main.get_reports_collection")
+def test_get_reports_archived_next_page_success(mock_reports_collection, archived_reports):
+    mock_docs = []
+    for doc_id in ["c", "d"]:
+        mock_report_doc = MagicMock()
+        mock_report_doc.id = doc_id
+        mock_report_doc.to_dict.return_value = {"id": doc_id}
+        mock_docs.append(mock_report_doc)
+
+    mock_query = MagicMock()
+    mock_live = mock_query.where.return_value.order_by.return_value
+    mock_live.limit.return_value.stream.side_effect = lambda: iter(mock_docs)
+    mock_live.start_after.return_value.limit.return_value.stream.return_value = mock_docs[1:]
+    mock_reports_collection.return_value = mock_query
+
+    pages = []
+    query_params = {"from": "2020-01-01", "to": "2020-01-02", "limit": "1"}
+    while True:
+        body = json.loads("".join(get_reports(query_params)[0]))
+        pages.append([report["id"] for report in body["data"]["reports"]])
+        if not body["data"]["nextPageToken"]:
+            break
+        query_params = {**query_params, "start_after": body["data"]["nextPageToken"]}
+
+    # pages run through the archive, then firestore
+    assert pages == [["a"], ["b"], ["c"], ["d"]]
+    mock_live.start_after.assert_called_once_with({"__name__": "c"})
+
+@patch("main.get_reports_collection")
+def test_get_reports_recent_dates_skip_archive(mock_reports_collection, archived_reports, monkeypatch):
+    mock_reports_collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = []
+    # the archived date is inside the retention window, so it isn't read from the archive
+    monkeypatch.setattr(main, "RETENTION_DAYS", 100000)
+
+    response = get_reports({"date": "2020-01-01"})
+
+    assert json.loads("".join(response[0]))["data"]["reports"] == []
+    mock_reports_collection.return_value.where.assert_called_once_with("date", "==", "2020-01-01")
+
+def test_report_filter_indexes():
+    with open(os.path.join(os.path.dirname(__file__), "..", "firestore.indexes.json")) as f:
+        indexes = json.load(f)["indexes"]
+    indexed = {(index["collectionGroup"], *(field["fieldPath"] for field in index["fields"])) for index in indexes}
+
+    # every accepted combination of two or more filters has a composite index
+    for size in range(2, len(main.REPORT_FILTERS) + 1):
+        for fields in itertools.combinations(main.REPORT_FILTERS, size):
+            assert main.is_indexed(fields) == (("reports", *fields, "__name__") in indexed)
+    # and so does every stats query over the rollups
+    for size in range(len(main.ROLLUP_FILTERS) + 1):
+        for fields in itertools.combinations(main.ROLLUP_FILTERS, size):
+            assert ("report_rollups", "bucket", *fields, "start") in indexed
+
+# export_reports tests
+@patch("main.get_reports_collection")
+def test_export_reports_success(mock_reports_collection):
+    mock_doc = MagicMock()
+    mock_doc.id = "1"
+    mock_doc.to_dict.return_value = {"id": "1", "type": "delay", "route": "Main Line", "date": "2024-01-05", "time": "08:15", "timestamp": datetime(2024, 1, 5, 8, 15, tzinfo=timezone.utc), "count": 2}
+    mock_query = mock_reports_collection.return_value.where.return_value
+    mock_query.order_by.return_value.limit.return_value.stream.return_value = [mock_doc]
+
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/reports/export"
+    request.args = {"type": "delay", "format": "csv"}
+    request.headers = {}
+
+    response = main.request_handler(request)
+
+    assert response[1:] == (200, {"Content-Type": "text/csv", "Content-Disposition": 'attachment; filename="reports.csv"'})
+    assert "".join(response[0]).splitlines() == [
+        ",".join(main.REPORT_FIELDS),
+        "1,delay,Main Line,,2024-01-05,08:15,2024-01-05T08:15:00+00:00,2,,,"
+    ]
+    # filters are pushed down into the exported query
+    mock_reports_collection.return_value.where.assert_called_once_with("type", "==", "delay")
+
+@pytest.mark.parametrize("invalid_data", [
+    {"format": "xml"},
+    {"limit": "10"},
+    {"type": "invalid"},
+    {"from": "2024-01-01", "to": "2024-03-01"}
+])
+@patch("main.get_reports_collection")
+def test_export_reports_invalid_query_params_fail(mock_reports_collection, invalid_data):
+    response = main.export_reports(invalid_data)
+
+    assert response[1] == 400
+
+# count_reports tests
+@patch("main.get_reports_collection")
+def test_count_reports_success(mock_reports_collection):
+    mock_query = mock_reports_collection.return_value
+    mock_filtered = mock_query.where.return_value.where.return_value
+    mock_filtered.sum.return_value.get.return_value = [[MagicMock(value=7)]]
+
+    response = count_reports({"type": "delay", "date": "2024-01-05"})
+
+    assert json.loads(response[0]) == {"message": "OK", "data": {"reportCount": 7}}
+    # the same filters as GET /reports, with coalesced reports added up server-side
+    mock_query.where.assert_called_once_with("type", "==", "delay")
+    mock_query.where.return_value.where.assert_called_once_with("date", "==", "2024-01-05")
+    mock_filtered.sum.assert_called_once_with("count", alias="count")
+
+@patch("main.get_reports_collection")
+def test_count_reports_archived_success(mock_reports_collection, archived_reports):
+    mock_live = mock_reports_collection.return_value.where.return_value.where.return_value
+    mock_live.sum.return_value.get.return_value = [[MagicMock(value=4)]]
+
+    response = count_reports({"type": "delay", "from": "2020-01-01", "to": "2020-01-02"})
+
+    # one matching archived report, and the live date counted in firestore
+    assert json.loads(response[0])["data"] == {"reportCount": 5}
+    mock_reports_collection.return_value.where.return_value.where.assert_called_once_with("date", "==", "2020-01-02")
+
+@pytest.mark.parametrize("invalid_data", [
+    {"limit": "10"},
+    {"type": "some_type"},
+    {"time": "08:15"},
+    {"from": "2024-01-01", "to": "2024-03-01"}
+])
+@patch("main.get_reports_collection")
+def test_count_reports_invalid_query_params_fail(mock_reports_collection, invalid_data):
+    response = count_reports(invalid_data)
+
+    assert response[1] == 400
+
+@patch("main.count_reports")
+def test_request_handler_count_success(mock_count):
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/reports/count"
+    request.args = {}
+    request.headers = {}
+
+    main.request_handler(request)
+
+    # "count" isn't taken as a report ID
+    mock_count.assert_called_once_with({})
+
+@patch("main.count_reports")
+def test_request_handler_invalid_token_fail(mock_count, monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+    header, payload, signature = tokens.issue_token("1", "user").split(".")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/reports/count"
+    request.args = {}
+    request.headers = {"Authorization": f"Bearer {header}.{payload}.{signature[::-1]}"}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 401
+    mock_count.assert_not_called()
+
+@pytest.mark.parametrize("authorization", ["Bearer not.a.token", "Basic dXNlcjpwYXNz"])
+@patch("main.count_reports")
+def test_request_handler_foreign_token_success(mock_count, monkeypatch, authorization):
+    # tokens someone else issued, like IAM ID tokens, leave the request anonymous
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/reports/count"
+    request.args = {}
+    request.headers = {"Authorization": authorization}
+
+    main.request_handler(request)
+
+    mock_count.assert_called_once_with({})
+
 # delete_routes tests
 @patch("main.get_db")
 @patch("main.get_reports_collection")
@@ -59,7 +437,8 @@ def test_delete_reports_success(mock_reports_collection, mock_get_db):
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_report_doc]
+    # one page, shorter than a full batch
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
     mock_reports_collection.return_value = mock_query
 
     # mock db and batch
@@ -86,9 +465,61 @@ def test_delete_reports_success(mock_reports_collection, mock_get_db):
 
     assert response == expected
 
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_delete_reports_filters_success(mock_reports_collection, mock_get_db):
+    mock_report_doc = MagicMock()
+    mock_report_doc.id = "1"
+    mock_report_doc.to_dict.return_value = {"id": "1", "type": "delay"}
+
+    mock_query = MagicMock()
+    mock_query.where.return_value.where.return_value.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
+    mock_reports_collection.return_value = mock_query
+
+    response = delete_reports({"type": "delay", "date": "2024-01-05"})
+
+    assert json.loads(response[0])["data"] == {"deletedReportCount": 1, "deletedReportIds": ["1"]}
+    mock_query.where.assert_called_once_with("type", "==", "delay")
+    mock_query.where.return_value.where.assert_called_once_with("date", "==", "2024-01-05")
+    mock_query.stream.assert_not_called()
+
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_delete_reports_date_range_success(mock_reports_collection, mock_get_db):
+    mock_docs = []
+    for doc_id in ["1", "2"]:
+        mock_report_doc = MagicMock()
+        mock_report_doc.id = doc_id
+        mock_report_doc.to_dict.return_value = {"id": doc_id}
+        mock_docs.append(mock_report_doc)
+
+    mock_query = MagicMock()
+    mock_query.where.return_value.select.return_value.order_by.return_value.limit.return_value.stream.side_effect = [[mock_docs[0]], [mock_docs[1]]]
+    mock_reports_collection.return_value = mock_query
+
+    response = delete_reports({"from": "2024-01-01", "to": "2024-02-15"})
+
+    assert json.loads(response[0])["data"] == {"deletedReportCount": 2, "deletedReportIds": ["1", "2"]}
+    # one query per 30 date partitions, and never the whole collection
+    days = [call[0][2] for call in mock_query.where.call_args_list]
+    assert [len(chunk) for chunk in days] == [30, 16]
+    assert days[0][0] == "2024-01-01" and days[-1][-1] == "2024-02-15"
+    mock_query.stream.assert_not_called()
+
+@pytest.mark.parametrize("invalid_data", [{"limit": "10"}, {"time": "08:15"}, {"date": "yesterday"}, {"to": "2024-01-01"}, {"from": "2020-01-01", "to": "2024-01-01"}])
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_delete_reports_invalid_query_params_fail(mock_reports_collection, mock_get_db, invalid_data):
+    response = delete_reports(invalid_data)
+
+    assert response[1] == 400
+    mock_reports_collection.return_value.stream.assert_not_called()
+
 # create_report tests
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
 @patch("main.get_reports_collection")
-def test_create_report_success(mock_reports_collection):
+def test_create_report_success(mock_reports_collection, mock_get_db, mock_rollups_collection):
     report = {
         "id": "1",
         "type": "delay",
@@ -101,7 +532,10 @@ def test_create_report_success(mock_reports_collection):
     expected = (
         json.dumps({
             "message": "Created",
-            "data": ""
+            "data": {
+                "id": "1",
+                "coalesced": False
+            }
         }),
         201,
         {
@@ -111,6 +545,7 @@ def test_create_report_success(mock_reports_collection):
 
     # mock reports collection
     mock_reports = MagicMock()
+    mock_reports.document.return_value.id = "1"
     mock_reports_collection.return_value = mock_reports
 
     # mock request data
@@ -119,6 +554,46 @@ def test_create_report_success(mock_reports_collection):
     response = create_report(data)
 
     assert response == expected
+    mock_batch = mock_get_db.return_value.batch.return_value
+    # date and time posted are stored for filtering
+    doc, stored = mock_batch.create.call_args[0]
+    assert doc is mock_reports.document.return_value
+    # the timestamp is set by the server, not the client
+    assert stored["timestamp"] is SERVER_TIMESTAMP
+    assert stored["count"] == 1
+    assert re.fullmatch(r"\d{4}-\d{2}-\d{2}", stored["date"])
+    assert re.fullmatch(r"\d{2}:\d{2}", stored["time"])
+    # the report is counted in its hour and day rollups in the same batch
+    rollups = [call[0][1] for call in mock_batch.set.call_args_list]
+    assert [(rollup["bucket"], rollup["start"]) for rollup in rollups] == [
+        ("hour", f"{stored['date']}T{stored['time'][:2]}"),
+        ("day", stored["date"])
+    ]
+    assert all(rollup["count"].value == 1 and 0 <= rollup["shard"] < main.ROLLUP_SHARDS for rollup in rollups)
+    assert all(call[1] == {"merge": True} for call in mock_batch.set.call_args_list)
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_report_without_timestamp_success(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_reports_collection.return_value.document.return_value.id = "1"
+    response = create_report({"type": "delay", "route": "Sample Route", "createdBy": "test_user_id"})
+
+    assert response[1] == 201
+
+
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_report_signed_in_success(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_reports_collection.return_value.document.return_value.id = "1"
+    # signed-in users don't name themselves as the author
+    response = create_report({"type": "delay", "route": "Sample Route"}, {"sub": "user-1", "type": "user"})
+
+    assert response[1] == 201
+    _, stored = mock_get_db.return_value.batch.return_value.create.call_args[0]
+    assert stored["createdBy"] == "user-1"
 
 @pytest.mark.parametrize("invalid_data", [0, None, "", "some_type"])
 @patch("main.get_reports_collection")
@@ -182,6 +657,174 @@ def test_create_report_invalid_route_fail(mock_reports_collection, invalid_data)
 
     assert response == expected
 
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_report_coalesces_duplicate(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_batches = [MagicMock(), MagicMock()]
+    # the report's window already has a report
+    mock_batches[0].commit.side_effect = AlreadyExists("document already exists")
+    mock_get_db.return_value.batch.side_effect = mock_batches
+    mock_reports_collection.return_value.document.return_value.id = "1"
+
+    response = create_report({"type": "delay", "route": "route 1", "stop": "stop 1", "createdBy": "test_user_id"})
+
+    # the client learns which report it was coalesced into
+    assert response[1] == 200
+    assert json.loads(response[0])["data"] == {"id": "1", "coalesced": True}
+    # the existing report counts one more report, and so do the rollups
+    doc, fields = mock_batches[1].update.call_args[0]
+    assert doc is mock_reports_collection.return_value.document.return_value
+    assert fields["count"].value == 1
+    assert fields["lastSeen"] is SERVER_TIMESTAMP
+    assert [call[0][1]["count"].value for call in mock_batches[1].set.call_args_list] == [1, 1]
+    mock_batches[1].commit.assert_called_once()
+
+def test_report_document_coalescing_key(monkeypatch):
+    mock_reports = MagicMock()
+    mock_reports.document.side_effect = lambda doc_id=None: doc_id
+    monkeypatch.setattr(main, "get_reports_collection", lambda: mock_reports)
+    monkeypatch.setattr(main, "COALESCE_WINDOW_MINUTES", 10)
+    report = {"type": "delay", "route": "Route 1", "stop": "Stop 1", "date": "2024-01-05", "time": "08:11"}
+
+    doc_id = main.report_document(report)
+
+    # same route, stop, type and window
+    assert main.report_document({**report, "time": "08:19"}) == doc_id
+    # different window, stop or type
+    assert main.report_document({**report, "time": "08:20"}) != doc_id
+    assert main.report_document({**report, "stop": "Stop 2"}) != doc_id
+    assert main.report_document({key: value for key, value in report.items() if key != "stop"}) != doc_id
+    assert main.report_document({**report, "type": "no-show"}) != doc_id
+
+    # coalescing off
+    monkeypatch.setattr(main, "COALESCE_WINDOW_MINUTES", 0)
+    assert main.report_document(report) is None
+
+def test_invalid_coalesce_window_fail():
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "REPORT_COALESCE_WINDOW_MINUTES": "7"}
+    result = subprocess.run([sys.executable, "-c", "import main"], cwd=service_dir, env=env, capture_output=True, text=True)
+
+    assert result.returncode != 0
+    assert "REPORT_COALESCE_WINDOW_MINUTES must be 0 or divide 60" in result.stderr
+
+# create_reports tests
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_reports_success(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    reports = [
+        {"type": "delay", "route": "route 1", "stop": "stop 1", "createdBy": "test_user_id"},
+        {"type": "some_type", "route": "route 1", "createdBy": "test_user_id"},
+        {"type": "no-show", "route": "route 2", "createdBy": "test_user_id"}
+    ]
+
+    mock_docs = []
+    for doc_id in ["a", "b"]:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_docs.append(mock_doc)
+    mock_reports = MagicMock()
+    mock_reports.document.side_effect = mock_docs
+    mock_reports_collection.return_value = mock_reports
+
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+    mock_get_db.return_value.get_all.return_value = []
+
+    response = main.create_reports({"reports": reports})
+    body = json.loads(response[0])
+
+    assert response[1] == 200
+    assert body["data"]["createdReportCount"] == 2
+    # one result per report, in request order
+    assert [result.get("id") for result in body["data"]["results"]] == ["a", None, "b"]
+    assert body["data"]["results"][1] == {"index": 1, "error": "Invalid report type: some_type"}
+    # both reports and their hour and day rollups go in one batch
+    stored = [call[0][1] for call in mock_batch.create.call_args_list]
+    assert [(report["id"], report["route"]) for report in stored] == [("a", "Route 1"), ("b", "Route 2")]
+    assert mock_batch.set.call_count == 4
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_reports_coalesces_duplicates(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_reports_collection.return_value.document.side_effect = lambda doc_id=None: MagicMock(id=doc_id)
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+    # the no-show report's window already has a report
+    mock_get_db.return_value.get_all.side_effect = lambda docs: [MagicMock(id=docs[1].id, exists=True)]
+
+    report = {"type": "delay", "route": "route 1", "createdBy": "test_user_id"}
+    response = main.create_reports([report, {**report, "type": "no-show"}, report])
+    results = json.loads(response[0])["data"]["results"]
+
+    assert json.loads(response[0])["data"]["createdReportCount"] == 3
+    # duplicates in the request share a report
+    assert results[0]["id"] == results[2]["id"] != results[1]["id"]
+    assert [result["coalesced"] for result in results] == [False, True, True]
+    created = mock_batch.create.call_args[0][1]
+    assert (created["id"], created["count"]) == (results[0]["id"], 2)
+    doc, fields = mock_batch.update.call_args[0]
+    assert (doc.id, fields["count"].value) == (results[1]["id"], 1)
+    assert sorted(call[0][1]["count"].value for call in mock_batch.set.call_args_list) == [1, 1, 2, 2]
+
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_reports_splits_batches(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_reports_collection.return_value.document.side_effect = lambda doc_id=None: MagicMock(id=doc_id)
+    mock_batches = [MagicMock() for _ in range(3)]
+    mock_get_db.return_value.batch.side_effect = mock_batches
+    mock_get_db.return_value.get_all.return_value = []
+
+    response = main.create_reports([{"type": "delay", "route": f"route {i}", "createdBy": "test_user_id"} for i in range(400)])
+
+    assert json.loads(response[0])["data"]["createdReportCount"] == 400
+    # a report and its two rollups are three writes, so at most 166 reports fit a batch
+    assert sorted(batch.create.call_count for batch in mock_batches) == [68, 166, 166]
+    assert all(batch.commit.call_count == 1 for batch in mock_batches)
+
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_reports_failed_batch_reported(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_reports_collection.return_value.document.return_value.id = "a"
+    mock_get_db.return_value.batch.return_value.commit.side_effect = Exception("deadline exceeded")
+
+    response = main.create_reports([{"type": "delay", "route": "route 1", "createdBy": "test_user_id"}])
+    body = json.loads(response[0])
+
+    assert response[1] == 200
+    assert body["data"]["createdReportCount"] == 0
+    assert body["data"]["results"] == [{"index": 0, "error": "Write failed: deadline exceeded"}]
+
+@pytest.mark.parametrize("invalid_data", [
+    {},
+    [],
+    {"reports": "delay"},
+    [{"type": "delay", "route": "route 1", "createdBy": "test_user_id"}] * 501
+])
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_create_reports_invalid_body_fail(mock_reports_collection, mock_get_db, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = main.create_reports(invalid_data)
+
+    assert response == expected
+
 # get_report tests
 @patch("main.get_reports_collection")
 def test_get_report_success(mock_reports_collection):
@@ -197,11 +840,8 @@ def test_get_report_success(mock_reports_collection):
     mock_report_doc = MagicMock()
     mock_report_doc.to_dict.return_value = report
 
-    mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_report_doc]
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value = mock_report_doc
 
     mock_reports_collection.return_value = mock_collection
 
@@ -214,7 +854,8 @@ def test_get_report_success(mock_reports_collection):
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
     
@@ -222,6 +863,53 @@ def test_get_report_success(mock_reports_collection):
 
     assert response == expected
 
+@patch("main.get_reports_collection")
+def test_get_report_fields_success(mock_reports_collection):
+    mock_reference = mock_reports_collection.return_value.document.return_value
+    mock_reference.get.return_value.to_dict.return_value = {"count": 3}
+
+    response = get_report("1", {"fields": "count"})
+
+    assert json.loads(response[0])["data"] == {"report": {"count": 3}}
+    mock_reference.get.assert_called_once_with(field_paths=["count"])
+
+@patch("main.get_reports_collection")
+def test_get_report_not_modified_success(mock_reports_collection):
+    mock_report_doc = mock_reports_collection.return_value.document.return_value.get.return_value
+    mock_report_doc.id = "1"
+    mock_report_doc.to_dict.return_value = {"id": "1"}
+    mock_report_doc.update_time = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+    headers = get_report("1")[2]
+    assert headers["Last-Modified"] == "Wed, 01 May 2024 12:30:00 GMT"
+
+    # the client's copy is current, so it gets a 304 with no body
+    for request_headers in ({"If-None-Match": headers["ETag"]}, {"If-Modified-Since": headers["Last-Modified"]}):
+        assert get_report("1", None, request_headers) == ("", 304, headers)
+
+    # the report changed since, so it is sent again
+    mock_report_doc.update_time = datetime(2024, 5, 1, 12, 31, tzinfo=timezone.utc)
+    response = get_report("1", None, {"If-None-Match": headers["ETag"]})
+
+    assert response[1] == 200
+    assert json.loads(response[0])["data"] == {"report": {"id": "1"}}
+
+@patch("main.get_reports_collection")
+def test_get_report_invalid_fields_fail(mock_reports_collection):
+    response = get_report("1", {"fields": "severity"})
+
+    assert response[1] == 400
+@patch("main.get_reports_collection")
+def test_get_report_timestamp_success(mock_reports_collection):
+    mock_report_doc = MagicMock()
+    mock_report_doc.to_dict.return_value = {"id": "1", "timestamp": datetime(2024, 1, 5, 8, 15, 30, tzinfo=timezone.utc)}
+    mock_reports_collection.return_value.document.return_value.get.return_value = mock_report_doc
+
+    response = get_report("1")
+
+    # firestore timestamps are returned as ISO 8601
+    assert json.loads(response[0])["data"]["report"] == {"id": "1", "timestamp": "2024-01-05T08:15:30+00:00"}
+
 @patch("main.get_reports_collection")
 @pytest.mark.parametrize("invalid_data", ["", 0, None])
 def test_get_report_invalid_id_fail(mock_reports_collection, invalid_data):
@@ -241,4 +929,166 @@ def test_get_report_invalid_id_fail(mock_reports_collection, invalid_data):
 
     response = get_report(invalid_data)
 
-    assert response == expected
\ No newline at end of file
+    assert response == expected
+
+# get_db tests
+# get_report_stats tests
+@patch("main.get_rollups_collection")
+def test_get_report_stats_success(mock_rollups_collection):
+    mock_docs = []
+    for start, shard, count in [("2024-01-05T08", 0, 2), ("2024-01-05T08", 3, 1), ("2024-01-05T09", 1, 4), ("2024-01-05T10", 2, 0)]:
+        mock_rollup_doc = MagicMock()
+        mock_rollup_doc.to_dict.return_value = {
+            "bucket": "hour",
+            "start": start,
+            "route": "Sample Route",
+            "type": "delay",
+            "shard": shard,
+            "count": count
+        }
+        mock_docs.append(mock_rollup_doc)
+
+    mock_query = mock_rollups_collection.return_value.where.return_value
+    mock_range = mock_query.where.return_value.where.return_value.where.return_value.where.return_value
+    mock_range.limit.return_value.stream.return_value = mock_docs
+
+    expected = (
+        json.dumps({
+            "message": "OK",
+            "data": {
+                "bucket": "hour",
+                "from": "2024-01-05T08",
+                "to": "2024-01-05T10",
+                "total": 7,
+                # shards are added up, and empty buckets are left out
+                "stats": [
+                    {"start": "2024-01-05T08", "route": "Sample Route", "type": "delay", "count": 3},
+                    {"start": "2024-01-05T09", "route": "Sample Route", "type": "delay", "count": 4}
+                ]
+            }
+        }),
+        200,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = main.get_report_stats({"route": "sample route", "type": "delay", "from": "2024-01-05T08:30", "to": "2024-01-05T11:15+01:00"})
+
+    assert response == expected
+    mock_rollups_collection.return_value.where.assert_called_once_with("bucket", "==", "hour")
+    mock_query.where.assert_called_once_with("route", "==", "Sample Route")
+    mock_query.where.return_value.where.assert_called_once_with("type", "==", "delay")
+    mock_query.where.return_value.where.return_value.where.assert_called_once_with("start", ">=", "2024-01-05T08")
+    mock_query.where.return_value.where.return_value.where.return_value.where.assert_called_once_with("start", "<=", "2024-01-05T10")
+    mock_range.limit.assert_called_once_with(main.MAX_STATS_ROLLUPS + 1)
+
+@patch("main.get_rollups_collection")
+def test_get_report_stats_request_handler_success(mock_rollups_collection):
+    mock_range = mock_rollups_collection.return_value.where.return_value.where.return_value.where.return_value
+    mock_range.limit.return_value.stream.return_value = []
+
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/reports/stats"
+    request.args = {"bucket": "day", "from": "2024-01-01", "to": "2024-01-31"}
+    request.headers = {}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 200
+    assert json.loads(response[0])["data"] == {"bucket": "day", "from": "2024-01-01", "to": "2024-01-31", "total": 0, "stats": []}
+
+@pytest.mark.parametrize("invalid_data", [
+    {"to": "2024-01-05"},
+    {"from": "2024-01-05"},
+    {"from": "yesterday", "to": "2024-01-05"},
+    {"from": "2024-01-06", "to": "2024-01-05"},
+    {"from": "2024-01-05", "to": "2024-01-06", "bucket": "week"},
+    {"from": "2024-01-05", "to": "2024-01-06", "type": "some_type"},
+    {"from": "2024-01-05", "to": "2024-01-06", "route": "some_route"},
+    {"from": "2024-01-05", "to": "2024-01-06", "stop": "Stop 1"},
+    # too many hourly buckets
+    {"from": "2023-01-01", "to": "2024-01-01"}
+])
+@patch("main.get_rollups_collection")
+def test_get_report_stats_invalid_query_params_fail(mock_rollups_collection, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = main.get_report_stats(invalid_data)
+
+    assert response == expected
+
+@patch("main.get_rollups_collection")
+def test_get_report_stats_too_many_rollups_fail(mock_rollups_collection, monkeypatch):
+    monkeypatch.setattr(main, "MAX_STATS_ROLLUPS", 2)
+    mock_rollup_doc = MagicMock()
+    mock_rollup_doc.to_dict.return_value = {"bucket": "day", "start": "2024-01-05", "route": "Sample Route", "type": "delay", "shard": 0, "count": 1}
+    mock_range = mock_rollups_collection.return_value.where.return_value.where.return_value.where.return_value
+    mock_range.limit.return_value.stream.return_value = iter([mock_rollup_doc] * 3)
+
+    response = main.get_report_stats({"bucket": "day", "from": "2024-01-01", "to": "2024-01-31"})
+
+    assert response[1] == 400
+    # no more than one rollup past the limit is read
+    mock_range.limit.assert_called_once_with(3)
+
+@patch("main.get_rollups_collection")
+@patch("main.get_db")
+@patch("main.get_reports_collection")
+def test_delete_reports_updates_rollups(mock_reports_collection, mock_get_db, mock_rollups_collection):
+    mock_report_doc = MagicMock()
+    mock_report_doc.id = "1"
+    mock_report_doc.to_dict.return_value = {"id": "1", "type": "delay", "route": "Sample Route", "date": "2024-01-05", "time": "08:15", "count": 3}
+    mock_reports_collection.return_value.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_report_doc]
+
+    response = delete_reports()
+
+    assert response[1] == 200
+    # only the fields the rollups need are read
+    mock_reports_collection.return_value.select.assert_called_once_with(["route", "type", "date", "time", "count"])
+    mock_batch = mock_get_db.return_value.batch.return_value
+    # the report must still exist, so a retried batch can't take it out twice
+    mock_get_db.return_value.write_option.assert_called_once_with(exists=True)
+    mock_batch.delete.assert_called_once_with(mock_report_doc.reference, option=mock_get_db.return_value.write_option.return_value)
+    # every report coalesced into the deleted one is taken out
+    rollups = [call[0][1] for call in mock_batch.set.call_args_list]
+    assert [(rollup["bucket"], rollup["start"], rollup["count"].value) for rollup in rollups] == [
+        ("hour", "2024-01-05T08", -3),
+        ("day", "2024-01-05", -3)
+    ]
+    mock_batch.commit.assert_called_once()
+
+@patch("google.cloud.firestore.Client")
+def test_get_db_reuses_client(mock_client, monkeypatch):
+    monkeypatch.setattr(main, "_db", None)
+    monkeypatch.setattr(main, "_reports_collection", None)
+
+    # simulate concurrent cold requests
+    threads = [threading.Thread(target=main.get_reports_collection) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert main.get_db() is main.get_db()
+    assert main.get_reports_collection() is main.get_reports_collection()
+    mock_client.assert_called_once()
+
+# cold start tests
+def test_import_defers_heavy_dependencies():
+    # import main in a fresh interpreter, like a cold start would
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main; print([m for m in ('google.cloud.firestore',) if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], cwd=service_dir, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
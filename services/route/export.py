@@ -0,0 +1,148 @@
+# streaming exports shared by the report, route and user services
+# each service deploys on its own, so services/shared/export.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+import csv
+import io
+import json
+import logging
+import zlib
+from datetime import datetime
+
+# content types and file extensions of the export formats
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv")
+}
+
+# number of documents read per query while exporting
+# every page is a new query that starts after the last exported document, so only
+# one page is held in memory and no single stream stays open for the whole export
+EXPORT_PAGE_SIZE = 500
+
+# utility function to validate the export query parameters
+# format is ndjson (the default) or csv, gzip=true compresses the file, and after
+# resumes an export after the document with that ID, the last one received
+# returns (format, gzip, after), or None if the parameters are invalid
+def parse_export_params(query_params=None):
+    query_params = query_params or {}
+
+    export_format = query_params.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        logging.error(f"Invalid format: {export_format}. Must be one of {', '.join(EXPORT_FORMATS)}")
+        return None
+
+    compress = query_params.get("gzip", "false")
+    if compress not in ("true", "false"):
+        logging.error(f"Invalid gzip: {compress}. Must be true or false")
+        return None
+
+    after = query_params.get("after") or None
+    if after is not None and "/" in after:
+        logging.error(f"Invalid after: {after}. Must be a document ID")
+        return None
+    return export_format, compress == "true", after
+
+# read every document a query matches in document ID order, one page at a time
+def export_documents(query, after=None, page_size=EXPORT_PAGE_SIZE):
+    while True:
+        page = query.order_by("__name__")
+        if after is not None:
+            page = page.start_after({"__name__": after})
+        count = 0
+        for doc in page.limit(page_size).stream():
+            count += 1
+            after = doc.id
+            yield doc
+        # a short page is the last one
+        if count < page_size:
+            return
+
+# utility function to encode values json can't, like firestore timestamps
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# encode documents as newline-delimited JSON, without the omitted fields
+def ndjson_lines(docs, omit=()):
+    for doc in docs:
+        data = doc.to_dict()
+        for field in omit:
+            data.pop(field, None)
+        yield json.dumps(data, default=export_value) + "\n"
+
+# encode a value as a CSV cell: lists and maps as JSON, missing values as empty cells
+def csv_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, (bool, list, dict)):
+        return json.dumps(value, default=export_value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+# encode documents as CSV rows under a header of the given fields
+def csv_lines(docs, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        row = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return row
+
+    yield line(fields)
+    for doc in docs:
+        data = doc.to_dict()
+        yield line([csv_cell(data.get(field)) for field in fields])
+
+# compress lines into a gzip stream
+# zlib only emits output once it has filled a block, so memory stays constant
+def gzip_chunks(lines):
+    compressor = zlib.compressobj(wbits=31)
+    for text in lines:
+        chunk = compressor.compress(text.encode("utf-8"))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+# utility function to stream the documents a query matches as an NDJSON or CSV file
+# csv files have a column per field, and fields in omit are never exported
+# if the connection drops, the export resumes with after set to the ID of the
+# last complete line received
+def http_export_response(name, query, export_format, compress=False, after=None, fields=(), omit=()):
+    docs = export_documents(query, after)
+    # fetch the first document up front so query errors still become a 500
+    first_doc = next(docs, None)
+
+    def documents():
+        if first_doc is None:
+            return
+        yield first_doc
+        try:
+            yield from docs
+        except Exception as e:
+            # the status has already been sent, so all we can do is end the file early
+            logging.error(f"Internal server error while exporting {name}: {e}")
+
+    if export_format == "csv":
+        lines = csv_lines(documents(), [field for field in fields if field not in omit])
+    else:
+        lines = ndjson_lines(documents(), omit)
+
+    content_type, extension = EXPORT_FORMATS[export_format]
+    filename = f"{name}.{extension}"
+    if compress:
+        lines = gzip_chunks(lines)
+        content_type = "application/gzip"
+        filename += ".gz"
+
+    logging.debug(f"Streaming export: {filename}")
+    # google cloud streams a generator body
+    return (
+        lines,
+        200,
+        {"Content-Type": content_type, "Content-Disposition": f'attachment; filename="{filename}"'}
+    )
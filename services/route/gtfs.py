@@ -0,0 +1,56 @@
+from collections import Counter, defaultdict
+import csv
+import io
+from itertools import chain
+
+# files of a GTFS feed needed to build routes
+GTFS_FILES = ["routes.txt", "stops.txt", "trips.txt", "stop_times.txt"]
+
+# build routes from a GTFS feed
+# open_file(name) returns an iterable of lines for a file in the feed, and may be
+# called more than once per file so that stop_times.txt is streamed, never loaded
+# each route's stops are taken from its longest trip, in stop_sequence order
+def parse_gtfs(open_file):
+    stop_names = {row["stop_id"]: row["stop_name"] for row in _read(open_file, "stops.txt")}
+    trip_routes = {row["trip_id"]: row["route_id"] for row in _read(open_file, "trips.txt")}
+
+    # first pass over stop_times.txt: find the longest trip of every route
+    trip_lengths = Counter(row["trip_id"] for row in _read(open_file, "stop_times.txt"))
+    longest_trips = {}
+    for trip_id, length in trip_lengths.items():
+        route_id = trip_routes.get(trip_id)
+        if route_id is None:
+            continue
+        if route_id not in longest_trips or length > trip_lengths[longest_trips[route_id]]:
+            longest_trips[route_id] = trip_id
+
+    # second pass: keep stop times only for the chosen trips
+    chosen_trips = set(longest_trips.values())
+    trip_stops = defaultdict(list)
+    for row in _read(open_file, "stop_times.txt"):
+        if row["trip_id"] in chosen_trips:
+            trip_stops[row["trip_id"]].append((int(row["stop_sequence"]), row["stop_id"]))
+
+    routes = []
+    for row in _read(open_file, "routes.txt"):
+        stop_times = sorted(trip_stops.get(longest_trips.get(row["route_id"]), []))
+        routes.append({
+            "name": row.get("route_long_name") or row.get("route_short_name") or "",
+            "stops": [stop_names.get(stop_id, stop_id) for _, stop_id in stop_times],
+            "active": True
+        })
+
+    return routes
+
+# build routes from a GTFS feed given as a dict of file name to file contents
+def parse_gtfs_files(files: dict):
+    missing = [name for name in GTFS_FILES if name not in files]
+    if missing:
+        raise KeyError(f"missing {', '.join(missing)}")
+    return parse_gtfs(lambda name: io.StringIO(files[name]))
+
+# utility function to read rows of a GTFS file, which may start with a byte order mark
+def _read(open_file, name):
+    lines = iter(open_file(name))
+    first_line = next(lines, "")
+    yield from csv.DictReader(chain([first_line.lstrip("\ufeff")], lines))
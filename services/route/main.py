@@ -1,11 +1,22 @@
-from google.cloud import firestore
 import json
 import logging
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from normalize import normalize_name, normalize_stops
+from gtfs import parse_gtfs_files
+from planner import TransitNetwork
+from bulk import bulk_delete, parse_sample_size
+from export import http_export_response, parse_export_params
+from conditional import not_modified, validator_headers
+from pages import count_documents, http_stream_response, paginate
+from fields import get_document, parse_fields, select_fields
+from tokens import authenticate
 
 STATUS = {
     200: "OK",
     201: "Created",
+    304: "Not Modified",
     400: "Bad Request",
     401: "Unauthorized",
     404: "Not Found",
@@ -14,12 +25,93 @@ STATUS = {
     500: "Internal Server Error"
 }
 
+# fields GET /routes and /routes/{id} can be narrowed to with fields=,
+# and the columns of a CSV export of routes
+ROUTE_FIELDS = ["id", "name", "stops", "active", "createdBy"]
+
+# maximum number of writes in a single firestore batch
+BATCH_SIZE = 500
+# maximum number of routes in one import request, and batches committed at once
+MAX_IMPORT_ROUTES = 20000
+IMPORT_WORKERS = 8
+
+# seconds before the cached trip planner network is rebuilt, to pick up route
+# changes made through other function instances
+NETWORK_TTL = 300
+
+# firestore client and collection handle, created lazily on first use and
+# reused across warm invocations of the function instance
+# google.cloud.firestore is only imported here, so requests that never reach the
+# database (404s, 405s, validation errors) don't pay for it on a cold start
+_db = None
+_db_lock = threading.Lock()
+_routes_collection = None
+_stops_collection = None
+
 def get_db():
-    return firestore.Client()
+    global _db
+    if _db is None:
+        with _db_lock:
+            # check again in case another request created the client first
+            if _db is None:
+                from google.cloud import firestore
+                _db = firestore.Client()
+    return _db
 
 def get_routes_collection():
-    db = get_db()
-    return db.collection("routes")
+    global _routes_collection
+    if _routes_collection is None:
+        _routes_collection = get_db().collection("routes")
+    return _routes_collection
+
+# the stops collection is an inverted index of routes, keyed by normalized stop
+# name, with the IDs of the routes serving each stop in its "routes" field
+def get_stops_collection():
+    global _stops_collection
+    if _stops_collection is None:
+        _stops_collection = get_db().collection("stops")
+    return _stops_collection
+
+# in-memory network of active routes for the trip planner, built on first use,
+# updated in place by this instance's route writes and rebuilt after NETWORK_TTL
+_network = None
+_network_built_at = 0.0
+_network_lock = threading.Lock()
+
+def get_network():
+    global _network, _network_built_at
+    with _network_lock:
+        if _network is None or time.monotonic() - _network_built_at > NETWORK_TTL:
+            network = TransitNetwork()
+            for doc in get_routes_collection().stream():
+                route = doc.to_dict()
+                if route.get("active"):
+                    network.add_route(doc.id, route.get("stops", []))
+            _network = network
+            _network_built_at = time.monotonic()
+        return _network
+
+# utility function to apply a route write to the cached network, if there is one
+# pass stops=None to remove the route
+def update_network(route_id, stops=None):
+    with _network_lock:
+        if _network is None:
+            return
+        if stops:
+            _network.add_route(route_id, stops)
+        else:
+            _network.remove_route(route_id)
+
+# utility function to add the stop index writes for a route's changed stops to a batch
+def index_route_stops(batch, route_id, added_stops=(), removed_stops=()):
+    from google.cloud.firestore import ArrayRemove, ArrayUnion
+    stops = get_stops_collection()
+
+    for stop in set(added_stops):
+        batch.set(stops.document(stop), {"name": stop, "routes": ArrayUnion([route_id])}, merge=True)
+    for stop in set(removed_stops):
+        # merge so a missing index entry doesn't fail the batch
+        batch.set(stops.document(stop), {"routes": ArrayRemove([route_id])}, merge=True)
 
 def request_handler(request):
     try:
@@ -33,6 +125,12 @@ def request_handler(request):
         query_params = request.args
         logging.debug(f"Query parameters: {query_params}")
 
+        # verify the access token, if the request carries one, without a database read
+        user = authenticate(request)
+        if user is None:
+            logging.error("Invalid or expired access token")
+            return http_response(401)
+
         # dynamically parse path parameters
         route_id = ""
         if len(path) == 2 and path[0] == "routes":
@@ -46,7 +144,7 @@ def request_handler(request):
                 match request.method:
                     # get a list of all routes
                     case "GET":
-                        return get_routes(query_params)
+                        return get_routes(query_params, request.headers)
                     # delete all routes
                     case "DELETE":
                         return delete_routes(query_params)
@@ -54,15 +152,68 @@ def request_handler(request):
                     case _:
                         logging.error(f"Invalid request method: {request.method}")
                         return http_response(405)
+            # /routes:import, endpoint for importing many routes at once
+            case ["routes:import"]:
+                match request.method:
+                    # import a JSON array of routes or a GTFS feed
+                    case "POST":
+                        return import_routes(data, user)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /stops/{name}/routes, endpoint for finding the routes serving a stop
+            case ["stops", stop_name, "routes"]:
+                match request.method:
+                    # get the IDs of the routes serving a stop
+                    case "GET":
+                        return get_stop_routes(stop_name)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /routes/plan, endpoint for planning a trip between two stops
+            # matched before /routes/{id} so "plan" isn't taken as a route ID
+            case ["routes", "plan"]:
+                match request.method:
+                    # get the trip with the fewest transfers, then the fewest stops
+                    case "GET":
+                        return plan_trip(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /routes/export, endpoint for downloading routes as a file
+            # matched before /routes/{id} so "export" isn't taken as a route ID
+            case ["routes", "export"]:
+                match request.method:
+                    # stream all routes as NDJSON or CSV
+                    case "GET":
+                        return export_routes(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+            # /routes/count, endpoint for counting routes
+            # matched before /routes/{id} so "count" isn't taken as a route ID
+            case ["routes", "count"]:
+                match request.method:
+                    # count all routes
+                    case "GET":
+                        return count_routes(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
             # /routes/{id}, endpoint for managing a specific route
             case ["routes", route_id]:
                 match request.method:
                     # create a new route
                     case "POST":
-                        return create_route(data)
+                        return create_route(data, user)
                     # get a route
                     case "GET":
-                        return get_route(route_id)
+                        return get_route(route_id, query_params, request.headers)
                     # update a route
                     case "PATCH":
                         return update_route(route_id, data)
@@ -82,7 +233,7 @@ def request_handler(request):
         return http_response(500)
 
 # utility function to form a consistent HTTP response
-def http_response(status: int, data=None):
+def http_response(status: int, data=None, headers=None):
     try:
         if data is None:
             data = ""
@@ -91,11 +242,11 @@ def http_response(status: int, data=None):
             "message": STATUS.get(status, "Unknown status"),
             "data": data
         }
-        # google cloud expects a tuple
+        # google cloud expects a tuple, and a 304 has no body
         response = (
-            json.dumps(response_data),
+            "" if status == 304 else json.dumps(response_data),
             status, 
-            {"Content-Type": "application/json"}
+            {"Content-Type": "application/json", **(headers or {})}
         )
         logging.debug(f"Raw response data: {response}")
         return response
@@ -107,22 +258,69 @@ def http_response(status: int, data=None):
             {"Content-Type": "application/json"}
         )
     
+
 # GET /routes
-def get_routes(query_params=None):
+def get_routes(query_params=None, request_headers=None):
     routes = get_routes_collection()
     query = routes
-    docs = []
 
-    # query params not implemented yet
     if query_params:
-        return NotImplementedError()
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"limit", "start_after", "fields"}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+    fields = parse_fields(query_params, ROUTE_FIELDS)
+    if fields is None:
+        return http_response(400)
+    query = select_fields(query, fields)
+
+    page = paginate(query, query_params)
+    if page is None:
+        return http_response(400)
+    query, limit = page
     
     try:
-        docs = list(query.stream())
-        query_result = [doc.to_dict() for doc in docs]
+        return http_stream_response(200, "routes", query.stream(), limit, request_headers, [fields, (query_params or {}).get("start_after", "")])
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /routes/export
+def export_routes(query_params=None):
+    if query_params:
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"format", "gzip", "after"}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+    export = parse_export_params(query_params)
+    if export is None:
+        return http_response(400)
+    export_format, compress, after = export
+
+    try:
+        return http_export_response("routes", get_routes_collection(), export_format, compress, after, fields=ROUTE_FIELDS)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /routes/count
+def count_routes(query_params=None):
+    try:
+        query = get_routes_collection()
+
+        if query_params:
+            # account for unsupported query parameters
+            unsupported = set(query_params)
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
 
         data = {
-            "routes": query_result
+            "routeCount": count_documents([query])
         }
 
         return http_response(200, data)
@@ -132,34 +330,34 @@ def get_routes(query_params=None):
 
 # DELETE /routes
 def delete_routes(query_params=None):
+    global _network, _network_built_at
     try:
         db = get_db()
         routes = get_routes_collection()
         query = routes
 
-        # query params not implemented yet
         if query_params:
-            return NotImplementedError()
-        
-        docs = list(query.stream())
-
-        batch = db.batch()
-        deleted_ids = []
+            # account for unsupported query parameters
+            unsupported = set(query_params) - {"sample"}
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
 
-        for i, doc in enumerate(docs):
-            batch.delete(doc.reference)
-            deleted_ids.append(doc.id)
+        sample_size = parse_sample_size(query_params)
+        if sample_size is None:
+            return http_response(400)
 
-            # commit every 500 deletes for batch deleting
-            if (i + 1) % 500 == 0:
-                batch.commit()
-                batch = db.batch()
-        # commit remaining deletes
-        if len(docs) % 500 != 0:
-            batch.commit()
+        deleted_count, deleted_ids = bulk_delete(db, [query], sample_size)
+        # the stop index only holds route IDs, so it is cleared along with the routes
+        bulk_delete(db, [get_stops_collection()])
+        # every route is gone, so the cached network starts over empty
+        with _network_lock:
+            if _network is not None:
+                _network = TransitNetwork()
+                _network_built_at = time.monotonic()
         
         data = {
-            "deletedRouteCount": len(deleted_ids),
+            "deletedRouteCount": deleted_count,
             "deletedRouteIds": deleted_ids
         }
 
@@ -168,92 +366,206 @@ def delete_routes(query_params=None):
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
+# utility function to validate and normalize a new route
+# returns the route to store and None, or None and the reason the route is invalid
+def validate_route(data, user=None):
+    if not isinstance(data, dict):
+        return None, f"Route is of type {type(data)}, must be an object"
+
+    # account for missing fields
+    if not data.get("name"):
+        return None, "Missing 'name' in request body"
+    if not data.get("stops"):
+        return None, "Missing 'stops' in request body"
+    if not data.get("active"):
+        return None, "Missing 'active' in request body"
+    
+    # account for invalid fields
+    # normalize route name
+    name = normalize_name(data["name"]) if isinstance(data["name"], str) else None
+    # invalid name
+    if name is None:
+        return None, f"Invalid route name: {data['name']}. Cannot contain special characters or underscores."
+    # normalize each stop in the list
+    stops = normalize_stops(data["stops"])
+    # invalid stops
+    if stops is None:
+        return None, f"Invalid stops: {data['stops']}. Must be an array of stop names without special characters or underscores."
+    # invalid active status
+    if not isinstance(data["active"], bool):
+        return None, f"Invalid active status: {data['active']}. Must be a boolean"
+
+    route = dict(data)
+    route["name"] = name
+    route["stops"] = stops
+    # routes are created by the signed-in user, if the request has an access token
+    route["createdBy"] = user.get("sub") if user else "test_user_id"
+    return route, None
+
 # POST /routes
-def create_route(data):
+def create_route(data, user=None):
     try:
         routes = get_routes_collection()
-        query = routes
 
-        # account for missing fields
-        if not data.get("name"):
-            logging.error(f"Missing 'name' in request body")
-            return http_response(400)
-        if not data.get("stops"):
-            logging.error(f"Missing 'stops' in request body")
-            return http_response(400)
-        if not data.get("active"):
-            logging.error(f"Missing 'active' in request body")
-            return http_response(400)
-        
-        # normalize route name
-        name = data["name"].strip()
-        name = re.sub(r"\s+", " ", name)
-        name = name.title()
-
-        # account for invalid fields
-        # invalid name
-        if re.match(r"^[A-Za-z0-9\s-]+$", name) is None:
-            logging.error(f"Invalid route name: {name}. Cannot contain special characters or underscores.")
-            return http_response(400)
-        # invalid stops
-        if isinstance(data["stops"], list):
-            # normalize each stop in the list
-            for stop in data["stops"]:
-                if isinstance(stop, str):
-                    stop = stop.strip()
-                    stop = re.sub(r"\s+", " ", stop)
-                    stop = stop.title()
-
-                    if re.match(r"^[A-Za-z0-9\s-]+$", stop) is None:
-                        logging.error(f"Invalid stop name: {stop}. Cannot contain special characters or underscores.")
-                        return http_response(400)
-                else:
-                    logging.error(f"Stop must be a string")
-                    return http_response(400)
-        else:
-            logging.error(f"Field 'stops' is of type {type(data['stops'])}, must be array of strings")
-            return http_response(400)
-        # invalid active status
-        if not isinstance(data["active"], bool):
-            logging.error(f"Invalid active status: {data['active']}. Must be a boolean")
+        route, error = validate_route(data, user)
+        if error:
+            logging.error(error)
             return http_response(400)
         
-        # create new route
+        # create new route and index its stops in one batch
         doc = routes.document()
-        route_id = doc.id
         # id is automatically generated
-        data["id"] = route_id
-        data["name"] = name
-        # TODO: generate createdBy with authentication
-        data["createdBy"] = "test_user_id"
-        doc.set(data)
+        route["id"] = doc.id
+        batch = get_db().batch()
+        batch.set(doc, route)
+        index_route_stops(batch, doc.id, added_stops=route["stops"])
+        batch.commit()
+        update_network(doc.id, route["stops"])
 
         return http_response(201)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
+# POST /routes:import
+def import_routes(data, user=None):
+    try:
+        db = get_db()
+        routes = get_routes_collection()
+
+        # accept a GTFS feed, {"routes": [...]} or a bare array of routes
+        if isinstance(data, dict) and "gtfs" in data:
+            try:
+                rows = parse_gtfs_files(data["gtfs"])
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                logging.error(f"Invalid GTFS feed: {e}")
+                return http_response(400)
+        elif isinstance(data, dict):
+            rows = data.get("routes")
+        else:
+            rows = data
+
+        if not isinstance(rows, list) or len(rows) == 0:
+            logging.error(f"Field 'routes' is of type {type(rows)}, must be a non-empty array of routes")
+            return http_response(400)
+        if len(rows) > MAX_IMPORT_ROUTES:
+            logging.error(f"Too many routes: {len(rows)}. Import at most {MAX_IMPORT_ROUTES} routes per request")
+            return http_response(400)
+
+        # validate every row with the same rules as POST /routes, keeping the valid ones
+        errors = []
+        writes = []
+        for row, row_data in enumerate(rows):
+            route, error = validate_route(row_data, user)
+            if error:
+                errors.append({"row": row, "error": error})
+                continue
+            doc = routes.document()
+            # id is automatically generated
+            route["id"] = doc.id
+            writes.append((row, doc, route))
+
+        # commit every 500 writes as a batch, with batches committed in parallel
+        chunks = [writes[i:i + BATCH_SIZE] for i in range(0, len(writes), BATCH_SIZE)]
+
+        def commit(chunk):
+            batch = db.batch()
+            for _, doc, route in chunk:
+                batch.set(doc, route)
+            batch.commit()
+
+        imported = []
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(IMPORT_WORKERS, len(chunks))) as executor:
+                futures = {executor.submit(commit, chunk): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    try:
+                        future.result()
+                        imported.extend((row, route["id"]) for row, _, route in chunk)
+                        for _, _, route in chunk:
+                            update_network(route["id"], route["stops"])
+                    except Exception as e:
+                        logging.error(f"Failed to commit batch of {len(chunk)} routes: {e}")
+                        errors.extend({"row": row, "error": f"Write failed: {e}"} for row, _, _ in chunk)
+
+        # index the stops of the imported routes, one write per stop however many
+        # routes serve it, so popular stops don't become hot documents
+        imported_ids = {route_id for _, route_id in imported}
+        stop_routes = {}
+        for _, _, route in writes:
+            if route["id"] in imported_ids:
+                for stop in route["stops"]:
+                    stop_routes.setdefault(stop, set()).add(route["id"])
+        index_chunks = [list(stop_routes.items())[i:i + BATCH_SIZE] for i in range(0, len(stop_routes), BATCH_SIZE)]
+
+        def commit_index(chunk):
+            from google.cloud.firestore import ArrayUnion
+            stops = get_stops_collection()
+            batch = db.batch()
+            for stop, route_ids in chunk:
+                batch.set(stops.document(stop), {"name": stop, "routes": ArrayUnion(sorted(route_ids))}, merge=True)
+            batch.commit()
+
+        # the routes are already stored, so a failed index batch is reported next to
+        # them instead of failing the request, and scripts/rebuild_stop_index.py repairs it
+        index_errors = []
+        if index_chunks:
+            with ThreadPoolExecutor(max_workers=min(IMPORT_WORKERS, len(index_chunks))) as executor:
+                futures = {executor.submit(commit_index, chunk): chunk for chunk in index_chunks}
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Failed to commit index batch of {len(chunk)} stops: {e}")
+                        index_errors.append({
+                            "stops": [stop for stop, _ in chunk],
+                            "routeIds": sorted(set().union(*(route_ids for _, route_ids in chunk))),
+                            "error": f"Index write failed: {e}"
+                        })
+
+        imported.sort()
+        errors.sort(key=lambda error: error["row"])
+        index_errors.sort(key=lambda error: error["stops"][0])
+        data = {
+            "importedRouteCount": len(imported),
+            "importedRouteIds": [route_id for _, route_id in imported],
+            "errors": errors,
+            "indexErrors": index_errors
+        }
+
+        return http_response(200, data)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
 # GET /routes/{id}
-def get_route(route_id):
+def get_route(route_id, query_params=None, request_headers=None):
     routes = get_routes_collection()
-    query = routes
-    docs = []
     
     try:
-        docs = list(query.where("id", "==", route_id).stream())
-        if not docs:
+        if not isinstance(route_id, str) or route_id == "":
+            logging.error(f"Invalid route ID: {route_id}, must be string")
+            return http_response(404)
+        fields = parse_fields(query_params, ROUTE_FIELDS)
+        if fields is None:
+            return http_response(400)
+        # route IDs are stored as the document ID, so look it up directly
+        doc = get_document(routes.document(route_id), fields)
+        if not doc.exists:
             logging.error(f"Route with ID {route_id} not found")
             return http_response(404)
-        # check if more than one route with the same ID exists
-        if len(docs) > 1:
-            logging.error(f"Multiple routes with ID {route_id} found")
-            return http_response(500)
         
+        headers = validator_headers([doc], single=True, variant=fields)
+        if not_modified(request_headers, headers):
+            return http_response(304, headers=headers)
+
         data = {
-            "route": docs[0].to_dict()
+            "route": doc.to_dict()
         }
 
-        return http_response(200, data)
+        return http_response(200, data, headers)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
@@ -262,8 +574,6 @@ def get_route(route_id):
 def update_route(route_id, data):
     try:
         routes = get_routes_collection()
-        db = get_db()
-        query = routes
 
         updates = {}
         
@@ -275,36 +585,18 @@ def update_route(route_id, data):
                 logging.error(f"Invalid route name: {data['name']}, must be string")
                 return http_response(400)
             # normalize route name
-            name = data["name"].strip()
-            name = re.sub(r"\s+", " ", name)
-            name = name.title()
-
+            name = normalize_name(data["name"])
             # invalid name
-            if re.match(r"^[A-Za-z0-9\s-]+$", name) is None:
-                logging.error(f"Invalid route name: {name}. Cannot contain special characters or underscores.")
+            if name is None:
+                logging.error(f"Invalid route name: {data['name']}. Cannot contain special characters or underscores.")
                 return http_response(400)
             updates.update({"name": name})
         
         if "stops" in data.keys():
+            # normalize each stop in the list
+            normalized_stops = normalize_stops(data["stops"])
             # invalid stops
-            if isinstance(data["stops"], list) and len(data["stops"]) > 0:
-                # normalize each stop in the list
-                normalized_stops = []
-                for bus_stop in data["stops"]:
-                    if isinstance(bus_stop, str) and bus_stop != "":
-                        bus_stop = bus_stop.strip()
-                        bus_stop = re.sub(r"\s+", " ", bus_stop)
-                        bus_stop = bus_stop.title()
-
-                        if re.match(r"^[A-Za-z0-9\s-]+$", bus_stop) is None:
-                            logging.error(f"Invalid stop name: {bus_stop}. Cannot contain special characters or underscores.")
-                            return http_response(400)
-                    else:
-                        logging.error(f"Stop must be a string")
-                        return http_response(400)
-                    normalized_stops.append(bus_stop)
-            else:
-                logging.error(f"Field 'stops' is of type {type(data['stops'])}, must be array of strings")
+            if normalized_stops is None:
                 return http_response(400)
             updates.update({"stops": normalized_stops})
             
@@ -315,17 +607,42 @@ def update_route(route_id, data):
                 return http_response(400)
             updates.update({"active": data["active"]})
         
-        docs = list(query.where("id", "==", route_id).stream())
-        if not docs:
+        route_ref = routes.document(route_id)
+        if "stops" in updates:
+            # the previous stops are needed to update the stop index
+            doc = route_ref.get()
+            if not doc.exists:
+                logging.error(f"Route with ID {route_id} not found")
+                return http_response(404)
+            previous = doc.to_dict()
+            previous_stops = previous.get("stops", [])
+
+            # update route and its stop index entries in one batch
+            batch = get_db().batch()
+            batch.update(route_ref, updates)
+            index_route_stops(
+                batch,
+                route_id,
+                added_stops=set(updates["stops"]) - set(previous_stops),
+                removed_stops=set(previous_stops) - set(updates["stops"])
+            )
+            batch.commit()
+            update_network(route_id, updates["stops"] if updates.get("active", previous.get("active")) else None)
+            return http_response(200)
+
+        # update route, update() fails if the document doesn't exist
+        from google.api_core.exceptions import NotFound
+        try:
+            route_ref.update(updates)
+        except NotFound:
             logging.error(f"Route with ID {route_id} not found")
             return http_response(404)
-        if len(docs) > 1:
-            logging.error(f"Multiple routes with ID {route_id} found")
-            return http_response(500)
 
-        # update route
-        route_ref = db.collection("routes").document(docs[0].id)
-        route_ref.update(updates)
+        # reactivated routes need their stops to rejoin the cached network
+        if updates.get("active") and _network is not None:
+            update_network(route_id, route_ref.get().to_dict().get("stops", []))
+        elif "active" in updates:
+            update_network(route_id)
 
         return http_response(200)
     except Exception as e:
@@ -336,25 +653,92 @@ def update_route(route_id, data):
 def delete_route(route_id):
     try:
         routes = get_routes_collection()
-        query = routes
-        docs = []
 
         if not isinstance(route_id, str) or route_id == "":
             logging.error(f"Invalid route ID: {route_id}, must be string")
             return http_response(404)
-        docs = list(query.where("id", "==", route_id).stream())
-        if not docs:
+        # the route's stops are needed to update the stop index
+        route_ref = routes.document(route_id)
+        doc = route_ref.get()
+        if not doc.exists:
             logging.error(f"Route with ID {route_id} not found")
             return http_response(404)
-        # check if more than one route with the same ID exists
-        if len(docs) > 1:
-            logging.error(f"Multiple routes with ID {route_id} found")
-            return http_response(500)
 
-        doc = docs[0]
-        doc.reference.delete()
+        # delete route and its stop index entries in one batch
+        batch = get_db().batch()
+        batch.delete(route_ref)
+        index_route_stops(batch, route_id, removed_stops=doc.to_dict().get("stops", []))
+        batch.commit()
+        update_network(route_id)
 
         return http_response(200)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
-        return http_response(500)
\ No newline at end of file
+        return http_response(500)
+
+# GET /stops/{name}/routes
+def get_stop_routes(stop_name):
+    stops = get_stops_collection()
+
+    try:
+        # stops are indexed by normalized name
+        name = normalize_name(stop_name) if isinstance(stop_name, str) else None
+        if name is None:
+            logging.error(f"Invalid stop name: {stop_name}. Cannot contain special characters or underscores.")
+            return http_response(404)
+
+        doc = stops.document(name).get()
+        if not doc.exists:
+            logging.error(f"Stop {name} not found")
+            return http_response(404)
+
+        data = {
+            "stop": name,
+            "routeIds": doc.to_dict().get("routes", [])
+        }
+
+        return http_response(200, data)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /routes/plan?from={stop}&to={stop}
+def plan_trip(query_params=None):
+    try:
+        query_params = query_params or {}
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"from", "to"}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+        # stops are stored by normalized name
+        stops = []
+        for param in ("from", "to"):
+            value = query_params.get(param)
+            name = normalize_name(value) if isinstance(value, str) else None
+            if name is None:
+                logging.error(f"Invalid '{param}' stop: {value}. Must be a stop name without special characters or underscores.")
+                return http_response(400)
+            stops.append(name)
+        origin, destination = stops
+
+        network = get_network()
+        with _network_lock:
+            legs = network.plan(origin, destination)
+        if legs is None:
+            logging.error(f"No trip found from {origin} to {destination}")
+            return http_response(404)
+
+        data = {
+            "from": origin,
+            "to": destination,
+            "transfers": max(len(legs) - 1, 0),
+            "stopCount": sum(len(leg["stops"]) - 1 for leg in legs),
+            "legs": legs
+        }
+
+        return http_response(200, data)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
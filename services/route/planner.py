@@ -0,0 +1,110 @@
+from array import array
+
+# in-memory transit graph built from the routes collection, used to plan trips
+# stops are interned to integers, each route is an array of stop numbers, and each
+# stop keeps the (route, position) pairs where routes serve it
+# routes are treated as running in both directions along their stops
+class TransitNetwork:
+    def __init__(self):
+        # stop name <-> stop number
+        self.stop_numbers = {}
+        self.stop_names = []
+        # stop number -> list of (route slot, position in route)
+        self.stop_routes = []
+        # route slot -> route ID and stop numbers, None once the route is removed
+        self.route_ids = []
+        self.route_stops = []
+        # route ID -> route slot
+        self.route_slots = {}
+
+    def __len__(self):
+        return len(self.route_slots)
+
+    def _stop_number(self, name):
+        number = self.stop_numbers.get(name)
+        if number is None:
+            number = len(self.stop_names)
+            self.stop_numbers[name] = number
+            self.stop_names.append(name)
+            self.stop_routes.append([])
+        return number
+
+    def add_route(self, route_id, stops):
+        self.remove_route(route_id)
+        if not stops:
+            return
+
+        slot = len(self.route_ids)
+        numbers = array("i", (self._stop_number(stop) for stop in stops))
+        self.route_ids.append(route_id)
+        self.route_stops.append(numbers)
+        self.route_slots[route_id] = slot
+        for position, number in enumerate(numbers):
+            self.stop_routes[number].append((slot, position))
+
+    def remove_route(self, route_id):
+        slot = self.route_slots.pop(route_id, None)
+        if slot is None:
+            return
+
+        for number in set(self.route_stops[slot]):
+            self.stop_routes[number] = [entry for entry in self.stop_routes[number] if entry[0] != slot]
+        self.route_ids[slot] = None
+        self.route_stops[slot] = None
+
+    # find the trip between two stops with the fewest transfers, then the fewest stops
+    # returns a list of legs, each {"routeId": ..., "stops": [...]}, or None if there is no trip
+    def plan(self, origin, destination):
+        start = self.stop_numbers.get(origin)
+        end = self.stop_numbers.get(destination)
+        if start is None or end is None:
+            return None
+        if start == end:
+            return []
+
+        # rounds of rides: the kth round holds the stops reached with k rides in fewer
+        # stops than before, as stop -> (stops ridden, route slot, board position, alight position)
+        best = {start: 0}
+        rounds = [{start: None}]
+        while rounds[-1]:
+            improved = {}
+            # only routes serving a stop reached in the last round can improve anything
+            slots = {slot for number in rounds[-1] for slot, _ in self.stop_routes[number]}
+            for slot in slots:
+                stops = self.route_stops[slot]
+                # scan the route once in each direction, boarding wherever it's cheapest
+                for positions in (range(len(stops)), range(len(stops) - 1, -1, -1)):
+                    cost = None
+                    for position in positions:
+                        number = stops[position]
+                        if cost is not None:
+                            cost += 1
+                            if cost < best.get(number, cost + 1) and (number not in improved or cost < improved[number][0]):
+                                improved[number] = (cost, slot, board, position)
+                        label = best.get(number)
+                        if label is not None and (cost is None or label < cost):
+                            cost, board = label, position
+
+            rounds.append(improved)
+            if end in improved:
+                return self._legs(end, rounds)
+            for number, (cost, _, _, _) in improved.items():
+                best[number] = cost
+
+        return None
+
+    def _legs(self, number, rounds):
+        legs = []
+        ride = len(rounds) - 1
+        while ride > 0:
+            _, slot, board, alight = rounds[ride][number]
+            step = 1 if alight > board else -1
+            stops = self.route_stops[slot][board:alight + step if alight + step >= 0 else None:step]
+            legs.append({"routeId": self.route_ids[slot], "stops": [self.stop_names[stop] for stop in stops]})
+            # continue from the boarding stop, in the latest earlier round that reached it
+            number = self.route_stops[slot][board]
+            ride -= 1
+            while number not in rounds[ride]:
+                ride -= 1
+        legs.reverse()
+        return legs
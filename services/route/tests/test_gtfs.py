@@ -0,0 +1,34 @@
+import pytest
+from gtfs import parse_gtfs_files
+
+FEED = {
+    "routes.txt": "\ufeffroute_id,route_short_name,route_long_name\nR1,1,Main Line\nR2,2,\n",
+    "stops.txt": "stop_id,stop_name\nS1,First Street\nS2,Second Street\nS3,Third Street\n",
+    "trips.txt": "route_id,service_id,trip_id\nR1,WK,T1\nR1,WK,T2\nR2,WK,T3\n",
+    "stop_times.txt": (
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "T1,08:00:00,08:00:00,S1,1\n"
+        "T2,09:10:00,09:10:00,S3,3\n"
+        "T2,09:00:00,09:00:00,S1,1\n"
+        "T2,09:05:00,09:05:00,S2,2\n"
+        "T3,10:00:00,10:00:00,S2,1\n"
+    )
+}
+
+# parse_gtfs_files tests
+def test_parse_gtfs_files_success():
+    routes = parse_gtfs_files(FEED)
+
+    assert routes == [
+        # stops come from the route's longest trip, in stop_sequence order
+        {"name": "Main Line", "stops": ["First Street", "Second Street", "Third Street"], "active": True},
+        # falls back to the short name
+        {"name": "2", "stops": ["Second Street"], "active": True}
+    ]
+
+def test_parse_gtfs_files_missing_file_fail():
+    feed = dict(FEED)
+    del feed["stop_times.txt"]
+
+    with pytest.raises(KeyError):
+        parse_gtfs_files(feed)
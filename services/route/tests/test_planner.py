@@ -0,0 +1,62 @@
+import pytest
+from planner import TransitNetwork
+
+@pytest.fixture
+def network():
+    network = TransitNetwork()
+    # A and B cross at C, D is a long way round from A to E without transferring
+    network.add_route("A", ["Stop 1", "Stop 2", "Stop 3"])
+    network.add_route("B", ["Stop 4", "Stop 3", "Stop 5"])
+    network.add_route("D", ["Stop 1", "Stop 6", "Stop 7", "Stop 8", "Stop 5"])
+    return network
+
+# plan tests
+def test_plan_fewest_transfers_success(network):
+    legs = network.plan("Stop 1", "Stop 5")
+
+    # the direct route wins over the shorter trip with a transfer
+    assert legs == [{"routeId": "D", "stops": ["Stop 1", "Stop 6", "Stop 7", "Stop 8", "Stop 5"]}]
+
+def test_plan_transfer_success(network):
+    legs = network.plan("Stop 2", "Stop 4")
+
+    assert legs == [
+        {"routeId": "A", "stops": ["Stop 2", "Stop 3"]},
+        {"routeId": "B", "stops": ["Stop 3", "Stop 4"]}
+    ]
+
+def test_plan_reverse_direction_success(network):
+    legs = network.plan("Stop 3", "Stop 1")
+
+    assert legs == [{"routeId": "A", "stops": ["Stop 3", "Stop 2", "Stop 1"]}]
+
+def test_plan_same_stop_success(network):
+    assert network.plan("Stop 1", "Stop 1") == []
+
+@pytest.mark.parametrize("origin, destination", [("Stop 1", "Unknown Stop"), ("Unknown Stop", "Stop 1")])
+def test_plan_unknown_stop_fail(network, origin, destination):
+    assert network.plan(origin, destination) is None
+
+# add_route and remove_route tests
+def test_remove_route_success(network):
+    network.remove_route("D")
+
+    assert len(network) == 2
+    # falls back to the trip with a transfer
+    assert network.plan("Stop 1", "Stop 5") == [
+        {"routeId": "A", "stops": ["Stop 1", "Stop 2", "Stop 3"]},
+        {"routeId": "B", "stops": ["Stop 3", "Stop 5"]}
+    ]
+
+def test_remove_route_disconnects_fail(network):
+    network.remove_route("B")
+    network.remove_route("D")
+
+    assert network.plan("Stop 1", "Stop 5") is None
+
+def test_add_route_replaces_stops_success(network):
+    network.add_route("A", ["Stop 1", "Stop 9"])
+
+    assert len(network) == 3
+    assert network.plan("Stop 9", "Stop 1") == [{"routeId": "A", "stops": ["Stop 9", "Stop 1"]}]
+    assert network.plan("Stop 2", "Stop 1") is None
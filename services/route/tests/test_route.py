@@ -1,7 +1,16 @@
 import pytest
-from unittest.mock import MagicMock, patch
-from main import get_routes, delete_routes, create_route, get_route, update_route, delete_route
+from unittest.mock import ANY, MagicMock, patch
+from google.api_core.exceptions import NotFound
+from main import get_routes, count_routes, delete_routes, create_route, import_routes, get_route, update_route, delete_route, get_stop_routes
 import json
+from datetime import datetime, timezone
+import base64
+import threading
+import os
+import subprocess
+import sys
+import main
+import tokens
 
 # get_routes tests
 @patch("main.get_routes_collection")
@@ -25,28 +34,252 @@ def test_get_routes_success(mock_routes_collection):
         json.dumps({
             "message": "OK",
             "data": {
-                "routes": [route]
+                "routes": [route],
+                "nextPageToken": ""
             }
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_route_doc]
+    mock_query.order_by.return_value.limit.return_value.stream.return_value = [mock_route_doc]
     mock_routes_collection.return_value = mock_query
     
+    response = get_routes()
+    # list responses are streamed
+    body = "".join(response[0])
+
+    assert (body, *response[1:]) == expected
+
+@patch("main.get_routes_collection")
+def test_get_routes_not_modified_success(mock_routes_collection):
+    mock_route_doc = MagicMock(id="1", update_time=datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc))
+    mock_route_doc.to_dict.return_value = {"id": "1"}
+
+    # mock query behavior
+    mock_page = mock_routes_collection.return_value.order_by.return_value.limit.return_value
+    mock_page.stream.return_value = [mock_route_doc]
+
+    etag = get_routes()[2]["ETag"]
+    response = get_routes(None, {"If-None-Match": etag})
+
+    # the page hasn't changed, so it is sent as a 304 with no body
+    assert response == ("", 304, {"Content-Type": "application/json", "ETag": etag})
+
+    # a new route on the page changes its tag
+    mock_page.stream.return_value = [mock_route_doc, MagicMock(id="2", update_time=datetime(2024, 5, 2, tzinfo=timezone.utc))]
+    response = get_routes(None, {"If-None-Match": etag})
+
+    assert response[1] == 200
+    assert response[2]["ETag"] != etag
+
+@patch("main.get_routes_collection")
+def test_get_routes_next_page_success(mock_routes_collection):
+    mock_docs = []
+    for doc_id in ["a", "b", "c"]:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_doc.to_dict.return_value = {"id": doc_id}
+        mock_docs.append(mock_doc)
+
+    mock_query = MagicMock()
+    mock_page = mock_query.order_by.return_value.start_after.return_value.limit.return_value
+    mock_page.stream.return_value = mock_docs
+    mock_routes_collection.return_value = mock_query
+
+    start_after = base64.urlsafe_b64encode(b"0").decode()
+    response = get_routes({"limit": "2", "start_after": start_after})
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    assert body["data"]["routes"] == [{"id": "a"}, {"id": "b"}]
+    assert base64.urlsafe_b64decode(body["data"]["nextPageToken"]).decode() == "b"
+    mock_query.order_by.return_value.start_after.assert_called_once_with({"__name__": "0"})
+    # one extra document is fetched to detect the next page
+    mock_query.order_by.return_value.start_after.return_value.limit.assert_called_once_with(3)
+
+@patch("main.get_routes_collection")
+def test_get_routes_empty_success(mock_routes_collection):
+    mock_query = MagicMock()
+    mock_query.order_by.return_value.limit.return_value.stream.return_value = iter([])
+    mock_routes_collection.return_value = mock_query
+
+    response = get_routes()
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    assert body == {"message": "OK", "data": {"routes": [], "nextPageToken": ""}}
+
+@patch("main.get_routes_collection")
+def test_get_routes_fields_success(mock_routes_collection):
+    mock_route_doc = MagicMock()
+    mock_route_doc.to_dict.return_value = {"id": "1", "name": "Sample Route"}
+    mock_query = mock_routes_collection.return_value
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_route_doc]
+
+    response = get_routes({"fields": "id,name"})
+
+    assert json.loads("".join(response[0]))["data"]["routes"] == [{"id": "1", "name": "Sample Route"}]
+    # stops aren't read when they aren't asked for
+    mock_query.select.assert_called_once_with(["id", "name"])
+
+@patch("main.get_routes_collection")
+def test_get_routes_query_error_fail(mock_routes_collection):
+    mock_query = MagicMock()
+    mock_query.order_by.return_value.limit.return_value.stream.side_effect = Exception("missing index")
+    mock_routes_collection.return_value = mock_query
+
+    expected = (
+        json.dumps({
+            "message": "Internal Server Error",
+            "data": ""
+        }),
+        500,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
     response = get_routes()
 
     assert response == expected
 
+@pytest.mark.parametrize("invalid_data", [
+    {"limit": "abc"},
+    {"limit": "0"},
+    {"limit": "5.5"},
+    {"limit": "100000"},
+    {"start_after": None},
+    {"start_after": "not_base64"},
+    {"start_after": "MA==!!"},
+    {"start_after": ""},
+    {"start_after": base64.urlsafe_b64encode(b"routes/1").decode()},
+    {"sort": "name"},
+    {"fields": ""},
+    {"fields": "name,color"}
+])
+@patch("main.get_routes_collection")
+def test_get_routes_invalid_query_params_fail(mock_routes_collection, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = get_routes(invalid_data)
+
+    assert response == expected
+
+# export_routes tests
+@patch("main.get_routes_collection")
+def test_export_routes_success(mock_routes_collection):
+    mock_doc = MagicMock()
+    mock_doc.id = "2"
+    mock_doc.to_dict.return_value = {"id": "2", "name": "Sample Route", "stops": ["Stop 1", "Stop 2"], "createdBy": "test_user_id", "active": True}
+    mock_page = mock_routes_collection.return_value.order_by.return_value.start_after.return_value
+    mock_page.limit.return_value.stream.return_value = [mock_doc]
+
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/routes/export"
+    request.args = {"after": "1"}
+    request.headers = {}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 200
+    assert [json.loads(line) for line in "".join(response[0]).splitlines()] == [mock_doc.to_dict.return_value]
+    # the export resumes after the last route received
+    mock_routes_collection.return_value.order_by.return_value.start_after.assert_called_once_with({"__name__": "1"})
+
+@pytest.mark.parametrize("invalid_data", [
+    {"format": "xml"},
+    {"gzip": "1"},
+    {"limit": "10"}
+])
+@patch("main.get_routes_collection")
+def test_export_routes_invalid_query_params_fail(mock_routes_collection, invalid_data):
+    response = main.export_routes(invalid_data)
+
+    assert response[1] == 400
+
+# count_routes tests
+@patch("main.get_routes_collection")
+def test_count_routes_success(mock_routes_collection):
+    mock_count = mock_routes_collection.return_value.count.return_value
+    mock_count.get.return_value = [[MagicMock(value=12)]]
+
+    response = count_routes()
+
+    assert json.loads(response[0]) == {"message": "OK", "data": {"routeCount": 12}}
+    # one aggregation query, no documents read
+    mock_routes_collection.return_value.count.assert_called_once_with(alias="count")
+    mock_routes_collection.return_value.stream.assert_not_called()
+
+@patch("main.get_routes_collection")
+def test_count_routes_invalid_query_params_fail(mock_routes_collection):
+    response = count_routes({"active": "true"})
+
+    assert response[1] == 400
+
+@patch("main.count_routes")
+def test_request_handler_count_success(mock_count):
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/routes/count"
+    request.args = {}
+    request.headers = {}
+
+    main.request_handler(request)
+
+    # "count" isn't taken as a route ID
+    mock_count.assert_called_once_with({})
+
+@patch("main.count_routes")
+def test_request_handler_invalid_token_fail(mock_count, monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+    header, payload, signature = tokens.issue_token("1", "user").split(".")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/routes/count"
+    request.args = {}
+    request.headers = {"Authorization": f"Bearer {header}.{payload}.{signature[::-1]}"}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 401
+    mock_count.assert_not_called()
+
+@pytest.mark.parametrize("authorization", ["Bearer not.a.token", "Basic dXNlcjpwYXNz"])
+@patch("main.count_routes")
+def test_request_handler_foreign_token_success(mock_count, monkeypatch, authorization):
+    # tokens someone else issued, like IAM ID tokens, leave the request anonymous
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/routes/count"
+    request.args = {}
+    request.headers = {"Authorization": authorization}
+
+    main.request_handler(request)
+
+    mock_count.assert_called_once_with({})
+
 # delete_routes tests
+@patch("main.get_stops_collection")
 @patch("main.get_db")
 @patch("main.get_routes_collection")
-def test_delete_routes_success(mock_routes_collection, mock_get_db):
+def test_delete_routes_success(mock_routes_collection, mock_get_db, mock_stops_collection):
     # mock doc for a sample route
     route = {
         "id": "1",
@@ -65,7 +298,8 @@ def test_delete_routes_success(mock_routes_collection, mock_get_db):
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_route_doc]
+    # one page, shorter than a full batch
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_route_doc]
     mock_routes_collection.return_value = mock_query
 
     # mock db and batch
@@ -93,8 +327,10 @@ def test_delete_routes_success(mock_routes_collection, mock_get_db):
     assert response == expected
 
 # create_route tests
+@patch("main.get_stops_collection")
+@patch("main.get_db")
 @patch("main.get_routes_collection")
-def test_create_route_success(mock_routes_collection):
+def test_create_route_success(mock_routes_collection, mock_get_db, mock_stops_collection):
     route = {
         "name": "Sample Route",
         "stops": [
@@ -119,12 +355,51 @@ def test_create_route_success(mock_routes_collection):
     mock_routes = MagicMock()
     mock_routes_collection.return_value = mock_routes
 
+    # mock batch
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+
     # mock request data
     data = route
 
     response = create_route(data)
 
     assert response == expected
+    # the route and its three stop index entries are written together
+    assert mock_batch.set.call_count == 4
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_stops_collection")
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_create_route_normalizes_stops(mock_routes_collection, mock_get_db, mock_stops_collection):
+    mock_routes = MagicMock()
+    mock_routes_collection.return_value = mock_routes
+
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+
+    response = create_route({"name": " sample  route", "stops": ["stop 1", "  stop   2"], "active": True})
+    stored = mock_batch.set.call_args_list[0][0][1]
+
+    assert response[1] == 201
+    assert stored["name"] == "Sample Route"
+    assert stored["stops"] == ["Stop 1", "Stop 2"]
+
+
+@patch("main.get_stops_collection")
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_create_route_signed_in_success(mock_routes_collection, mock_get_db, mock_stops_collection):
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+
+    # claims of the request's access token
+    response = create_route({"name": "Sample Route", "stops": ["Stop 1"], "active": True}, {"sub": "user-1", "type": "admin"})
+    stored = mock_batch.set.call_args_list[0][0][1]
+
+    assert response[1] == 201
+    assert stored["createdBy"] == "user-1"
 
 @pytest.mark.parametrize("invalid_data", [
     {
@@ -279,6 +554,129 @@ def test_create_route_invalid_active_status_fail(mock_routes_collection, invalid
 
     assert response == expected
 
+# import_routes tests
+@patch("main.get_stops_collection")
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_import_routes_success(mock_routes_collection, mock_get_db, mock_stops_collection):
+    routes = [
+        {"name": "route 1", "stops": ["stop 1", "stop 2"], "active": True},
+        {"name": "route_2", "stops": ["stop 1"], "active": True},
+        {"name": "route 3", "stops": ["stop 3"], "active": True}
+    ]
+
+    mock_docs = []
+    for doc_id in ["a", "b"]:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_docs.append(mock_doc)
+    mock_routes = MagicMock()
+    mock_routes.document.side_effect = mock_docs
+    mock_routes_collection.return_value = mock_routes
+
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+
+    response = import_routes(routes)
+    body = json.loads(response[0])
+
+    assert response[1] == 200
+    assert body["data"]["importedRouteCount"] == 2
+    assert body["data"]["importedRouteIds"] == ["a", "b"]
+    # invalid rows are reported, valid rows are still written
+    assert [error["row"] for error in body["data"]["errors"]] == [1]
+    # one batch for the two routes, one for the index entries of their three stops
+    assert mock_batch.set.call_count == 5
+    assert mock_batch.commit.call_count == 2
+
+@patch("main.get_stops_collection")
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_import_routes_gtfs_success(mock_routes_collection, mock_get_db, mock_stops_collection):
+    feed = {
+        "routes.txt": "route_id,route_short_name,route_long_name\nR1,1,Main Line\n",
+        "stops.txt": "stop_id,stop_name\nS1,First Street\nS2,Second Street\n",
+        "trips.txt": "route_id,service_id,trip_id\nR1,WK,T1\n",
+        "stop_times.txt": "trip_id,stop_id,stop_sequence\nT1,S2,2\nT1,S1,1\n"
+    }
+
+    mock_routes = MagicMock()
+    mock_routes.document.return_value.id = "a"
+    mock_routes_collection.return_value = mock_routes
+
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+
+    response = import_routes({"gtfs": feed})
+    stored = mock_batch.set.call_args_list[0][0][1]
+
+    assert response[1] == 200
+    assert stored["name"] == "Main Line"
+    assert stored["stops"] == ["First Street", "Second Street"]
+
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_import_routes_failed_batch_reported(mock_routes_collection, mock_get_db):
+    mock_routes = MagicMock()
+    mock_routes.document.return_value.id = "a"
+    mock_routes_collection.return_value = mock_routes
+
+    mock_get_db.return_value.batch.return_value.commit.side_effect = Exception("deadline exceeded")
+
+    response = import_routes({"routes": [{"name": "route 1", "stops": ["stop 1"], "active": True}]})
+    body = json.loads(response[0])
+
+    assert response[1] == 200
+    assert body["data"]["importedRouteCount"] == 0
+    assert body["data"]["errors"][0]["row"] == 0
+
+@patch("main.get_stops_collection")
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_import_routes_failed_index_batch_reported(mock_routes_collection, mock_get_db, mock_stops_collection):
+    mock_routes = MagicMock()
+    mock_routes.document.return_value.id = "a"
+    mock_routes_collection.return_value = mock_routes
+
+    # the route batch commits, the index batch after it fails
+    mock_get_db.return_value.batch.return_value.commit.side_effect = [None, Exception("deadline exceeded")]
+
+    response = import_routes({"routes": [{"name": "route 1", "stops": ["stop 1", "stop 2"], "active": True}]})
+    body = json.loads(response[0])
+
+    # the stored route is still reported, so it isn't imported again
+    assert response[1] == 200
+    assert body["data"]["importedRouteIds"] == ["a"]
+    assert body["data"]["errors"] == []
+    assert body["data"]["indexErrors"] == [
+        {"stops": ["Stop 1", "Stop 2"], "routeIds": ["a"], "error": "Index write failed: deadline exceeded"}
+    ]
+
+@pytest.mark.parametrize("invalid_data", [
+    {},
+    [],
+    {"routes": "route 1"},
+    {"gtfs": {"routes.txt": ""}},
+    {"gtfs": "feed.zip"}
+])
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_import_routes_invalid_body_fail(mock_routes_collection, mock_get_db, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = import_routes(invalid_data)
+
+    assert response == expected
+
 # get_route tests
 @patch("main.get_routes_collection")
 def test_get_route_success(mock_routes_collection):
@@ -297,11 +695,8 @@ def test_get_route_success(mock_routes_collection):
     mock_route_doc = MagicMock()
     mock_route_doc.to_dict.return_value = route
 
-    mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_route_doc]
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value = mock_route_doc
 
     mock_routes_collection.return_value = mock_collection
 
@@ -314,7 +709,8 @@ def test_get_route_success(mock_routes_collection):
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
     
@@ -323,13 +719,60 @@ def test_get_route_success(mock_routes_collection):
     assert response == expected
 
 @patch("main.get_routes_collection")
+def test_get_route_fields_success(mock_routes_collection):
+    mock_reference = mock_routes_collection.return_value.document.return_value
+    mock_reference.get.return_value.to_dict.return_value = {"name": "Sample Route", "active": True}
+
+    response = get_route("1", {"fields": "name,active"})
+
+    assert json.loads(response[0])["data"] == {"route": {"name": "Sample Route", "active": True}}
+    mock_reference.get.assert_called_once_with(field_paths=["name", "active"])
+
+@patch("main.get_routes_collection")
+def test_get_route_not_modified_success(mock_routes_collection):
+    mock_route_doc = mock_routes_collection.return_value.document.return_value.get.return_value
+    mock_route_doc.id = "1"
+    mock_route_doc.to_dict.return_value = {"id": "1"}
+    mock_route_doc.update_time = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+    headers = get_route("1")[2]
+    assert headers["Last-Modified"] == "Wed, 01 May 2024 12:30:00 GMT"
+
+    # the client's copy is current, so it gets a 304 with no body
+    for request_headers in ({"If-None-Match": headers["ETag"]}, {"If-Modified-Since": headers["Last-Modified"]}):
+        assert get_route("1", None, request_headers) == ("", 304, headers)
+
+    # the route changed since, so it is sent again
+    mock_route_doc.update_time = datetime(2024, 5, 1, 12, 31, tzinfo=timezone.utc)
+    response = get_route("1", None, {"If-None-Match": headers["ETag"]})
+
+    assert response[1] == 200
+    assert json.loads(response[0])["data"] == {"route": {"id": "1"}}
+
+@patch("main.get_routes_collection")
+def test_get_route_fields_etag_success(mock_routes_collection):
+    mock_route_doc = mock_routes_collection.return_value.document.return_value.get.return_value
+    mock_route_doc.id = "1"
+    mock_route_doc.to_dict.return_value = {"name": "Main Line"}
+    mock_route_doc.update_time = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+    etag = get_route("1")[2]["ETag"]
+    response = get_route("1", {"fields": "name"}, {"If-None-Match": etag})
+
+    # the full route's tag doesn't match the projected body
+    assert response[1] == 200
+    assert response[2]["ETag"] != etag
+
+@patch("main.get_routes_collection")
+def test_get_route_invalid_fields_fail(mock_routes_collection):
+    response = get_route("1", {"fields": "color"})
+
+    assert response[1] == 400
+@patch("main.get_routes_collection")
 @pytest.mark.parametrize("invalid_data", ["", 0, None])
 def test_get_route_invalid_id_fail(mock_routes_collection, invalid_data):
-    mock_query = MagicMock()
-    mock_query.stream.return_value = []
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value.exists = False
 
     mock_routes_collection.return_value = mock_collection
     
@@ -358,20 +801,10 @@ def test_update_route_success(mock_routes_collection, mock_get_db):
         "name": "Sample Route"
     }
 
-    mock_route_doc = MagicMock()
-
-    # mock query
-    mock_query = MagicMock()
-    mock_query.where.return_value.stream.return_value = [mock_route_doc]
-    mock_routes_collection.return_value = mock_query
-
     mock_route_doc_ref = MagicMock()
     mock_collection = MagicMock()
-    mock_collection.return_value = mock_route_doc_ref
-
-    mock_db = MagicMock()
-    mock_db.collection.return_value = mock_collection
-    mock_get_db.return_value = mock_db
+    mock_collection.document.return_value = mock_route_doc_ref
+    mock_routes_collection.return_value = mock_collection
 
     expected = (
         json.dumps({
@@ -387,6 +820,57 @@ def test_update_route_success(mock_routes_collection, mock_get_db):
     response = update_route(route_id, data)
 
     assert response == expected
+    mock_collection.document.assert_called_once_with(route_id)
+    mock_route_doc_ref.update.assert_called_once_with({"name": "Sample Route"})
+
+@patch("main.get_stops_collection")
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_update_route_stops_updates_index(mock_routes_collection, mock_get_db, mock_stops_collection):
+    route_id = "1"
+
+    mock_route_doc_ref = MagicMock()
+    mock_route_doc_ref.get.return_value.to_dict.return_value = {"id": route_id, "stops": ["Stop 1", "Stop 2"]}
+    mock_collection = MagicMock()
+    mock_collection.document.return_value = mock_route_doc_ref
+    mock_routes_collection.return_value = mock_collection
+
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
+
+    mock_stops = MagicMock()
+    mock_stops.document.side_effect = lambda name: name
+    mock_stops_collection.return_value = mock_stops
+
+    response = update_route(route_id, {"stops": ["stop 2", "stop 3"]})
+
+    assert response[1] == 200
+    mock_batch.update.assert_called_once_with(mock_route_doc_ref, {"stops": ["Stop 2", "Stop 3"]})
+    # only the stops that changed are touched in the index
+    assert sorted(call[0][0] for call in mock_batch.set.call_args_list) == ["Stop 1", "Stop 3"]
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_update_route_not_found_fail(mock_routes_collection, mock_get_db):
+    mock_collection = MagicMock()
+    mock_collection.document.return_value.update.side_effect = NotFound("No document to update")
+    mock_routes_collection.return_value = mock_collection
+
+    expected = (
+        json.dumps({
+            "message": "Not Found",
+            "data": ""
+        }),
+        404,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = update_route("missing", {"name": "Sample Route"})
+
+    assert response == expected
 
 @patch("main.get_db")
 @patch("main.get_routes_collection")
@@ -535,17 +1019,20 @@ def test_update_route_invalid_active_status_fail(mock_routes_collection, mock_ge
     assert response == expected
 
 # delete_route tests
+@patch("main.get_stops_collection")
+@patch("main.get_db")
 @patch("main.get_routes_collection")
-def test_delete_route_success(mock_routes_collection):
+def test_delete_route_success(mock_routes_collection, mock_get_db, mock_stops_collection):
     route_id = "1"
     
     mock_doc_ref = MagicMock()
-    mock_doc = MagicMock()
-    mock_doc.reference = mock_doc_ref
+    mock_doc_ref.get.return_value.to_dict.return_value = {"id": route_id, "stops": ["Stop 1", "Stop 2"]}
+    mock_collection = MagicMock()
+    mock_collection.document.return_value = mock_doc_ref
+    mock_routes_collection.return_value = mock_collection
 
-    mock_query = MagicMock()
-    mock_query.where.return_value.stream.return_value = [mock_doc]
-    mock_routes_collection.return_value = mock_query
+    mock_batch = MagicMock()
+    mock_get_db.return_value.batch.return_value = mock_batch
 
     expected = (
         json.dumps({
@@ -561,15 +1048,39 @@ def test_delete_route_success(mock_routes_collection):
     response = delete_route(route_id)
 
     assert response == expected
+    mock_collection.document.assert_called_once_with(route_id)
+    mock_batch.delete.assert_called_once_with(mock_doc_ref)
+    # the route is removed from both stops' index entries
+    assert mock_batch.set.call_count == 2
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_db")
+@patch("main.get_routes_collection")
+def test_delete_route_not_found_fail(mock_routes_collection, mock_get_db):
+    mock_collection = MagicMock()
+    mock_collection.document.return_value.get.return_value.exists = False
+    mock_routes_collection.return_value = mock_collection
+
+    expected = (
+        json.dumps({
+            "message": "Not Found",
+            "data": ""
+        }),
+        404,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = delete_route("missing")
+
+    assert response == expected
 
 @patch("main.get_routes_collection")
 @pytest.mark.parametrize("invalid_data", [0, None, ""])
 def test_delete_route_invalid_id_fail(mock_routes_collection, invalid_data):
-    mock_query = MagicMock()
-    mock_query.stream.return_value = []
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value.exists = False
 
     mock_routes_collection.return_value = mock_collection
     
@@ -586,4 +1097,200 @@ def test_delete_route_invalid_id_fail(mock_routes_collection, invalid_data):
 
     response = delete_route(invalid_data)
 
-    assert response == expected
\ No newline at end of file
+    assert response == expected
+
+# get_db tests
+@patch("google.cloud.firestore.Client")
+def test_get_db_reuses_client(mock_client, monkeypatch):
+    monkeypatch.setattr(main, "_db", None)
+    monkeypatch.setattr(main, "_routes_collection", None)
+
+    # simulate concurrent cold requests
+    threads = [threading.Thread(target=main.get_routes_collection) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert main.get_db() is main.get_db()
+    assert main.get_routes_collection() is main.get_routes_collection()
+    mock_client.assert_called_once()
+
+# cold start tests
+def test_import_defers_heavy_dependencies():
+    # import main in a fresh interpreter, like a cold start would
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main; print([m for m in ('google.cloud.firestore',) if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], cwd=service_dir, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
+
+# get_stop_routes tests
+@patch("main.get_stops_collection")
+def test_get_stop_routes_success(mock_stops_collection):
+    mock_stop_doc = MagicMock()
+    mock_stop_doc.to_dict.return_value = {"name": "Main St", "routes": ["1", "2"]}
+
+    mock_collection = MagicMock()
+    mock_collection.document.return_value.get.return_value = mock_stop_doc
+    mock_stops_collection.return_value = mock_collection
+
+    expected = (
+        json.dumps({
+            "message": "OK",
+            "data": {
+                "stop": "Main St",
+                "routeIds": ["1", "2"]
+            }
+        }),
+        200,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = get_stop_routes("  main  st")
+
+    assert response == expected
+    # stops are looked up by normalized name
+    mock_collection.document.assert_called_once_with("Main St")
+
+@patch("main.get_stops_collection")
+@pytest.mark.parametrize("invalid_data", ["", "main_st", None, "Unknown Stop"])
+def test_get_stop_routes_not_found_fail(mock_stops_collection, invalid_data):
+    mock_collection = MagicMock()
+    mock_collection.document.return_value.get.return_value.exists = False
+    mock_stops_collection.return_value = mock_collection
+
+    expected = (
+        json.dumps({
+            "message": "Not Found",
+            "data": ""
+        }),
+        404,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = get_stop_routes(invalid_data)
+
+    assert response == expected
+
+# plan_trip tests
+@pytest.fixture
+def mock_network(monkeypatch):
+    # cached network built from two active routes crossing at Stop 3, and one inactive route
+    docs = []
+    for route_id, stops, active in [
+        ("1", ["Stop 1", "Stop 2", "Stop 3"], True),
+        ("2", ["Stop 4", "Stop 3", "Stop 5"], True),
+        ("3", ["Stop 1", "Stop 5"], False)
+    ]:
+        mock_route_doc = MagicMock()
+        mock_route_doc.id = route_id
+        mock_route_doc.to_dict.return_value = {"id": route_id, "stops": stops, "active": active}
+        docs.append(mock_route_doc)
+
+    mock_collection = MagicMock()
+    mock_collection.stream.return_value = docs
+    monkeypatch.setattr(main, "_network", None)
+    monkeypatch.setattr(main, "get_routes_collection", MagicMock(return_value=mock_collection))
+    return mock_collection
+
+def test_plan_trip_success(mock_network):
+    expected = (
+        json.dumps({
+            "message": "OK",
+            "data": {
+                "from": "Stop 1",
+                "to": "Stop 5",
+                "transfers": 1,
+                "stopCount": 3,
+                "legs": [
+                    {"routeId": "1", "stops": ["Stop 1", "Stop 2", "Stop 3"]},
+                    {"routeId": "2", "stops": ["Stop 3", "Stop 5"]}
+                ]
+            }
+        }),
+        200,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = main.plan_trip({"from": "stop  1", "to": " stop 5"})
+
+    # the inactive direct route is left out of the network
+    assert response == expected
+    # the network is built once and reused
+    main.plan_trip({"from": "Stop 5", "to": "Stop 1"})
+    mock_network.stream.assert_called_once()
+
+def test_plan_trip_request_handler_success(mock_network):
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/routes/plan"
+    request.args = {"from": "Stop 2", "to": "Stop 3"}
+    request.headers = {}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 200
+    assert json.loads(response[0])["data"]["legs"] == [{"routeId": "1", "stops": ["Stop 2", "Stop 3"]}]
+
+def test_plan_trip_cache_updated_on_delete(mock_network):
+    main.plan_trip({"from": "Stop 1", "to": "Stop 5"})
+
+    mock_route_doc = MagicMock()
+    mock_route_doc.to_dict.return_value = {"stops": ["Stop 4", "Stop 3", "Stop 5"]}
+    mock_network.document.return_value.get.return_value = mock_route_doc
+    with patch("main.get_db"), patch("main.get_stops_collection"):
+        assert delete_route("2")[1] == 200
+
+    response = main.plan_trip({"from": "Stop 1", "to": "Stop 5"})
+
+    assert response[1] == 404
+    mock_network.stream.assert_called_once()
+
+def test_plan_trip_cache_cleared_on_delete_all(mock_network):
+    main.plan_trip({"from": "Stop 1", "to": "Stop 5"})
+
+    with patch("main.get_db"), patch("main.get_stops_collection"):
+        assert delete_routes()[1] == 200
+
+    response = main.plan_trip({"from": "Stop 1", "to": "Stop 2"})
+
+    assert response[1] == 404
+    mock_network.stream.assert_called_once()
+
+@pytest.mark.parametrize("invalid_data", [
+    {},
+    {"from": "Stop 1"},
+    {"from": "Stop_1", "to": "Stop 5"},
+    {"from": "Stop 1", "to": "Stop 5", "via": "Stop 3"}
+])
+def test_plan_trip_invalid_query_params_fail(mock_network, invalid_data):
+    expected = (
+        json.dumps({
+            "message": "Bad Request",
+            "data": ""
+        }),
+        400,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = main.plan_trip(invalid_data)
+
+    assert response == expected
+
+@pytest.mark.parametrize("invalid_data", [
+    {"from": "Stop 1", "to": "Unknown Stop"},
+    {"from": "Unknown Stop", "to": "Stop 1"}
+])
+def test_plan_trip_not_found_fail(mock_network, invalid_data):
+    response = main.plan_trip(invalid_data)
+
+    assert response[1] == 404
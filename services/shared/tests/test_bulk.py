@@ -0,0 +1,144 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from google.api_core.exceptions import DeadlineExceeded, NotFound, PermissionDenied
+import bulk
+from bulk import bulk_delete, commit_with_backoff, parse_sample_size
+
+def make_docs(doc_ids):
+    docs = []
+    for doc_id in doc_ids:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        docs.append(mock_doc)
+    return docs
+
+# a query whose pages are served in document ID order from docs
+def make_query(docs):
+    query = MagicMock()
+    ordered = query.select.return_value.order_by.return_value
+
+    def page(after=None):
+        mock_page = MagicMock()
+        def limit(count):
+            mock_limited = MagicMock()
+            mock_limited.stream.side_effect = lambda: iter([doc for doc in docs if after is None or doc.id > after][:count])
+            return mock_limited
+        mock_page.limit.side_effect = limit
+        return mock_page
+
+    ordered.limit.side_effect = page().limit
+    ordered.start_after.side_effect = lambda cursor: page(cursor["__name__"])
+    return query
+
+# parse_sample_size tests
+@pytest.mark.parametrize("query_params, expected", [
+    ({}, bulk.DEFAULT_DELETED_ID_SAMPLE),
+    ({"sample": "0"}, 0),
+    ({"sample": "1000"}, 1000)
+])
+def test_parse_sample_size_success(query_params, expected):
+    assert parse_sample_size(query_params) == expected
+
+@pytest.mark.parametrize("invalid_data", ["-1", "1001", "ten", ""])
+def test_parse_sample_size_invalid_fail(invalid_data):
+    assert parse_sample_size({"sample": invalid_data}) is None
+
+# bulk_delete tests
+def test_bulk_delete_pages_success(monkeypatch):
+    monkeypatch.setattr(bulk, "BATCH_SIZE", 2)
+    docs = make_docs(["a", "b", "c", "d", "e"])
+    query = make_query(docs)
+    mock_db = MagicMock()
+
+    deleted, sample = bulk_delete(mock_db, [query], sample_size=3)
+
+    assert deleted == 5
+    # the sample is truncated, and holds the first IDs in document ID order
+    assert sample == ["a", "b", "c"]
+    # one batch per page, each page starting after the previous one
+    assert mock_db.batch.return_value.commit.call_count == 3
+    assert [call.args[0] for call in query.select.return_value.order_by.return_value.start_after.call_args_list] == [{"__name__": "b"}, {"__name__": "d"}]
+    assert mock_db.batch.return_value.delete.call_count == 5
+
+def test_bulk_delete_extra_writes_success(monkeypatch):
+    monkeypatch.setattr(bulk, "BATCH_SIZE", 6)
+    query = make_query(make_docs(["a", "b", "c"]))
+    mock_db = MagicMock()
+    write = MagicMock()
+
+    deleted, _ = bulk_delete(mock_db, [query], fields=["count"], write=write, writes_per_doc=3)
+
+    assert deleted == 3
+    query.select.assert_called_with(["count"])
+    # two documents with their extra writes fill a batch
+    assert mock_db.batch.return_value.commit.call_count == 2
+    assert write.call_count == 3
+    mock_db.write_option.assert_called_once_with(exists=True)
+
+def test_bulk_delete_concurrently_deleted_success():
+    docs = make_docs(["a", "b", "c"])
+    query = make_query(docs)
+    mock_db = MagicMock()
+    mock_batches = [MagicMock(), MagicMock()]
+    mock_db.batch.side_effect = mock_batches
+    # another request deletes b first, so the first commit fails its preconditions
+    mock_batches[0].commit.side_effect = NotFound("gone")
+    mock_db.get_all.side_effect = lambda references, field_paths=None: [MagicMock(id=doc.id, exists=doc.id != "b") for doc in docs]
+    write = MagicMock()
+
+    deleted, sample = bulk_delete(mock_db, [query], sample_size=3, write=write, writes_per_doc=2)
+
+    # the page is retried without b, which is left out of the count and the sample
+    assert (deleted, sample) == (2, ["a", "c"])
+    assert [call.args[0] for call in mock_batches[1].delete.call_args_list] == [docs[0].reference, docs[2].reference]
+    assert [call.args[1] for call in write.call_args_list[3:]] == [docs[0], docs[2]]
+    mock_batches[1].commit.assert_called_once()
+
+def test_bulk_delete_commit_error_fail():
+    query = make_query(make_docs(["a"]))
+    mock_db = MagicMock()
+    mock_db.batch.return_value.commit.side_effect = PermissionDenied("denied")
+
+    with pytest.raises(PermissionDenied):
+        bulk_delete(mock_db, [query])
+
+# commit_with_backoff tests
+@patch("bulk.time.sleep")
+def test_commit_with_backoff_retries_success(mock_sleep):
+    mock_batch = MagicMock()
+    mock_batch.commit.side_effect = [DeadlineExceeded("timeout"), DeadlineExceeded("timeout"), None]
+
+    commit_with_backoff(mock_batch)
+
+    assert mock_batch.commit.call_count == 3
+    # the wait doubles between retries
+    delays = [call.args[0] for call in mock_sleep.call_args_list]
+    assert bulk.DELETE_BACKOFF / 2 <= delays[0] <= bulk.DELETE_BACKOFF
+    assert bulk.DELETE_BACKOFF <= delays[1] <= 2 * bulk.DELETE_BACKOFF
+
+@patch("bulk.time.sleep")
+def test_commit_with_backoff_gives_up_fail(mock_sleep):
+    mock_batch = MagicMock()
+    mock_batch.commit.side_effect = DeadlineExceeded("timeout")
+
+    with pytest.raises(DeadlineExceeded):
+        commit_with_backoff(mock_batch)
+
+    assert mock_batch.commit.call_count == bulk.DELETE_RETRIES + 1
+
+@patch("bulk.time.sleep")
+def test_commit_with_backoff_committed_retry_success(mock_sleep):
+    mock_batch = MagicMock()
+    # the first attempt timed out after committing, so its retry fails its preconditions
+    mock_batch.commit.side_effect = [DeadlineExceeded("timeout"), NotFound("gone")]
+
+    commit_with_backoff(mock_batch)
+
+    assert mock_batch.commit.call_count == 2
+
+def test_commit_with_backoff_not_found_fail():
+    mock_batch = MagicMock()
+    mock_batch.commit.side_effect = NotFound("gone")
+
+    with pytest.raises(NotFound):
+        commit_with_backoff(mock_batch)
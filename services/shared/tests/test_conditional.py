@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock
+from datetime import datetime, timezone
+from conditional import entity_tag, not_modified, validator_headers
+
+UPDATE_TIME = datetime(2024, 5, 1, 12, 30, 15, 250000, tzinfo=timezone.utc)
+
+def make_doc(doc_id, data, update_time=None):
+    doc = MagicMock()
+    doc.id = doc_id
+    doc.to_dict.return_value = data
+    doc.update_time = update_time
+    return doc
+
+# entity_tag tests
+def test_entity_tag_success():
+    doc = make_doc("1", {"id": "1"}, UPDATE_TIME)
+    tag = entity_tag([doc])
+
+    # strong and stable for the same version
+    assert tag.startswith('"') and tag.endswith('"')
+    assert entity_tag([make_doc("1", {"id": "1", "name": "changed"}, UPDATE_TIME)]) == tag
+    # a new update time, another document or another order all change it
+    assert entity_tag([make_doc("1", {"id": "1"}, UPDATE_TIME.replace(microsecond=0))]) != tag
+    other = make_doc("2", {"id": "2"}, UPDATE_TIME)
+    assert entity_tag([doc, other]) != entity_tag([other, doc])
+
+def test_entity_tag_content_success():
+    # documents without an update time are tagged by their content
+    assert entity_tag([make_doc("1", {"a": 1, "b": 2})]) == entity_tag([make_doc("1", {"b": 2, "a": 1})])
+    assert entity_tag([make_doc("1", {"a": 1})]) != entity_tag([make_doc("1", {"a": 2})])
+
+def test_entity_tag_variant_success():
+    # the same document projected onto other fields is another representation
+    doc = make_doc("1", {"id": "1"}, UPDATE_TIME)
+
+    assert entity_tag([doc], ["name"]) != entity_tag([doc])
+    assert entity_tag([doc], ["name"]) != entity_tag([doc], ["id", "name"])
+    assert validator_headers([doc], single=True, variant=["name"])["ETag"] == entity_tag([doc], ["name"])
+
+# validator_headers and not_modified tests
+def test_validator_headers_success():
+    doc = make_doc("1", {"id": "1"}, UPDATE_TIME)
+
+    assert validator_headers([doc], single=True)["Last-Modified"] == "Wed, 01 May 2024 12:30:15 GMT"
+    assert "Last-Modified" not in validator_headers([doc])
+    assert "Last-Modified" not in validator_headers([make_doc("1", {"id": "1"})], single=True)
+
+def test_not_modified_success():
+    headers = validator_headers([make_doc("1", {"id": "1"}, UPDATE_TIME)], single=True)
+    etag = headers["ETag"]
+
+    assert not_modified({"If-None-Match": etag}, headers)
+    assert not_modified({"If-None-Match": f'"other", W/{etag}'}, headers)
+    assert not_modified({"If-None-Match": "*"}, headers)
+    assert not_modified({"If-Modified-Since": "Wed, 01 May 2024 12:30:15 GMT"}, headers)
+    assert not_modified({"If-Modified-Since": "Thu, 02 May 2024 00:00:00 GMT"}, headers)
+
+def test_not_modified_fail():
+    headers = validator_headers([make_doc("1", {"id": "1"}, UPDATE_TIME)], single=True)
+
+    assert not not_modified(None, headers)
+    assert not not_modified({}, headers)
+    assert not not_modified({"If-None-Match": '"other"'}, headers)
+    assert not not_modified({"If-Modified-Since": "Wed, 01 May 2024 12:30:14 GMT"}, headers)
+    assert not not_modified({"If-Modified-Since": "yesterday"}, headers)
+    # If-None-Match wins over If-Modified-Since
+    assert not not_modified({"If-None-Match": '"other"', "If-Modified-Since": "Thu, 02 May 2024 00:00:00 GMT"}, headers)
+    # lists have no Last-Modified
+    assert not not_modified({"If-Modified-Since": "Thu, 02 May 2024 00:00:00 GMT"}, validator_headers([make_doc("1", {})]))
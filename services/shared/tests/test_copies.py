@@ -0,0 +1,18 @@
+import os
+import sys
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "..", "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+from sync_shared_modules import SHARED_MODULES, stale_copies
+
+# every service deploys its own copy of the shared modules, which must not drift
+def test_shared_module_copies_success():
+    stale = [os.path.relpath(path, os.path.join(SCRIPTS_DIR, "..")) for path, _ in stale_copies()]
+
+    assert stale == [], "run scripts/sync_shared_modules.py"
+
+def test_shared_modules_listed_success():
+    # every shared module is copied somewhere
+    shared_dir = os.path.join(os.path.dirname(__file__), "..")
+    assert sorted(SHARED_MODULES) == sorted(name for name in os.listdir(shared_dir) if name.endswith(".py"))
@@ -0,0 +1,98 @@
+import gzip
+import json
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+from export import export_documents, http_export_response, parse_export_params
+
+def make_docs(doc_ids, **fields):
+    docs = []
+    for doc_id in doc_ids:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_doc.to_dict.return_value = {"id": doc_id, **fields}
+        docs.append(mock_doc)
+    return docs
+
+# a query whose pages are served in document ID order from docs
+def make_query(docs):
+    query = MagicMock()
+    ordered = query.order_by.return_value
+
+    def page(after=None):
+        mock_page = MagicMock()
+        def limit(count):
+            mock_limited = MagicMock()
+            mock_limited.stream.side_effect = lambda: iter([doc for doc in docs if after is None or doc.id > after][:count])
+            return mock_limited
+        mock_page.limit.side_effect = limit
+        return mock_page
+
+    ordered.limit.side_effect = page().limit
+    ordered.start_after.side_effect = lambda cursor: page(cursor["__name__"])
+    return query
+
+# parse_export_params tests
+@pytest.mark.parametrize("query_params, expected", [
+    ({}, ("ndjson", False, None)),
+    ({"format": "csv", "gzip": "true", "after": "abc"}, ("csv", True, "abc"))
+])
+def test_parse_export_params_success(query_params, expected):
+    assert parse_export_params(query_params) == expected
+
+@pytest.mark.parametrize("invalid_data", [
+    {"format": "xml"},
+    {"gzip": "yes"},
+    {"after": "2024-01-05/abc"}
+])
+def test_parse_export_params_invalid_fail(invalid_data):
+    assert parse_export_params(invalid_data) is None
+
+# export_documents tests
+def test_export_documents_pages_success():
+    query = make_query(make_docs(["a", "b", "c", "d", "e"]))
+
+    docs = list(export_documents(query, page_size=2))
+
+    assert [doc.id for doc in docs] == ["a", "b", "c", "d", "e"]
+    # each page starts after the last document of the previous one
+    assert [call.args[0] for call in query.order_by.return_value.start_after.call_args_list] == [{"__name__": "b"}, {"__name__": "d"}]
+
+def test_export_documents_resumes_success():
+    query = make_query(make_docs(["a", "b", "c"]))
+
+    assert [doc.id for doc in export_documents(query, after="a")] == ["b", "c"]
+
+# http_export_response tests
+def test_http_export_response_ndjson_success():
+    query = make_query(make_docs(["a", "b"], secret="hash"))
+
+    response = http_export_response("items", query, "ndjson", omit=["secret"])
+
+    assert [json.loads(line) for line in "".join(response[0]).splitlines()] == [{"id": "a"}, {"id": "b"}]
+    assert response[1:] == (200, {"Content-Type": "application/x-ndjson", "Content-Disposition": 'attachment; filename="items.ndjson"'})
+
+def test_http_export_response_csv_success():
+    docs = make_docs(["a"], tags=["x", "y"], active=True, seen=datetime(2024, 1, 5, 8, 15, tzinfo=timezone.utc), secret="hash")
+    query = make_query(docs)
+
+    response = http_export_response("items", query, "csv", fields=["id", "tags", "active", "seen", "missing", "secret"], omit=["secret"])
+
+    assert "".join(response[0]) == 'id,tags,active,seen,missing\r\na,"[""x"", ""y""]",true,2024-01-05T08:15:00+00:00,\r\n'
+    assert response[2]["Content-Type"] == "text/csv"
+
+def test_http_export_response_gzip_success():
+    query = make_query(make_docs(["a", "b"]))
+
+    response = http_export_response("items", query, "ndjson", compress=True)
+
+    assert gzip.decompress(b"".join(response[0])).decode() == '{"id": "a"}\n{"id": "b"}\n'
+    assert response[2] == {"Content-Type": "application/gzip", "Content-Disposition": 'attachment; filename="items.ndjson.gz"'}
+
+def test_http_export_response_query_error_fail():
+    query = MagicMock()
+    query.order_by.return_value.limit.return_value.stream.side_effect = Exception("Query error")
+
+    # the first page is read before the response starts, so the caller can return a 500
+    with pytest.raises(Exception):
+        http_export_response("items", query, "ndjson")
@@ -0,0 +1,36 @@
+import pytest
+from unittest.mock import MagicMock
+from fields import get_document, parse_fields, select_fields
+
+ALLOWED = ["id", "name", "stops"]
+
+# parse_fields tests
+def test_parse_fields_default_success():
+    assert parse_fields(None, ALLOWED) == []
+    assert parse_fields({"limit": "10"}, ALLOWED, default=["id", "name"]) == ["id", "name"]
+
+def test_parse_fields_success():
+    # whitespace and repeated fields are ignored, order is kept
+    assert parse_fields({"fields": " name, id,name "}, ALLOWED) == ["name", "id"]
+
+@pytest.mark.parametrize("invalid_data", ["", ",", " , ", "password", "id,password", "id.name"])
+def test_parse_fields_invalid_fail(invalid_data):
+    assert parse_fields({"fields": invalid_data}, ALLOWED) is None
+
+# select_fields and get_document tests
+def test_select_fields_success():
+    query = MagicMock()
+
+    assert select_fields(query, ["id"]) is query.select.return_value
+    query.select.assert_called_once_with(["id"])
+    # no fields leaves the query whole
+    assert select_fields(query, []) is query
+
+def test_get_document_success():
+    reference = MagicMock()
+
+    get_document(reference, ["id", "name"])
+    get_document(reference, [])
+
+    assert reference.get.call_args_list[0].kwargs == {"field_paths": ["id", "name"]}
+    assert reference.get.call_args_list[1].kwargs == {}
@@ -0,0 +1,30 @@
+import pytest
+from normalize import normalize_name, normalize_stops
+
+# normalize_name tests
+@pytest.mark.parametrize("name, expected", [
+    ("sample route", "Sample Route"),
+    ("  main   st\tstation ", "Main St Station"),
+    ("route 12-b", "Route 12-B")
+])
+def test_normalize_name_success(name, expected):
+    assert normalize_name(name) == expected
+
+@pytest.mark.parametrize("name", ["", "   ", "some_name", "somename!"])
+def test_normalize_name_invalid_fail(name):
+    assert normalize_name(name) is None
+
+def test_normalize_name_cached():
+    normalize_name.cache_clear()
+    normalize_name("cached stop")
+    normalize_name("cached stop")
+
+    assert normalize_name.cache_info().hits == 1
+
+# normalize_stops tests
+def test_normalize_stops_success():
+    assert normalize_stops(["stop 1", " stop  2 "]) == ["Stop 1", "Stop 2"]
+
+@pytest.mark.parametrize("stops", [None, "", [], [None], [""], ["stop 1", "stop_2"], [1, 2]])
+def test_normalize_stops_invalid_fail(stops):
+    assert normalize_stops(stops) is None
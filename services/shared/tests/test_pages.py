@@ -0,0 +1,82 @@
+import pytest
+from unittest.mock import MagicMock
+from datetime import datetime, timezone
+import base64
+import json
+from pages import MAX_PAGE_SIZE, count_documents, decode_page_token, http_stream_response, paginate
+
+# utility function to mock a document with an ID and data
+def mock_doc(doc_id, data=None):
+    doc = MagicMock()
+    doc.id = doc_id
+    doc.update_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    doc.to_dict.return_value = data or {"id": doc_id}
+    return doc
+
+# decode_page_token tests
+def test_decode_page_token_success():
+    assert decode_page_token(base64.urlsafe_b64encode(b"a-1").decode()) == "a-1"
+
+@pytest.mark.parametrize("invalid_data", [None, "", "MA==!!", "not base64", base64.b64encode(b"\xff").decode()])
+def test_decode_page_token_invalid_fail(invalid_data):
+    assert decode_page_token(invalid_data) is None
+
+# paginate tests
+def test_paginate_success():
+    query = MagicMock()
+    start_after = base64.urlsafe_b64encode(b"1").decode()
+
+    page, limit = paginate(query, {"limit": "5", "start_after": start_after})
+
+    assert limit == 5
+    # one extra document tells whether there is another page
+    assert page is query.order_by.return_value.start_after.return_value.limit.return_value
+    query.order_by.return_value.start_after.assert_called_once_with({"__name__": "1"})
+    query.order_by.return_value.start_after.return_value.limit.assert_called_once_with(6)
+
+@pytest.mark.parametrize("invalid_data", [
+    {"limit": "0"},
+    {"limit": "-1"},
+    {"limit": str(MAX_PAGE_SIZE + 1)},
+    {"start_after": "MA==!!"},
+    # a cursor that isn't a document ID
+    {"start_after": base64.urlsafe_b64encode(b"reports/1").decode()}
+])
+def test_paginate_invalid_fail(invalid_data):
+    assert paginate(MagicMock(), invalid_data) is None
+
+# count_documents tests
+def test_count_documents_success():
+    queries = [MagicMock(), MagicMock()]
+    for query, count in zip(queries, [3, 4]):
+        query.count.return_value.get.return_value = [[MagicMock(value=count)]]
+
+    assert count_documents(queries) == 7
+
+# http_stream_response tests
+def test_http_stream_response_success():
+    docs = [mock_doc("a"), mock_doc("b"), mock_doc("c")]
+
+    body, status, headers = http_stream_response(200, "items", iter(docs), limit=2)
+
+    data = json.loads("".join(body))
+    assert status == 200
+    assert data["message"] == "OK"
+    assert data["data"]["items"] == [{"id": "a"}, {"id": "b"}]
+    assert base64.urlsafe_b64decode(data["data"]["nextPageToken"]).decode() == "b"
+    assert "ETag" in headers
+
+def test_http_stream_response_default_success():
+    docs = [mock_doc("a", {"created": datetime(2024, 1, 1, tzinfo=timezone.utc)})]
+
+    body, _, _ = http_stream_response(200, "items", iter(docs), default=lambda value: value.isoformat())
+
+    assert json.loads("".join(body))["data"]["items"] == [{"created": "2024-01-01T00:00:00+00:00"}]
+
+def test_http_stream_response_not_modified_success():
+    docs = [mock_doc("a")]
+    _, _, headers = http_stream_response(200, "items", iter(docs), limit=10)
+
+    response = http_stream_response(200, "items", iter(docs), limit=10, request_headers={"If-None-Match": headers["ETag"]})
+
+    assert response == ("", 304, {"Content-Type": "application/json", "ETag": headers["ETag"]})
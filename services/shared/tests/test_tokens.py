@@ -0,0 +1,119 @@
+import pytest
+from unittest.mock import MagicMock
+import tokens
+from tokens import authenticate, issue_token, verify_token
+
+@pytest.fixture(autouse=True)
+def token_secret(monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+
+# issue_token and verify_token tests
+def test_verify_token_success():
+    claims = verify_token(issue_token("1", "admin"))
+
+    assert (claims["sub"], claims["type"], claims["use"]) == ("1", "admin", "access")
+    assert claims["exp"] - claims["iat"] == tokens.ACCESS_TOKEN_TTL
+
+def test_verify_token_refresh_success():
+    claims = verify_token(issue_token("1", "user", use="refresh"), use="refresh")
+
+    assert claims["exp"] - claims["iat"] == tokens.REFRESH_TOKEN_TTL
+
+def test_verify_token_expired_fail(monkeypatch):
+    token = issue_token("1", "user")
+    monkeypatch.setattr(tokens.time, "time", lambda: 2 ** 40)
+
+    assert verify_token(token) is None
+
+def test_verify_token_wrong_use_fail():
+    assert verify_token(issue_token("1", "user", use="refresh")) is None
+
+def test_verify_token_tampered_fail():
+    header, payload, signature = issue_token("1", "user").split(".")
+    forged = tokens._encode(tokens._decode(payload).replace(b'"user"', b'"admin"'))
+
+    assert verify_token(f"{header}.{forged}.{signature}") is None
+
+def test_verify_token_other_secret_fail(monkeypatch):
+    token = issue_token("1", "user")
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "other-secret")
+
+    assert verify_token(token) is None
+
+def test_verify_token_unsigned_fail():
+    # tokens that name another algorithm are never accepted
+    header = tokens._encode(b'{"alg":"none","typ":"JWT"}')
+    _, payload, _ = issue_token("1", "admin").split(".")
+
+    assert verify_token(f"{header}.{payload}.") is None
+
+@pytest.mark.parametrize("invalid_data", [None, "", "abc", "a.b.c", 123])
+def test_verify_token_malformed_fail(invalid_data):
+    assert verify_token(invalid_data) is None
+
+@pytest.mark.parametrize("suffix", ["\u00e9", "\udc80"])
+def test_verify_token_non_ascii_fail(suffix):
+    assert verify_token(issue_token("1", "user") + suffix) is None
+    assert verify_token(issue_token("1", "user", use="refresh") + suffix, use="refresh") is None
+
+def test_issue_token_without_secret_fail(monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "")
+
+    with pytest.raises(RuntimeError):
+        issue_token("1", "user")
+
+# authenticate tests
+def test_authenticate_success():
+    request = MagicMock()
+    request.headers = {"Authorization": f"Bearer {issue_token('1', 'user')}"}
+
+    assert authenticate(request)["sub"] == "1"
+
+def test_authenticate_anonymous_success():
+    request = MagicMock()
+    request.headers = {}
+
+    assert authenticate(request) == {}
+
+# headers of bearer tokens someone else issued, like IAM ID tokens
+ID_TOKEN_HEADER = tokens._encode(b'{"alg":"RS256","kid":"google","typ":"JWT"}')
+OTHER_HS256_HEADER = tokens._encode(b'{"alg":"HS256","typ":"JWT"}')
+
+# other schemes and tokens someone else issued are anonymous
+@pytest.mark.parametrize("foreign_data", [
+    "Bearer abc",
+    "Bearer",
+    "Basic dXNlcjpwYXNz",
+    f"Bearer {ID_TOKEN_HEADER}.e30.c2ln",
+    f"Bearer {OTHER_HS256_HEADER}.e30.c2ln"
+])
+def test_authenticate_foreign_token_anonymous_success(foreign_data):
+    request = MagicMock()
+    request.headers = {"Authorization": foreign_data}
+
+    assert authenticate(request) == {}
+
+def test_authenticate_invalid_fail(monkeypatch):
+    token = issue_token("1", "user")
+    header, payload, signature = token.split(".")
+    request = MagicMock()
+
+    # a token of ours with a bad signature
+    request.headers = {"Authorization": f"Bearer {header}.{payload}.{signature[::-1]}"}
+    assert authenticate(request) is None
+
+    # or with characters base64url doesn't use
+    request.headers = {"Authorization": f"Bearer {token}\u00e9"}
+    assert authenticate(request) is None
+
+    # or an expired one
+    request.headers = {"Authorization": f"Bearer {token}"}
+    monkeypatch.setattr(tokens.time, "time", lambda: 2 ** 40)
+    assert authenticate(request) is None
+
+def test_verify_token_other_issuer_fail():
+    # a token signed with the same secret and header but another issuer
+    claims = tokens._encode(b'{"iss":"other","sub":"1","type":"admin","use":"access","iat":0,"exp":9999999999}')
+    signing_input = f"{tokens.TOKEN_HEADER}.{claims}"
+
+    assert verify_token(f"{signing_input}.{tokens._sign(signing_input)}") is None
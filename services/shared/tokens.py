@@ -0,0 +1,84 @@
+# signed session tokens shared by the map, report, route and user services
+# each service deploys on its own, so services/shared/tokens.py is copied into every
+# service that uses it by scripts/sync_shared_modules.py, whose --check fails if a copy differs
+# tokens are HS256 JSON web tokens signed with FLOW_TOKEN_SECRET, which every service
+# must be deployed with, so any service can verify them without a database read
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+TOKEN_SECRET = os.environ.get("FLOW_TOKEN_SECRET", "")
+
+# seconds an access token and a refresh token are valid for
+ACCESS_TOKEN_TTL = int(os.environ.get("FLOW_ACCESS_TOKEN_TTL", "900"))
+REFRESH_TOKEN_TTL = int(os.environ.get("FLOW_REFRESH_TOKEN_TTL", str(30 * 24 * 3600)))
+
+def _encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _decode(text: str):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+# tokens name this issuer in their header's key ID and their iss claim, which tells
+# them apart from other bearer tokens, like the ID tokens Cloud Functions IAM takes
+TOKEN_ISSUER = "flow"
+# every token has the same header, so verifying only accepts tokens signed this way
+TOKEN_HEADER = _encode(json.dumps({"alg": "HS256", "kid": TOKEN_ISSUER, "typ": "JWT"}, separators=(",", ":")).encode())
+
+def _sign(signing_input: str):
+    return _encode(hmac.new(TOKEN_SECRET.encode(), signing_input.encode(), hashlib.sha256).digest())
+
+# issue an access or refresh token for a user, carrying their ID and account type
+def issue_token(user_id, account_type, use="access"):
+    if not TOKEN_SECRET:
+        raise RuntimeError("FLOW_TOKEN_SECRET is not set")
+    now = int(time.time())
+    claims = {
+        "iss": TOKEN_ISSUER,
+        "sub": user_id,
+        "type": account_type,
+        "use": use,
+        "iat": now,
+        "exp": now + (ACCESS_TOKEN_TTL if use == "access" else REFRESH_TOKEN_TTL)
+    }
+    signing_input = f"{TOKEN_HEADER}.{_encode(json.dumps(claims, separators=(',', ':')).encode())}"
+    return f"{signing_input}.{_sign(signing_input)}"
+
+# verify a token's signature, use and expiry
+# returns its claims, or None if the token is invalid or expired
+def verify_token(token, use="access"):
+    # tokens are base64url, and compare_digest can't compare strings with other characters
+    if not TOKEN_SECRET or not isinstance(token, str) or not token.isascii():
+        return None
+    signing_input, _, signature = token.rpartition(".")
+    header, _, payload = signing_input.partition(".")
+    if header != TOKEN_HEADER or not hmac.compare_digest(signature, _sign(signing_input)):
+        return None
+    try:
+        claims = json.loads(_decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get("iss") != TOKEN_ISSUER or claims.get("use") != use:
+        return None
+    if not isinstance(claims.get("exp"), int) or claims["exp"] <= time.time():
+        return None
+    return claims
+
+# utility function to get the claims of the access token a request carries as
+# "Authorization: Bearer <token>"
+# other schemes and tokens someone else issued are left to whoever checks them,
+# so the request is anonymous here
+# returns {} if there is no token of ours, or None if it is invalid or expired
+def authenticate(request):
+    header = request.headers.get("Authorization", "")
+    scheme, _, token = header.partition(" ")
+    token = token.strip()
+    if scheme.lower() != "bearer" or token.partition(".")[0] != TOKEN_HEADER:
+        if header:
+            logging.debug(f"Authorization is not a Flow access token, the request is anonymous")
+        return {}
+    return verify_token(token)
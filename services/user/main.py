@@ -1,32 +1,133 @@
-from google.cloud import firestore
 import json
 import logging
-import base64
-import bcrypt
+import hashlib
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bulk import bulk_delete, parse_sample_size
+from export import http_export_response, parse_export_params
+from conditional import not_modified, validator_headers
+from pages import count_documents, http_stream_response, paginate
+from fields import get_document, parse_fields, select_fields
+from tokens import ACCESS_TOKEN_TTL, authenticate, issue_token, verify_token
 
 STATUS = {
     200: "OK",
     201: "Created",
+    304: "Not Modified",
     400: "Bad Request",
     401: "Unauthorized",
     404: "Not Found",
     405: "Method Not Allowed",
     409: "Conflict",
-    500: "Internal Server Error"
+    500: "Internal Server Error",
+    503: "Service Unavailable"
 }
 
+# patterns used to validate credentials, compiled once per instance
+EMAIL_PATTERN = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w+$")
+PASSWORD_PATTERN = re.compile(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[^\w\s]).{8,}$")
+
+# bcrypt cost of new password hashes: every step doubles the time to hash and check
+# a password, so pick it for the deployment's hardware with scripts/calibrate_bcrypt.py
+# stored hashes with another cost are rehashed the next time their user logs in
+BCRYPT_ROUNDS = int(os.environ.get("USER_BCRYPT_ROUNDS", "12"))
+if not 4 <= BCRYPT_ROUNDS <= 31:
+    raise ValueError(f"USER_BCRYPT_ROUNDS must be between 4 and 31, not {BCRYPT_ROUNDS}")
+
+# password hashing and checking run on a bounded pool of threads (bcrypt releases
+# the GIL while it works), so a burst of logins can't take every CPU from other
+# requests, and once every worker is busy and PASSWORD_QUEUE_LIMIT more are waiting,
+# further requests get a 503 straight away instead of queueing
+PASSWORD_WORKERS = int(os.environ.get("USER_PASSWORD_WORKERS", "2"))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("USER_PASSWORD_QUEUE_LIMIT", "8"))
+
 user_types = [
     "user",
     "admin"
 ]
 
+# fields GET /users and /users/{id} return (or can be narrowed to with fields=),
+# and the columns of a CSV export of users
+# password hashes are never returned or exported
+USER_FIELDS = ["id", "email", "type"]
+EXPORT_OMIT = ["password"]
+
+# endpoints that hand out tokens don't check the access token a request carries,
+# since clients that send it on every call send an expired one when they refresh
+TOKENLESS_PATHS = [["users", "register"], ["users", "login"], ["users", "refresh"]]
+
+# firestore client and collection handle, created lazily on first use and
+# reused across warm invocations of the function instance
+# google.cloud.firestore is only imported here, so requests that never reach the
+# database (404s, 405s, validation errors) don't pay for it on a cold start
+_db = None
+_db_lock = threading.Lock()
+_users_collection = None
+_emails_collection = None
+
 def get_db():
-    return firestore.Client()
+    global _db
+    if _db is None:
+        with _db_lock:
+            # check again in case another request created the client first
+            if _db is None:
+                from google.cloud import firestore
+                _db = firestore.Client()
+    return _db
 
 def get_users_collection():
-    db = get_db()
-    return db.collection("users")
+    global _users_collection
+    if _users_collection is None:
+        _users_collection = get_db().collection("users")
+    return _users_collection
+
+# each registered email has a reservation document in "user_emails" holding the ID
+# of the user it belongs to, so registering can claim an email atomically and
+# logging in reads documents by key instead of querying the users collection
+def get_emails_collection():
+    global _emails_collection
+    if _emails_collection is None:
+        _emails_collection = get_db().collection("user_emails")
+    return _emails_collection
+
+# utility function to get the reservation document ID of a normalized email
+# emails are hashed, since document IDs can't take every string an email can
+def email_key(email):
+    return hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+# password worker pool, and the slots for the tasks it runs or has waiting,
+# created on first use like the firestore client
+_password_pool = None
+_password_slots = None
+_password_pool_lock = threading.Lock()
+
+class PasswordPoolFull(Exception):
+    pass
+
+def get_password_pool():
+    global _password_pool, _password_slots
+    if _password_pool is None:
+        with _password_pool_lock:
+            if _password_pool is None:
+                _password_slots = threading.BoundedSemaphore(PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT)
+                _password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+    return _password_pool
+
+# utility function to run bcrypt work on the password pool and wait for the result
+# raises PasswordPoolFull without waiting if the pool and its queue are full
+def run_password_task(fn, *args):
+    pool = get_password_pool()
+    if not _password_slots.acquire(blocking=False):
+        raise PasswordPoolFull()
+    try:
+        future = pool.submit(fn, *args)
+    except Exception:
+        _password_slots.release()
+        raise
+    future.add_done_callback(lambda _: _password_slots.release())
+    return future.result()
 
 def request_handler(request):
     try:
@@ -40,10 +141,16 @@ def request_handler(request):
         query_params = request.args
         logging.debug(f"Query parameters: {query_params}")
 
+        # verify the access token, if the request carries one, without a database read
+        user = {} if path in TOKENLESS_PATHS else authenticate(request)
+        if user is None:
+            logging.error("Invalid or expired access token")
+            return http_response(401)
+
         # dynamically parse path parameters
         user_id = ""
         if len(path) == 2 and path[0] == "users":
-            if path[1] not in ["register", "login"]:
+            if path[1] not in ["register", "login", "refresh", "export", "count"]:
                 user_id = path[1]
                 logging.debug(f"User ID path parameter: {user_id}")
 
@@ -54,7 +161,7 @@ def request_handler(request):
                 match request.method:
                     # get a list of all user accounts
                     case "GET":
-                        return get_users(query_params)
+                        return get_users(query_params, request.headers)
                     # delete all user accounts
                     case "DELETE":
                         return delete_users(query_params)
@@ -85,12 +192,45 @@ def request_handler(request):
                         logging.error(f"Invalid request method: {request.method}")
                         return http_response(405)
                     
+            # /users/refresh, endpoint for exchanging a refresh token for new tokens
+            case ["users", "refresh"]:
+                match request.method:
+                    # issue new access and refresh tokens
+                    case "POST":
+                        return refresh_tokens(data)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+
+            # /users/export, admin endpoint for downloading user accounts as a file
+            case ["users", "export"]:
+                match request.method:
+                    # stream all user accounts as NDJSON or CSV
+                    case "GET":
+                        return export_users(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+
+            # /users/count, admin endpoint for counting user accounts
+            case ["users", "count"]:
+                match request.method:
+                    # count all user accounts, or those of one type
+                    case "GET":
+                        return count_users(query_params)
+                    # handle invalid request method
+                    case _:
+                        logging.error(f"Invalid request method: {request.method}")
+                        return http_response(405)
+
             # /users/{id}, endpoint for managing a specific user account
             case ["users", user_id]:
                 match request.method:
                     # get a user account
                     case "GET":
-                        return get_user(user_id)
+                        return get_user(user_id, query_params, request.headers)
                     # update a user account
                     case "PATCH":
                         return update_user(user_id, data)
@@ -119,8 +259,26 @@ def request_handler(request):
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
+# utility function to hash a password with the configured bcrypt cost
+def hash_password(password):
+    # bcrypt is imported on first use, like firestore
+    import bcrypt
+    return run_password_task(bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
+
+# utility function to check a password against its stored hash
+def check_password(password, hashed):
+    import bcrypt
+    return run_password_task(bcrypt.checkpw, password.encode("utf-8"), hashed.encode("utf-8"))
+
+# utility function to get the cost a bcrypt hash was made with ($2b$[cost]$...)
+def hash_rounds(hashed):
+    try:
+        return int(hashed.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
 # utility function to form a consistent HTTP response
-def http_response(status: int, data=None):
+def http_response(status: int, data=None, headers=None):
     try:
         if data is None:
             data = ""
@@ -129,11 +287,11 @@ def http_response(status: int, data=None):
             "message": STATUS.get(status, "Unknown status"),
             "data": data
         }
-        # google cloud expects a tuple
+        # google cloud expects a tuple, and a 304 has no body
         response = (
-            json.dumps(response_data),
+            "" if status == 304 else json.dumps(response_data),
             status, 
-            {"Content-Type": "application/json"}
+            {"Content-Type": "application/json", **(headers or {})}
         )
         logging.debug(f"Raw response data: {response}")
         return response
@@ -146,63 +304,68 @@ def http_response(status: int, data=None):
         )
 
 # GET /users
-def get_users(query_params=None):
+def get_users(query_params=None, request_headers=None):
     users = get_users_collection()
     query = users
-    limit = None
-    docs = []
-    next_page_token = ""
 
     if query_params:
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"type", "limit", "start_after", "fields"}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
         # filter - AccountType
+        # an equality filter ordered by document ID is served by the automatic
+        # single-field index on type, so it needs no composite index
         if "type" in query_params:
             # account for invalid type
-            if "type" in user_types:
+            if query_params["type"] in user_types:
                 query = query.where("type", "==", query_params["type"])
             else:
                 logging.error(f"Invalid type: {query_params['type']}")
                 return http_response(400)
-        
-        # filter - pagination limit
-        if "limit" in query_params:
-            # account for invalid limit
-            if limit is int and limit > 0:
-                limit = int(query_params["limit"])
-                query = query.limit(limit)
-            else:
-                logging.error(f"Invalid limit: {query_params['limit']}")
-                return http_response(400)
 
-        # filter - pagination start_after
-        if "start_after" in query_params:
-            try:
-                doc_id = query_params["start_after"]
-                # decode base64 nextPageToken
-                doc_id = base64.urlsafe_b64decode(doc_id.encode()).decode()
-                logging.debug(f"Decoded next page token: {doc_id}")
-
-                last_doc = users.document(doc_id).get()
-                if last_doc.exists:
-                    query = query.start_after(last_doc)
-                else:
-                    logging.error(f"Invalid start_after ID: {query_params['start_after']}")
-                    return http_response(400)
-            except Exception as e:
-                logging.error(f"Internal server error: {e}")
-                return http_response(500)
+    # only the requested fields are read, which never include the password hash
+    fields = parse_fields(query_params, USER_FIELDS, default=USER_FIELDS)
+    if fields is None:
+        return http_response(400)
+    query = select_fields(query, fields)
+
+    page = paginate(query, query_params)
+    if page is None:
+        return http_response(400)
+    query, limit = page
     
     try:
-        docs = list(query.stream())
-        query_result = [doc.to_dict() for doc in docs]
+        return http_stream_response(200, "users", query.stream(), limit, request_headers, [fields, (query_params or {}).get("start_after", "")])
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# GET /users/count
+def count_users(query_params=None):
+    try:
+        query = get_users_collection()
+
+        if query_params:
+            # account for unsupported query parameters
+            unsupported = set(query_params) - {"type"}
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
 
-        # add base64-encoded pagination token if needed
-        if limit and len(docs) == limit:
-            last_doc_id = docs[-1].id
-            next_page_token = base64.urlsafe_b64encode(last_doc_id.encode()).decode()
+            # filter - AccountType
+            if "type" in query_params:
+                # account for invalid type
+                if query_params["type"] in user_types:
+                    query = query.where("type", "==", query_params["type"])
+                else:
+                    logging.error(f"Invalid type: {query_params['type']}")
+                    return http_response(400)
 
         data = {
-            "users": query_result,
-            "nextPageToken": next_page_token
+            "userCount": count_documents([query])
         }
 
         return http_response(200, data)
@@ -210,6 +373,37 @@ def get_users(query_params=None):
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
+# GET /users/export
+def export_users(query_params=None):
+    query = get_users_collection()
+
+    if query_params:
+        # account for unsupported query parameters
+        unsupported = set(query_params) - {"format", "gzip", "after", "type"}
+        if unsupported:
+            logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+            return http_response(400)
+
+        # filter - AccountType
+        if "type" in query_params:
+            # account for invalid type
+            if query_params["type"] in user_types:
+                query = query.where("type", "==", query_params["type"])
+            else:
+                logging.error(f"Invalid type: {query_params['type']}")
+                return http_response(400)
+
+    export = parse_export_params(query_params)
+    if export is None:
+        return http_response(400)
+    export_format, compress, after = export
+
+    try:
+        return http_export_response("users", query, export_format, compress, after, fields=USER_FIELDS, omit=EXPORT_OMIT)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
 # DELETE /users
 def delete_users(query_params=None):
     try:
@@ -218,6 +412,12 @@ def delete_users(query_params=None):
         query = users
 
         if query_params:
+            # account for unsupported query parameters
+            unsupported = set(query_params) - {"type", "sample"}
+            if unsupported:
+                logging.error(f"Unsupported query parameters: {', '.join(sorted(unsupported))}")
+                return http_response(400)
+
             # filter - AccountType
             if "type" in query_params:
                 # account for invalid type
@@ -226,26 +426,23 @@ def delete_users(query_params=None):
                 else:
                     logging.error(f"Invalid type: {query_params['type']}")
                     return http_response(400)
-        
-        docs = list(query.stream())
 
-        batch = db.batch()
-        deleted_ids = []
+        sample_size = parse_sample_size(query_params)
+        if sample_size is None:
+            return http_response(400)
 
-        for i, doc in enumerate(docs):
-            batch.delete(doc.reference)
-            deleted_ids.append(doc.id)
-        
-            # commit every 500 deletes for batch deleting
-            if (i + 1) % 500 == 0:
-                batch.commit()
-                batch = db.batch()
-        # commit remaining deletes
-        if len(docs) % 500 != 0:
-            batch.commit()
+        emails = get_emails_collection()
+
+        # free each deleted user's email for registering again
+        def release_email(batch, doc):
+            email = doc.to_dict().get("email")
+            if email:
+                batch.delete(emails.document(email_key(email)))
+
+        deleted_count, deleted_ids = bulk_delete(db, [query], sample_size, fields=["email"], write=release_email, writes_per_doc=2)
         
         data = {
-            "deletedUserCount": len(deleted_ids),
+            "deletedUserCount": deleted_count,
             "deletedUserIds": deleted_ids
         }
 
@@ -258,7 +455,6 @@ def delete_users(query_params=None):
 def register_user(data):
     try:
         users = get_users_collection()
-        query = users
 
         # account for missing fields
         if not data.get("email"):
@@ -275,26 +471,26 @@ def register_user(data):
 
         # account for invalid fields
         # invalid email
-        if re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email) is None:
+        if EMAIL_PATTERN.match(email) is None:
             logging.error(f"Invalid email: {email}")
             return http_response(400)
         # invalid password
-        if re.match(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[^\w\s]).{8,}$", data.get("password")) is None:
+        if PASSWORD_PATTERN.match(data.get("password")) is None:
             logging.error(f"Invalid password. Must be at least 8 characters, contain at least one uppercase and one lowercase letter, at least one digit, and at least one special character: !, @, #, $, %, ^, &, *, (, )")
             return http_response(400)
         # invalid type
         if data.get("type") not in user_types:
             logging.error(f"Invalid user type: {data.get('type')}")
             return http_response(400)
-    
-        password = bcrypt.hashpw(data["password"].encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
 
-        # check for accounts that already use this email
-        registered_email = query.where("email", "==", email).limit(1).stream()
-        if any(registered_email):
+        # check for accounts that already use this email before paying for a hash
+        reservation = get_emails_collection().document(email_key(email))
+        if reservation.get().exists:
             logging.error(f"Email already in use")
             return http_response(409)
 
+        password = hash_password(data["password"])
+
         # create new user
         doc = users.document()
         user_id = doc.id
@@ -302,9 +498,23 @@ def register_user(data):
         data["id"] = user_id
         data["email"] = email
         data["password"] = password
-        doc.set(data)
+
+        # claim the email and create the user together, create() fails the whole
+        # batch if another registration claimed the email since the check above
+        from google.api_core.exceptions import AlreadyExists
+        batch = get_db().batch()
+        batch.create(reservation, {"email": email, "userId": user_id})
+        batch.set(doc, data)
+        try:
+            batch.commit()
+        except AlreadyExists:
+            logging.error(f"Email already in use")
+            return http_response(409)
 
         return http_response(201)
+    except PasswordPoolFull:
+        logging.error("Password workers are busy")
+        return http_response(503)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
@@ -313,54 +523,112 @@ def register_user(data):
 def login_user(data):
     try:
         users = get_users_collection()
-        query = users
 
         if not data.get("email"):
             logging.error(f"Missing 'email' in request body")
-            http_response(400)
+            return http_response(400)
         if not data.get("password"):
             logging.error(f"Missing 'password' in request body")
-            http_response(400)
+            return http_response(400)
 
         email = data["email"].strip().lower()
         password = data["password"]
 
-        query_result = query.where("email", "==", email).limit(1).stream()
-        doc = next(iter(query_result), None)
+        # find the user the email is reserved for, then read them by key
+        reservation = get_emails_collection().document(email_key(email)).get()
+        if not reservation.exists:
+            logging.error(f"No account with email {email}")
+            return http_response(401)
+        user_id = reservation.to_dict().get("userId")
+        doc = users.document(user_id).get()
+        if not doc.exists:
+            logging.error(f"User with ID {user_id} not found")
+            return http_response(401)
         
         user_data = doc.to_dict()
         stored_password = user_data.get("password", "")
         # verify password
-        if not bcrypt.checkpw(password.encode("utf-8"), stored_password.encode("utf-8")):
+        if not check_password(password, stored_password):
             logging.error(f"Invalid password")
             return http_response(401)
+
+        # upgrade hashes made with another cost while the password is at hand
+        if hash_rounds(stored_password) != BCRYPT_ROUNDS:
+            try:
+                doc.reference.update({"password": hash_password(password)})
+            except Exception as e:
+                # the old hash still works, so the login goes ahead
+                logging.warning(f"Could not rehash password for user {doc.id}: {e}")
         
-        return http_response(200)
+        return http_response(200, session_tokens(doc.id, user_data.get("type")))
+    except PasswordPoolFull:
+        logging.error("Password workers are busy")
+        return http_response(503)
+    except Exception as e:
+        logging.error(f"Internal server error: {e}")
+        return http_response(500)
+
+# utility function to issue the access and refresh tokens for a user's session
+def session_tokens(user_id, account_type):
+    return {
+        "userId": user_id,
+        "accessToken": issue_token(user_id, account_type),
+        "refreshToken": issue_token(user_id, account_type, use="refresh"),
+        "tokenType": "Bearer",
+        "expiresIn": ACCESS_TOKEN_TTL
+    }
+
+# POST /users/refresh
+def refresh_tokens(data):
+    try:
+        users = get_users_collection()
+
+        # account for missing or invalid refresh tokens
+        if not data.get("refreshToken"):
+            logging.error(f"Missing 'refreshToken' in request body")
+            return http_response(400)
+        claims = verify_token(data["refreshToken"], use="refresh")
+        if claims is None:
+            logging.error(f"Invalid or expired refresh token")
+            return http_response(401)
+
+        # read the account, so deleted accounts can't refresh and type changes apply
+        doc = users.document(claims["sub"]).get()
+        if not doc.exists:
+            logging.error(f"User not found: {claims['sub']}")
+            return http_response(401)
+
+        return http_response(200, session_tokens(doc.id, doc.to_dict().get("type")))
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
 
 # GET /users/{id}
-def get_user(user_id):
+def get_user(user_id, query_params=None, request_headers=None):
     users = get_users_collection()
-    query = users
-    docs = []
 
     try:
-        docs = list(query.where("id", "==", user_id).stream())
-        if not docs:
+        if not isinstance(user_id, str) or user_id == "":
+            logging.error(f"Invalid user ID: {user_id}, must be string")
+            return http_response(404)
+        fields = parse_fields(query_params, USER_FIELDS, default=USER_FIELDS)
+        if fields is None:
+            return http_response(400)
+        # user IDs are stored as the document ID, so look it up directly
+        doc = get_document(users.document(user_id), fields)
+        if not doc.exists:
             logging.error(f"User with ID {user_id} not found")
             return http_response(404)
-        # check if more than one user with the same ID exists
-        if len(docs) > 1:
-            logging.error(f"Multiple users with ID {user_id} found")
-            return http_response(500)
         
+        headers = validator_headers([doc], single=True, variant=fields)
+        if not_modified(request_headers, headers):
+            return http_response(304, headers=headers)
+
         data = {
-            "user": docs[0].to_dict(),
+            "user": doc.to_dict(),
         }
 
-        return http_response(200, data)
+        return http_response(200, data, headers)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
@@ -369,8 +637,7 @@ def get_user(user_id):
 def update_user(user_id, data):
     try:
         users = get_users_collection()
-        db = get_db()
-        query = users
+        emails = get_emails_collection()
 
         updates = {}
 
@@ -385,7 +652,7 @@ def update_user(user_id, data):
             # normalize email
             email = data["email"].strip().lower()
             # invalid email
-            if re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email) is None:
+            if EMAIL_PATTERN.match(email) is None:
                 logging.error(f"Invalid email: {email}")
                 return http_response(400)
             updates.update({"email": email})
@@ -401,18 +668,38 @@ def update_user(user_id, data):
                 return http_response(400)
             updates.update({"type": data["type"]})
 
-        query_result = query.where("id", "==", user_id).limit(1).stream()
-        doc = next(iter(query_result), None)
-
-        if not doc:
+        from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+        user_ref = users.document(user_id)
+        try:
+            if "email" not in updates:
+                # update user, update() fails if the document doesn't exist
+                user_ref.update(updates)
+            else:
+                # a new email moves the user's reservation, so read the current email
+                doc = user_ref.get()
+                if not doc.exists:
+                    logging.error(f"User with ID {user_id} not found")
+                    return http_response(404)
+                previous_email = doc.to_dict().get("email")
+
+                batch = get_db().batch()
+                if email != previous_email:
+                    batch.create(emails.document(email_key(email)), {"email": email, "userId": user_id})
+                    if previous_email:
+                        batch.delete(emails.document(email_key(previous_email)))
+                # only commit if the user is unchanged since it was read, so a
+                # concurrent email change can't leave a reservation behind
+                batch.update(user_ref, updates, option=get_db().write_option(last_update_time=doc.update_time))
+                batch.commit()
+        except NotFound:
             logging.error(f"User with ID {user_id} not found")
             return http_response(404)
-        
-        user_data = doc.to_dict()
-
-        # update user
-        user_ref = db.collection("users").document(doc.id)
-        user_ref.update(updates)
+        except AlreadyExists:
+            logging.error(f"Email already in use")
+            return http_response(409)
+        except FailedPrecondition:
+            logging.error(f"User with ID {user_id} changed during the update")
+            return http_response(409)
 
         return http_response(200)
     except Exception as e:
@@ -423,20 +710,33 @@ def update_user(user_id, data):
 def delete_user(user_id):
     try:
         users = get_users_collection()
-        query = users
-        docs = []
 
-        docs = list(query.where("id", "==", user_id).stream())
-        if not docs:
+        if not isinstance(user_id, str) or user_id == "":
+            logging.error(f"Invalid user ID: {user_id}, must be string")
+            return http_response(404)
+        # read the user for the email reservation to delete along with it
+        user_ref = users.document(user_id)
+        doc = user_ref.get()
+        if not doc.exists:
             logging.error(f"User with ID {user_id} not found")
             return http_response(404)
-        # check if more than one user with the same ID exists
-        if len(docs) > 1:
-            logging.error(f"Multiple users with ID {user_id} found")
-            return http_response(500)
-
-        doc = docs[0]
-        doc.reference.delete()
+        email = doc.to_dict().get("email")
+
+        # delete user, the precondition makes the batch fail if the user was
+        # deleted or changed (like their email) since it was read
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+        batch = get_db().batch()
+        batch.delete(user_ref, option=get_db().write_option(last_update_time=doc.update_time))
+        if email:
+            batch.delete(get_emails_collection().document(email_key(email)))
+        try:
+            batch.commit()
+        except NotFound:
+            logging.error(f"User with ID {user_id} not found")
+            return http_response(404)
+        except FailedPrecondition:
+            logging.error(f"User with ID {user_id} changed during the delete")
+            return http_response(409)
 
         return http_response(200)
     except Exception as e:
@@ -447,8 +747,6 @@ def delete_user(user_id):
 def update_password(user_id, data):
     try:
         users = get_users_collection()
-        db = get_db()
-        query = users
 
         if not isinstance(user_id, str) or user_id == "":
             logging.error(f"Invalid user ID: {user_id}, must be string")
@@ -466,8 +764,7 @@ def update_password(user_id, data):
         new_password = data["newPassword"]
 
         # validate password formats
-        pw_regex = r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[^\w\s]).{8,}$"
-        if not re.match(pw_regex, prev_password) or not re.match(pw_regex, new_password):
+        if not PASSWORD_PATTERN.match(prev_password) or not PASSWORD_PATTERN.match(new_password):
             logging.error("Invalid password format")
             return http_response(400)
 
@@ -476,26 +773,27 @@ def update_password(user_id, data):
             return http_response(400)
 
         # get user doc by ID
-        query_result = query.where("id", "==", user_id).limit(1).stream()
-        doc = next(iter(query_result), None)
-        if not doc:
+        user_ref = users.document(user_id)
+        doc = user_ref.get()
+        if not doc.exists:
             logging.error(f"User with ID {user_id} not found")
             return http_response(404)
 
         user_data = doc.to_dict()
         stored_hashed_pw = user_data.get("password")
-
-        if not stored_hashed_pw or not bcrypt.checkpw(prev_password.encode("utf-8"), stored_hashed_pw.encode("utf-8")):
+        if not stored_hashed_pw or not check_password(prev_password, stored_hashed_pw):
             logging.error("Previous password does not match stored password")
             return http_response(401)
 
-        new_hashed_pw = bcrypt.hashpw(new_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+        new_hashed_pw = hash_password(new_password)
 
         # update password
-        user_ref = db.collection("users").document(doc.id)
         user_ref.update({"password": new_hashed_pw})
 
         return http_response(200)
+    except PasswordPoolFull:
+        logging.error("Password workers are busy")
+        return http_response(503)
     except Exception as e:
         logging.error(f"Internal server error: {e}")
         return http_response(500)
\ No newline at end of file
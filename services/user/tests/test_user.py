@@ -1,17 +1,26 @@
 import pytest
-from unittest.mock import MagicMock, patch
-from main import get_users, delete_users, register_user, login_user, get_user, update_user, delete_user, update_password
+from unittest.mock import ANY, MagicMock, patch
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from main import get_users, count_users, delete_users, register_user, login_user, get_user, update_user, delete_user, update_password
 import bcrypt
 import json
+from datetime import datetime, timezone
+import base64
+import threading
+import os
+import subprocess
+import sys
+import main
+import pages
+import tokens
 
 # get_users tests
 @patch("main.get_users_collection")
 def test_get_users_success(mock_users_collection):
-    # mock doc for a sample user
+    # mock doc for a sample user, as read with the default projection
     user = {
         "id": "1",
         "email": "email@example.com",
-        "password": "Password123!",
         "type": "user"
     }
     mock_user_doc = MagicMock()
@@ -27,18 +36,94 @@ def test_get_users_success(mock_users_collection):
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_user_doc]
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_user_doc]
     mock_users_collection.return_value = mock_query
     
     response = get_users()
+    # list responses are streamed
+    body = "".join(response[0])
 
-    assert response == expected
+    assert (body, *response[1:]) == expected
+    # password hashes are never read
+    mock_query.select.assert_called_once_with(["id", "email", "type"])
+    # pages are ordered by document ID, with one extra document to detect the next page
+    mock_query.select.return_value.order_by.assert_called_once_with("__name__")
+    mock_query.select.return_value.order_by.return_value.limit.assert_called_once_with(pages.DEFAULT_PAGE_SIZE + 1)
+
+@patch("main.get_users_collection")
+def test_get_users_not_modified_success(mock_users_collection):
+    mock_user_doc = MagicMock(id="1", update_time=datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc))
+    mock_user_doc.to_dict.return_value = {"id": "1"}
+
+    # mock query behavior
+    mock_page = mock_users_collection.return_value.select.return_value.order_by.return_value.limit.return_value
+    mock_page.stream.return_value = [mock_user_doc]
+
+    etag = get_users()[2]["ETag"]
+    response = get_users(None, {"If-None-Match": etag})
+
+    # the page hasn't changed, so it is sent as a 304 with no body
+    assert response == ("", 304, {"Content-Type": "application/json", "ETag": etag})
+
+    # a new user on the page changes its tag
+    mock_page.stream.return_value = [mock_user_doc, MagicMock(id="2", update_time=datetime(2024, 5, 2, tzinfo=timezone.utc))]
+    response = get_users(None, {"If-None-Match": etag})
+
+    assert response[1] == 200
+    assert response[2]["ETag"] != etag
+
+@patch("main.get_users_collection")
+def test_get_users_next_page_success(mock_users_collection):
+    mock_docs = []
+    for doc_id in ["a", "b", "c"]:
+        mock_doc = MagicMock()
+        mock_doc.id = doc_id
+        mock_doc.to_dict.return_value = {"id": doc_id}
+        mock_docs.append(mock_doc)
+
+    mock_query = MagicMock()
+    mock_ordered = mock_query.where.return_value.select.return_value.order_by.return_value
+    mock_ordered.start_after.return_value.limit.return_value.stream.return_value = mock_docs
+    mock_users_collection.return_value = mock_query
+
+    start_after = base64.urlsafe_b64encode(b"0").decode()
+    response = get_users({"type": "admin", "limit": "2", "start_after": start_after})
+    body = json.loads("".join(response[0]))
+
+    assert response[1] == 200
+    assert body["data"]["users"] == [{"id": "a"}, {"id": "b"}]
+    assert base64.urlsafe_b64decode(body["data"]["nextPageToken"]).decode() == "b"
+    mock_query.where.assert_called_once_with("type", "==", "admin")
+    # the cursor is the document ID itself, so no document is read to resolve it
+    mock_ordered.start_after.assert_called_once_with({"__name__": "0"})
+    mock_query.document.assert_not_called()
+    mock_ordered.start_after.return_value.limit.assert_called_once_with(3)
+
+@patch("main.get_users_collection")
+def test_get_users_fields_success(mock_users_collection):
+    mock_user_doc = MagicMock()
+    mock_user_doc.to_dict.return_value = {"email": "email@example.com"}
+    mock_users_collection.return_value.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_user_doc]
+
+    response = get_users({"fields": "email"})
+
+    assert json.loads("".join(response[0]))["data"]["users"] == [{"email": "email@example.com"}]
+    mock_users_collection.return_value.select.assert_called_once_with(["email"])
+
+@pytest.mark.parametrize("invalid_data", ["password", "email,password", "", " , "])
+@patch("main.get_users_collection")
+def test_get_users_invalid_fields_fail(mock_users_collection, invalid_data):
+    response = get_users({"fields": invalid_data})
+
+    assert response[1] == 400
+    mock_users_collection.return_value.select.assert_not_called()
 
 @patch("main.get_users_collection")
 def test_get_users_invalid_type_fail(mock_users_collection):
@@ -60,7 +145,10 @@ def test_get_users_invalid_type_fail(mock_users_collection):
 @pytest.mark.parametrize("invalid_data", [
     {"limit": "abc"},
     {"limit": None},
-    {"limit": 5.5}
+    {"limit": 5.5},
+    {"limit": "0"},
+    {"limit": "100000"},
+    {"sort": "email"}
 ])
 @patch("main.get_users_collection")
 def test_get_users_invalid_limit_fail(mock_users_collection, invalid_data):
@@ -81,16 +169,19 @@ def test_get_users_invalid_limit_fail(mock_users_collection, invalid_data):
 
 @pytest.mark.parametrize("invalid_data", [
     {"start_after": None},
-    {"start_after": "not_base64"}
+    {"start_after": "not_base64"},
+    {"start_after": "MA==!!"},
+    {"start_after": ""},
+    {"start_after": base64.urlsafe_b64encode(b"users/1").decode()}
 ])
 @patch("main.get_users_collection")
 def test_get_users_invalid_start_after_fail(mock_users_collection, invalid_data):
     expected = (
         json.dumps({
-            "message": "Internal Server Error",
+            "message": "Bad Request",
             "data": ""
         }),
-        500,
+        400,
         {
             "Content-Type": "application/json"
         }
@@ -100,10 +191,82 @@ def test_get_users_invalid_start_after_fail(mock_users_collection, invalid_data)
 
     assert response == expected
 
+# count_users tests
+@patch("main.get_users_collection")
+def test_count_users_success(mock_users_collection):
+    mock_query = mock_users_collection.return_value
+    mock_query.where.return_value.count.return_value.get.return_value = [[MagicMock(value=2)]]
+
+    response = count_users({"type": "admin"})
+
+    assert json.loads(response[0]) == {"message": "OK", "data": {"userCount": 2}}
+    # one aggregation query, no documents read
+    mock_query.where.assert_called_once_with("type", "==", "admin")
+    mock_query.where.return_value.count.assert_called_once_with(alias="count")
+    mock_query.where.return_value.stream.assert_not_called()
+
+@pytest.mark.parametrize("invalid_data", [{"type": "guest"}, {"limit": "10"}])
+@patch("main.get_users_collection")
+def test_count_users_invalid_query_params_fail(mock_users_collection, invalid_data):
+    response = count_users(invalid_data)
+
+    assert response[1] == 400
+
+@patch("main.count_users")
+def test_request_handler_count_success(mock_count):
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/users/count"
+    request.args = {}
+    request.headers = {}
+
+    main.request_handler(request)
+
+    # "count" isn't taken as a user ID
+    mock_count.assert_called_once_with({})
+
+# export_users tests
+@patch("main.get_users_collection")
+def test_export_users_excludes_password(mock_users_collection):
+    mock_doc = MagicMock()
+    mock_doc.id = "1"
+    mock_doc.to_dict.return_value = {"id": "1", "email": "email@example.com", "password": "hash", "type": "admin"}
+    mock_query = mock_users_collection.return_value.where.return_value
+    mock_query.order_by.return_value.limit.return_value.stream.return_value = [mock_doc]
+
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/users/export"
+    request.args = {"type": "admin"}
+    request.headers = {}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 200
+    assert "".join(response[0]) == '{"id": "1", "email": "email@example.com", "type": "admin"}\n'
+    mock_users_collection.return_value.where.assert_called_once_with("type", "==", "admin")
+
+    # csv exports leave the column out
+    response = main.export_users({"type": "admin", "format": "csv"})
+
+    assert "".join(response[0]) == "id,email,type\r\n1,email@example.com,admin\r\n"
+
+@pytest.mark.parametrize("invalid_data", [
+    {"format": "xml"},
+    {"type": "invalid"},
+    {"limit": "10"}
+])
+@patch("main.get_users_collection")
+def test_export_users_invalid_query_params_fail(mock_users_collection, invalid_data):
+    response = main.export_users(invalid_data)
+
+    assert response[1] == 400
+
 # delete_users tests
+@patch("main.get_emails_collection")
 @patch("main.get_db")
 @patch("main.get_users_collection")
-def test_delete_users_success(mock_users_collection, mock_get_db):
+def test_delete_users_success(mock_users_collection, mock_get_db, mock_emails_collection):
     # mock doc for a sample user
     user = {
         "id": "1",
@@ -117,7 +280,8 @@ def test_delete_users_success(mock_users_collection, mock_get_db):
 
     # mock query behavior
     mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_user_doc]
+    # one page, shorter than a full batch
+    mock_query.select.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_user_doc]
     mock_users_collection.return_value = mock_query
 
     # mock db and batch
@@ -143,6 +307,9 @@ def test_delete_users_success(mock_users_collection, mock_get_db):
     response = delete_users()
 
     assert response == expected
+    # the deleted user's email is freed in the same batch
+    mock_emails_collection.return_value.document.assert_called_once_with(main.email_key("email@example.com"))
+    mock_batch.delete.assert_any_call(mock_emails_collection.return_value.document.return_value)
 
 @patch("main.get_db")
 @patch("main.get_users_collection")
@@ -166,8 +333,10 @@ def test_delete_users_invalid_type_fail(mock_users_collection, mock_get_db):
     assert response == expected
 
 # register_user tests
+@patch("main.get_db")
+@patch("main.get_emails_collection")
 @patch("main.get_users_collection")
-def test_register_user_success(mock_users_collection):
+def test_register_user_success(mock_users_collection, mock_emails_collection, mock_get_db):
     user = {
         "email": "user@example.com",
         "password": "Password123!",
@@ -187,17 +356,65 @@ def test_register_user_success(mock_users_collection):
 
     # mock users collection
     mock_users = MagicMock()
+    mock_users.document.return_value.id = "1"
     mock_users_collection.return_value = mock_users
 
+    # mock email reservation, not yet taken
+    mock_reservation = mock_emails_collection.return_value.document.return_value
+    mock_reservation.get.return_value.exists = False
+    mock_batch = mock_get_db.return_value.batch.return_value
+
     # mock request data
     data = user
 
     response = register_user(data)
 
     assert response == expected
+    # the email is claimed and the user created in one batch
+    mock_emails_collection.return_value.document.assert_called_once_with(main.email_key("user@example.com"))
+    mock_batch.create.assert_called_once_with(mock_reservation, {"email": "user@example.com", "userId": "1"})
+    mock_batch.set.assert_called_once_with(mock_users.document.return_value, data)
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_db")
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_register_user_email_claimed_meanwhile_fail(mock_users_collection, mock_emails_collection, mock_get_db):
+    mock_emails_collection.return_value.document.return_value.get.return_value.exists = False
+    # another registration claimed the email between the check and the commit
+    mock_get_db.return_value.batch.return_value.commit.side_effect = AlreadyExists("Document already exists")
+
+    response = register_user({"email": "user@example.com", "password": "Password123!", "type": "user"})
+
+    assert response[1] == 409
+
+@patch("main.get_db")
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_register_user_configured_cost_success(mock_users_collection, mock_emails_collection, mock_get_db, monkeypatch):
+    monkeypatch.setattr(main, "BCRYPT_ROUNDS", 5)
+    mock_emails_collection.return_value.document.return_value.get.return_value.exists = False
+
+    response = register_user({"email": "user@example.com", "password": "Password123!", "type": "user"})
+    stored = mock_get_db.return_value.batch.return_value.set.call_args[0][1]["password"]
+
+    assert response[1] == 201
+    assert stored.startswith("$2b$05$")
+    assert bcrypt.checkpw(b"Password123!", stored.encode("utf-8"))
 
+def test_bcrypt_rounds_invalid_fail():
+    # the cost is checked when the function instance starts, not on the first request
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "USER_BCRYPT_ROUNDS": "3"}
+    result = subprocess.run([sys.executable, "-c", "import main"], cwd=service_dir, env=env, capture_output=True, text=True)
+
+    assert result.returncode != 0
+    assert "USER_BCRYPT_ROUNDS must be between 4 and 31" in result.stderr
+
+@patch("main.hash_password")
+@patch("main.get_emails_collection")
 @patch("main.get_users_collection")
-def test_register_user_existing_email_fail(mock_users_collection):
+def test_register_user_existing_email_fail(mock_users_collection, mock_emails_collection, mock_hash_password):
     user = {
         "email": "user@example.com",
         "password": "Password123!",
@@ -215,23 +432,21 @@ def test_register_user_existing_email_fail(mock_users_collection):
         }
     )
 
-    # mock firestore document stream result
-    mock_existing_user = MagicMock()
-    mock_existing_user.to_dict.return_value = user
-
     # mock collection
     mock_users = MagicMock()
-    
-    # when register_user calls .where(...).limit(1).stream(), return a non-empty list
-    mock_users.where.return_value.limit.return_value.stream.return_value = [mock_existing_user]
     mock_users_collection.return_value = mock_users
 
+    # the email is already reserved
+    mock_emails_collection.return_value.document.return_value.get.return_value.exists = True
+
     # mock request data
     data = user
 
     response = register_user(data)
 
     assert response == expected
+    # taken emails are turned away before the password is hashed
+    mock_hash_password.assert_not_called()
 
 @pytest.mark.parametrize("invalid_data", [
     {"email": "", "password": "Password123!", "type": "user"},
@@ -315,40 +530,112 @@ def test_register_user_invalid_type_fail(mock_users_collection, invalid_data):
     assert response == expected
 
 # login_user tests
+@pytest.fixture
+def token_secret(monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_SECRET", "test-secret")
+
+# utility function to mock the email reservation and user doc a login reads
+def mock_login_docs(mock_emails_collection, mock_users_collection, user_data, user_id="1"):
+    mock_reservation = mock_emails_collection.return_value.document.return_value.get.return_value
+    mock_reservation.exists = True
+    mock_reservation.to_dict.return_value = {"email": user_data.get("email"), "userId": user_id}
+
+    mock_user_doc = mock_users_collection.return_value.document.return_value.get.return_value
+    mock_user_doc.exists = True
+    mock_user_doc.id = user_id
+    mock_user_doc.to_dict.return_value = user_data
+    return mock_user_doc
+
+@patch("main.get_emails_collection")
 @patch("main.get_users_collection")
-def test_login_user_success(mock_users_collection):
+def test_login_user_success(mock_users_collection, mock_emails_collection, token_secret):
     user = {
         "email": "email@example.com",
         "password": "Password123!"
     }
 
-    expected = (
-        json.dumps({
-            "message": "OK",
-            "data": ""
-        }),
-        200,
-        {
-            "Content-Type": "application/json"
-        }
-    )
-
     # mock user doc with hashed password
     hashed_pw = bcrypt.hashpw("Password123!".encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-    mock_user_doc = MagicMock()
-    mock_user_doc.to_dict.return_value = {
+    mock_login_docs(mock_emails_collection, mock_users_collection, {
         "email": "email@example.com",
-        "password": hashed_pw
-    }
-
-    # mock query
-    mock_query = MagicMock()
-    mock_query.where.return_value.limit.return_value.stream.return_value = [mock_user_doc]
-    mock_users_collection.return_value = mock_query
+        "password": hashed_pw,
+        "type": "admin"
+    })
 
     response = login_user(user)
+    data = json.loads(response[0])["data"]
     
-    assert response == expected
+    assert response[1:] == (200, {"Content-Type": "application/json"})
+    assert (data["userId"], data["tokenType"], data["expiresIn"]) == ("1", "Bearer", tokens.ACCESS_TOKEN_TTL)
+    # the tokens carry the user's ID and account type, and are only valid for their use
+    assert {key: value for key, value in tokens.verify_token(data["accessToken"]).items() if key in ("sub", "type")} == {"sub": "1", "type": "admin"}
+    assert tokens.verify_token(data["refreshToken"], use="refresh")["sub"] == "1"
+    assert tokens.verify_token(data["refreshToken"]) is None
+    # the email's reservation leads straight to the user's document
+    mock_emails_collection.return_value.document.assert_called_once_with(main.email_key("email@example.com"))
+    mock_users_collection.return_value.document.assert_called_once_with("1")
+    mock_users_collection.return_value.where.assert_not_called()
+
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_login_user_wrong_password_fail(mock_users_collection, mock_emails_collection, token_secret):
+    mock_login_docs(mock_emails_collection, mock_users_collection, {
+        "email": "email@example.com",
+        "password": bcrypt.hashpw(b"Password123!", bcrypt.gensalt()).decode("utf-8")
+    })
+
+    response = login_user({"email": "email@example.com", "password": "Password456!"})
+
+    assert response[1] == 401
+
+@patch("main.check_password")
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_login_user_unknown_email_fail(mock_users_collection, mock_emails_collection, mock_check_password, token_secret):
+    mock_emails_collection.return_value.document.return_value.get.return_value.exists = False
+
+    response = login_user({"email": "nobody@example.com", "password": "Password123!"})
+
+    assert response[1] == 401
+    mock_check_password.assert_not_called()
+
+
+@pytest.mark.parametrize("stored_rounds, rehashed", [(4, True), (5, False)])
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_login_user_rehashes_password(mock_users_collection, mock_emails_collection, token_secret, monkeypatch, stored_rounds, rehashed):
+    monkeypatch.setattr(main, "BCRYPT_ROUNDS", 5)
+    mock_user_doc = mock_login_docs(mock_emails_collection, mock_users_collection, {
+        "email": "email@example.com",
+        "password": bcrypt.hashpw(b"Password123!", bcrypt.gensalt(rounds=stored_rounds)).decode("utf-8"),
+        "type": "user"
+    })
+
+    response = login_user({"email": "email@example.com", "password": "Password123!"})
+
+    assert response[1] == 200
+    # hashes with another cost are upgraded, with the password that was just checked
+    if rehashed:
+        stored = mock_user_doc.reference.update.call_args[0][0]["password"]
+        assert stored.startswith("$2b$05$")
+        assert bcrypt.checkpw(b"Password123!", stored.encode("utf-8"))
+    else:
+        mock_user_doc.reference.update.assert_not_called()
+
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_login_user_rehash_error_success(mock_users_collection, mock_emails_collection, token_secret, monkeypatch):
+    monkeypatch.setattr(main, "BCRYPT_ROUNDS", 5)
+    mock_user_doc = mock_login_docs(mock_emails_collection, mock_users_collection, {
+        "email": "email@example.com",
+        "password": bcrypt.hashpw(b"Password123!", bcrypt.gensalt(rounds=4)).decode("utf-8")
+    })
+    mock_user_doc.reference.update.side_effect = Exception("write failed")
+
+    response = login_user({"email": "email@example.com", "password": "Password123!"})
+
+    # the old hash still works, so the login isn't failed over it
+    assert response[1] == 200
 
 @pytest.mark.parametrize("invalid_data", [
     {"email": "", "password": "Password123!"},
@@ -359,10 +646,10 @@ def test_login_user_success(mock_users_collection):
 def test_login_user_invalid_email_fail(mock_users_collection, invalid_data):
     expected = (
         json.dumps({
-            "message": "Internal Server Error",
+            "message": "Bad Request",
             "data": ""
         }),
-        500,
+        400,
         {
             "Content-Type": "application/json"
         }
@@ -381,14 +668,15 @@ def test_login_user_invalid_email_fail(mock_users_collection, invalid_data):
     {"email": "email@example.com"},
     {"email": "email@example.com", "password": None}
 ])
+@patch("main.get_emails_collection")
 @patch("main.get_users_collection")
-def test_login_user_invalid_password_fail(mock_users_collection, invalid_data):
+def test_login_user_invalid_password_fail(mock_users_collection, mock_emails_collection, invalid_data):
     expected = (
         json.dumps({
-            "message": "Internal Server Error",
+            "message": "Bad Request",
             "data": ""
         }),
-        500,
+        400,
         {
             "Content-Type": "application/json"
         }
@@ -402,6 +690,98 @@ def test_login_user_invalid_password_fail(mock_users_collection, invalid_data):
 
     assert response == expected
 
+# refresh_tokens tests
+@patch("main.get_users_collection")
+def test_refresh_tokens_success(mock_users_collection, token_secret):
+    mock_user_doc = MagicMock()
+    mock_user_doc.id = "1"
+    mock_user_doc.exists = True
+    # the account type changed since the refresh token was issued
+    mock_user_doc.to_dict.return_value = {"id": "1", "type": "admin"}
+    mock_users_collection.return_value.document.return_value.get.return_value = mock_user_doc
+
+    response = main.refresh_tokens({"refreshToken": tokens.issue_token("1", "user", use="refresh")})
+
+    assert response[1] == 200
+    assert tokens.verify_token(json.loads(response[0])["data"]["accessToken"])["type"] == "admin"
+    mock_users_collection.return_value.document.assert_called_once_with("1")
+
+@patch("main.get_users_collection")
+def test_refresh_tokens_deleted_user_fail(mock_users_collection, token_secret):
+    mock_users_collection.return_value.document.return_value.get.return_value.exists = False
+
+    response = main.refresh_tokens({"refreshToken": tokens.issue_token("1", "user", use="refresh")})
+
+    assert response[1] == 401
+
+@pytest.mark.parametrize("invalid_data, status", [
+    ({}, 400),
+    ({"refreshToken": "not.a.token"}, 401),
+    # access tokens can't be used to refresh
+    ({"refreshToken": "access"}, 401)
+])
+@patch("main.get_users_collection")
+def test_refresh_tokens_invalid_fail(mock_users_collection, token_secret, invalid_data, status):
+    if invalid_data.get("refreshToken") == "access":
+        invalid_data = {"refreshToken": tokens.issue_token("1", "user")}
+
+    response = main.refresh_tokens(invalid_data)
+
+    assert response[1] == status
+    mock_users_collection.return_value.document.assert_not_called()
+
+@patch("main.get_users_collection")
+def test_request_handler_invalid_token_fail(mock_users_collection, token_secret):
+    header, payload, signature = tokens.issue_token("1", "user").split(".")
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/users/1"
+    request.args = {}
+    request.headers = {"Authorization": f"Bearer {header}.{payload}.{signature[::-1]}"}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 401
+    mock_users_collection.assert_not_called()
+
+@pytest.mark.parametrize("authorization", ["Bearer not.a.token", "Basic dXNlcjpwYXNz"])
+@patch("main.get_users_collection")
+def test_request_handler_foreign_token_success(mock_users_collection, token_secret, authorization):
+    # tokens someone else issued, like IAM ID tokens, leave the request anonymous
+    mock_users_collection.return_value.document.return_value.get.return_value.exists = False
+    request = MagicMock()
+    request.method = "GET"
+    request.path = "/users/1"
+    request.args = {}
+    request.headers = {"Authorization": authorization}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 404
+
+@patch("main.get_users_collection")
+def test_request_handler_refresh_expired_token_success(mock_users_collection, token_secret, monkeypatch):
+    # clients that send their access token on every call still refresh once it expires
+    monkeypatch.setattr(tokens, "ACCESS_TOKEN_TTL", -1)
+    expired_token = tokens.issue_token("1", "user")
+    monkeypatch.setattr(tokens, "ACCESS_TOKEN_TTL", 900)
+    mock_user_doc = MagicMock()
+    mock_user_doc.id = "1"
+    mock_user_doc.exists = True
+    mock_user_doc.to_dict.return_value = {"id": "1", "type": "user"}
+    mock_users_collection.return_value.document.return_value.get.return_value = mock_user_doc
+    request = MagicMock()
+    request.method = "POST"
+    request.path = "/users/refresh"
+    request.args = {}
+    request.headers = {"Authorization": f"Bearer {expired_token}"}
+    request.get_json.return_value = {"refreshToken": tokens.issue_token("1", "user", use="refresh")}
+
+    response = main.request_handler(request)
+
+    assert response[1] == 200
+    assert tokens.verify_token(json.loads(response[0])["data"]["accessToken"])["sub"] == "1"
+
 # get_user tests
 @patch("main.get_users_collection")
 def test_get_user_success(mock_users_collection):
@@ -410,18 +790,14 @@ def test_get_user_success(mock_users_collection):
     user = {
         "id": user_id,
         "email": "user@example.com",
-        "password": "Password123!",
         "type": "user"
     }
 
     mock_user_doc = MagicMock()
     mock_user_doc.to_dict.return_value = user
 
-    mock_query = MagicMock()
-    mock_query.stream.return_value = [mock_user_doc]
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value = mock_user_doc
 
     mock_users_collection.return_value = mock_collection
 
@@ -434,22 +810,59 @@ def test_get_user_success(mock_users_collection):
         }),
         200,
         {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "ETag": ANY
         }
     )
     
     response = get_user(user_id)
 
     assert response == expected
+    # the document is read without its password hash
+    mock_collection.document.return_value.get.assert_called_once_with(field_paths=["id", "email", "type"])
+
+@patch("main.get_users_collection")
+def test_get_user_fields_success(mock_users_collection):
+    mock_users_collection.return_value.document.return_value.get.return_value.to_dict.return_value = {"type": "user", "id": "1"}
+
+    response = get_user("1", {"fields": "type,id"})
+
+    assert response[1] == 200
+    mock_users_collection.return_value.document.return_value.get.assert_called_once_with(field_paths=["type", "id"])
+
+@patch("main.get_users_collection")
+def test_get_user_not_modified_success(mock_users_collection):
+    mock_user_doc = mock_users_collection.return_value.document.return_value.get.return_value
+    mock_user_doc.id = "1"
+    mock_user_doc.to_dict.return_value = {"id": "1"}
+    mock_user_doc.update_time = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+    headers = get_user("1")[2]
+    assert headers["Last-Modified"] == "Wed, 01 May 2024 12:30:00 GMT"
+
+    # the client's copy is current, so it gets a 304 with no body
+    for request_headers in ({"If-None-Match": headers["ETag"]}, {"If-Modified-Since": headers["Last-Modified"]}):
+        assert get_user("1", None, request_headers) == ("", 304, headers)
+
+    # the user changed since, so it is sent again
+    mock_user_doc.update_time = datetime(2024, 5, 1, 12, 31, tzinfo=timezone.utc)
+    response = get_user("1", None, {"If-None-Match": headers["ETag"]})
+
+    assert response[1] == 200
+    assert json.loads(response[0])["data"] == {"user": {"id": "1"}}
+
+@patch("main.get_users_collection")
+def test_get_user_invalid_fields_fail(mock_users_collection):
+    response = get_user("1", {"fields": "password"})
+
+    assert response[1] == 400
+    mock_users_collection.return_value.document.return_value.get.assert_not_called()
 
 @patch("main.get_users_collection")
 @pytest.mark.parametrize("invalid_data", ["", 0, None])
 def test_get_user_invalid_id_fail(mock_users_collection, invalid_data):
-    mock_query = MagicMock()
-    mock_query.stream.return_value = []
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value.exists = False
 
     mock_users_collection.return_value = mock_collection
     
@@ -469,9 +882,10 @@ def test_get_user_invalid_id_fail(mock_users_collection, invalid_data):
     assert response == expected
 
 # update_user tests
+@patch("main.get_emails_collection")
 @patch("main.get_db")
 @patch("main.get_users_collection")
-def test_update_user_success(mock_users_collection, mock_get_db):
+def test_update_user_success(mock_users_collection, mock_get_db, mock_emails_collection):
     user_id = "1"
 
     user = {
@@ -480,22 +894,16 @@ def test_update_user_success(mock_users_collection, mock_get_db):
         "type": "user"
     }
 
-    mock_user_doc = MagicMock()
-    mock_user_doc.id = "some_id"
-    mock_user_doc.to_dict.return_value = user
-
-    # mock query
-    mock_query = MagicMock()
-    mock_query.where.return_value.limit.return_value.stream.return_value = [mock_user_doc]
-    mock_users_collection.return_value = mock_query
-
     mock_user_doc_ref = MagicMock()
+    mock_user_doc_ref.get.return_value.to_dict.return_value = {"id": user_id, "email": "old@example.com", "type": "user"}
     mock_collection = MagicMock()
-    mock_collection.return_value = mock_user_doc_ref
+    mock_collection.document.return_value = mock_user_doc_ref
+    mock_users_collection.return_value = mock_collection
 
-    mock_db = MagicMock()
-    mock_db.collection.return_value = mock_collection
-    mock_get_db.return_value = mock_db
+    # reservations for the new and previous email
+    mock_emails = mock_emails_collection.return_value
+    mock_emails.document.side_effect = lambda key: {main.email_key("user@example.com"): "new", main.email_key("old@example.com"): "old"}[key]
+    mock_batch = mock_get_db.return_value.batch.return_value
 
     expected = (
         json.dumps({
@@ -511,6 +919,58 @@ def test_update_user_success(mock_users_collection, mock_get_db):
     response = update_user(user_id, user)
 
     assert response == expected
+    mock_collection.document.assert_called_once_with(user_id)
+    # the reservation moves to the new email along with the update
+    mock_batch.create.assert_called_once_with("new", {"email": "user@example.com", "userId": user_id})
+    mock_batch.delete.assert_called_once_with("old")
+    assert mock_batch.update.call_args[0] == (mock_user_doc_ref, {"email": "user@example.com", "type": "user"})
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_emails_collection")
+@patch("main.get_db")
+@patch("main.get_users_collection")
+def test_update_user_type_success(mock_users_collection, mock_get_db, mock_emails_collection):
+    response = update_user("1", {"type": "admin"})
+
+    assert response[1] == 200
+    # without a new email there is no reservation to move
+    mock_users_collection.return_value.document.return_value.update.assert_called_once_with({"type": "admin"})
+    mock_get_db.return_value.batch.assert_not_called()
+
+@pytest.mark.parametrize("error", [AlreadyExists("Document already exists"), FailedPrecondition("Document changed")])
+@patch("main.get_emails_collection")
+@patch("main.get_db")
+@patch("main.get_users_collection")
+def test_update_user_email_conflict_fail(mock_users_collection, mock_get_db, mock_emails_collection, error):
+    mock_users_collection.return_value.document.return_value.get.return_value.to_dict.return_value = {"email": "old@example.com"}
+    # the new email is taken, or the user changed since it was read
+    mock_get_db.return_value.batch.return_value.commit.side_effect = error
+
+    response = update_user("1", {"email": "user@example.com"})
+
+    assert response[1] == 409
+
+@patch("main.get_db")
+@patch("main.get_users_collection")
+def test_update_user_not_found_fail(mock_users_collection, mock_get_db):
+    mock_collection = MagicMock()
+    mock_collection.document.return_value.update.side_effect = NotFound("No document to update")
+    mock_users_collection.return_value = mock_collection
+
+    expected = (
+        json.dumps({
+            "message": "Not Found",
+            "data": ""
+        }),
+        404,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = update_user("missing", {"type": "user"})
+
+    assert response == expected
 
 @patch("main.get_db")
 @patch("main.get_users_collection")
@@ -654,17 +1114,17 @@ def test_update_user_invalid_type_fail(mock_users_collection, mock_get_db, inval
     assert response == expected
 
 # delete_user tests
+@patch("main.get_emails_collection")
+@patch("main.get_db")
 @patch("main.get_users_collection")
-def test_delete_user_success(mock_users_collection):
+def test_delete_user_success(mock_users_collection, mock_get_db, mock_emails_collection):
     user_id = "1"
     
     mock_doc_ref = MagicMock()
-    mock_doc = MagicMock()
-    mock_doc.reference = mock_doc_ref
-
-    mock_query = MagicMock()
-    mock_query.where.return_value.stream.return_value = [mock_doc]
-    mock_users_collection.return_value = mock_query
+    mock_doc_ref.get.return_value.to_dict.return_value = {"id": user_id, "email": "user@example.com"}
+    mock_collection = MagicMock()
+    mock_collection.document.return_value = mock_doc_ref
+    mock_users_collection.return_value = mock_collection
 
     expected = (
         json.dumps({
@@ -678,17 +1138,43 @@ def test_delete_user_success(mock_users_collection):
     )
 
     response = delete_user(user_id)
+    mock_batch = mock_get_db.return_value.batch.return_value
+
+    assert response == expected
+    mock_collection.document.assert_called_once_with(user_id)
+    # the user and their email reservation are deleted together
+    assert mock_batch.delete.call_args_list[0][0] == (mock_doc_ref,)
+    mock_emails_collection.return_value.document.assert_called_once_with(main.email_key("user@example.com"))
+    mock_batch.delete.assert_any_call(mock_emails_collection.return_value.document.return_value)
+    mock_batch.commit.assert_called_once()
+
+@patch("main.get_db")
+@patch("main.get_users_collection")
+def test_delete_user_not_found_fail(mock_users_collection, mock_get_db):
+    mock_collection = MagicMock()
+    mock_collection.document.return_value.get.return_value.exists = False
+    mock_users_collection.return_value = mock_collection
+
+    expected = (
+        json.dumps({
+            "message": "Not Found",
+            "data": ""
+        }),
+        404,
+        {
+            "Content-Type": "application/json"
+        }
+    )
+
+    response = delete_user("missing")
 
     assert response == expected
 
 @patch("main.get_users_collection")
 @pytest.mark.parametrize("invalid_data", [0, None, ""])
 def test_delete_user_invalid_id_fail(mock_users_collection, invalid_data):
-    mock_query = MagicMock()
-    mock_query.stream.return_value = []
-
     mock_collection = MagicMock()
-    mock_collection.where.return_value = mock_query
+    mock_collection.document.return_value.get.return_value.exists = False
 
     mock_users_collection.return_value = mock_collection
     
@@ -725,17 +1211,9 @@ def test_update_password_success(mock_users_collection, mock_get_db):
         "password": hashed_pw
     }
 
-    mock_query = MagicMock()
-    mock_query.where.return_value.limit.return_value.stream.return_value = [mock_user_doc]
-    mock_users_collection.return_value = mock_query
-
-    mock_user_doc_ref = MagicMock()
     mock_collection = MagicMock()
-    mock_collection.return_value.document.return_value = mock_user_doc_ref
-
-    mock_db = MagicMock()
-    mock_db.collection.return_value = mock_collection
-    mock_get_db.return_value = mock_db
+    mock_collection.document.return_value.get.return_value = mock_user_doc
+    mock_users_collection.return_value = mock_collection
 
     user_data = {
         "id": user_id,
@@ -775,17 +1253,9 @@ def test_update_password_invalid_password_fail(mock_users_collection, mock_get_d
         "password": hashed_pw
     }
 
-    mock_query = MagicMock()
-    mock_query.where.return_value.limit.return_value.stream.return_value = [mock_user_doc]
-    mock_users_collection.return_value = mock_query
-
-    mock_user_doc_ref = MagicMock()
     mock_collection = MagicMock()
-    mock_collection.return_value.document.return_value = mock_user_doc_ref
-
-    mock_db = MagicMock()
-    mock_db.collection.return_value = mock_collection
-    mock_get_db.return_value = mock_db
+    mock_collection.document.return_value.get.return_value = mock_user_doc
+    mock_users_collection.return_value = mock_collection
 
     expected = (
         json.dumps({
@@ -800,4 +1270,84 @@ def test_update_password_invalid_password_fail(mock_users_collection, mock_get_d
 
     response = update_password(user_id, {"prevPassword": prev_password, "newPassword": invalid_data})
 
-    assert response == expected
\ No newline at end of file
+    assert response == expected
+
+# password pool tests
+@pytest.fixture
+def busy_password_pool(monkeypatch):
+    # one worker, no queue, and the worker held until the test ends
+    monkeypatch.setattr(main, "PASSWORD_WORKERS", 1)
+    monkeypatch.setattr(main, "PASSWORD_QUEUE_LIMIT", 0)
+    monkeypatch.setattr(main, "_password_pool", None)
+    release = threading.Event()
+    started = threading.Event()
+
+    def hold():
+        started.set()
+        release.wait()
+
+    holder = threading.Thread(target=main.run_password_task, args=(hold,))
+    holder.start()
+    started.wait()
+    yield
+    release.set()
+    holder.join()
+
+def test_run_password_task_success(monkeypatch):
+    monkeypatch.setattr(main, "PASSWORD_WORKERS", 1)
+    monkeypatch.setattr(main, "PASSWORD_QUEUE_LIMIT", 0)
+    monkeypatch.setattr(main, "_password_pool", None)
+
+    # each task frees its slot when it finishes
+    assert [main.run_password_task(lambda value: value * 2, i) for i in range(3)] == [0, 2, 4]
+
+def test_run_password_task_full_fail(busy_password_pool):
+    with pytest.raises(main.PasswordPoolFull):
+        main.run_password_task(lambda: None)
+
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_login_user_busy_fail(mock_users_collection, mock_emails_collection, busy_password_pool):
+    mock_login_docs(mock_emails_collection, mock_users_collection, {"email": "email@example.com", "password": "$2b$04$" + "a" * 53})
+
+    response = login_user({"email": "email@example.com", "password": "Password123!"})
+
+    # turned away straight away rather than queued
+    assert response[1] == 503
+
+@patch("main.get_db")
+@patch("main.get_emails_collection")
+@patch("main.get_users_collection")
+def test_register_user_busy_fail(mock_users_collection, mock_emails_collection, mock_get_db, busy_password_pool):
+    mock_emails_collection.return_value.document.return_value.get.return_value.exists = False
+
+    response = register_user({"email": "user@example.com", "password": "Password123!", "type": "user"})
+
+    assert response[1] == 503
+    mock_get_db.return_value.batch.assert_not_called()
+
+# get_db tests
+@patch("google.cloud.firestore.Client")
+def test_get_db_reuses_client(mock_client, monkeypatch):
+    monkeypatch.setattr(main, "_db", None)
+    monkeypatch.setattr(main, "_users_collection", None)
+
+    # simulate concurrent cold requests
+    threads = [threading.Thread(target=main.get_users_collection) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert main.get_db() is main.get_db()
+    assert main.get_users_collection() is main.get_users_collection()
+    mock_client.assert_called_once()
+
+# cold start tests
+def test_import_defers_heavy_dependencies():
+    # import main in a fresh interpreter, like a cold start would
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main; print([m for m in ('google.cloud.firestore', 'bcrypt') if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], cwd=service_dir, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"